@@ -11,17 +11,19 @@ import sharkpylib.tklib.tkinter_widgets as tkw
 
 import core
 from . import gui
+from .lib.timing import Timer
 from plugins.plugin_app import PluginApp
 
-ALL_PAGES = dict()
-ALL_PAGES['PageStart'] = gui.PageStart
-ALL_PAGES['PageUser'] = gui.PageUser
-ALL_PAGES['PageBasic'] = gui.PageBasic
-ALL_PAGES['PageAdvanced'] = gui.PageAdvanced
+# Pages are imported and created first when shown. See App.get_frame
+ALL_PAGES = ['PageStart', 'PageUser', 'PageBasic', 'PageAdvanced']
 
 APP_TO_PAGE = dict()
-for page_name, page in ALL_PAGES.items():
+
+
+def get_page_class(page_name):
+    page = getattr(gui, page_name)
     APP_TO_PAGE[page] = page_name
+    return page
 
 
 class App(PluginApp):
@@ -43,6 +45,7 @@ class App(PluginApp):
     def startup(self):
         """
         """
+        self.startup_timer = Timer('Svea CTD startup')
         # Setting upp GUI logger
         if not os.path.exists(self.log_directory):
             os.makedirs(self.log_directory)
@@ -72,6 +75,7 @@ class App(PluginApp):
         self.show_frame('PageStart')
 
         self.update_all()
+        self.logger.info(self.startup_timer.get_report())
 
     def close(self):
         for page_name, frame in self.frames.items():
@@ -93,23 +97,32 @@ class App(PluginApp):
         # Tuple that store all pages
         self.pages_started = dict()
 
-        # Dictionary to store all frame classes
-        self.frames = {}
-        
-        # Looping all pages to make them active. 
-        for page_name, Page in ALL_PAGES.items():  # Capital P to emphasize class
-            # Destroy old page if called as an update
+        # Destroy old pages if called as an update
+        for frame in getattr(self, 'frames', {}).values():
             try:
-                self.frames[page_name].destroy()
+                frame.destroy()
             except:
                 pass
-            frame = Page(self.container, self)
-            frame.grid(row=0, column=0, sticky="nsew")
 
-            self.container.rowconfigure(0, weight=1)
-            self.container.columnconfigure(0, weight=1) 
-            
+        # Dictionary to store all frame classes. Frames are created in get_frame
+        self.frames = {}
+
+    def get_frame(self, page_name):
+        """
+        Returns the frame for the given page. The page module is imported and the frame created the first time.
+        """
+        if page_name not in self.frames:
+            with self.startup_timer.measure(f'Import {page_name}'):
+                Page = get_page_class(page_name)  # Capital P to emphasize class
+            with self.startup_timer.measure(f'Create {page_name}'):
+                frame = Page(self.container, self)
+                frame.grid(row=0, column=0, sticky="nsew")
+
+                self.container.rowconfigure(0, weight=1)
+                self.container.columnconfigure(0, weight=1)
+
             self.frames[page_name] = frame
+        return self.frames[page_name]
 
     def _set_load_frame(self):
         pass
@@ -128,11 +141,14 @@ class App(PluginApp):
         """
 
         load_page = True
-        frame = self.frames[page_name]
+        page = page_name
+        frame = self.get_frame(page_name)
         # self.withdraw()
         if not self.pages_started.get(page_name, None):
-            frame.startup()
+            with self.startup_timer.measure(f'Startup {page_name}'):
+                frame.startup()
             self.pages_started[page_name] = True
+            self.logger.debug(self.startup_timer.get_report())
         frame.update_page()
 
         #-----------------------------------------------------------------------
@@ -3,10 +3,19 @@
 #
 # Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
 # License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+import importlib
 
-from .page_user import PageUser
-from .page_start import PageStart
-from .page_advanced import PageAdvanced
-from .page_basic import PageBasic
+# The page modules import heavy packages (ctdpy, svea etc.) so they are imported first when accessed
+PAGE_MODULES = dict(PageUser='page_user',
+                    PageStart='page_start',
+                    PageAdvanced='page_advanced',
+                    PageBasic='page_basic')
+
+
+def __getattr__(name):
+    if name not in PAGE_MODULES:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    module = importlib.import_module(f'.{PAGE_MODULES[name]}', __name__)
+    return getattr(module, name)
 
 
@@ -5,7 +5,7 @@
 # License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
 import datetime
 import shutil
-import time
+import tempfile
 import tkinter as tk
 from tkinter import ttk
 from tkinter import filedialog
@@ -16,11 +16,25 @@ import os
 
 from sharkpylib.tklib import tkinter_widgets as tkw
 
-from ctdpy.core import session as ctdpy_session
-from ctdpy.core.utils import generate_filepaths
-
 from pathlib import Path
 
+from ..lib import batch
+from ..lib import cast_cache
+from ..lib import cnv
+from ..lib import files
+from ..lib import jobs
+from ..lib import journal
+from ..lib import profiling
+from ..lib import reading
+from ..lib import transfer
+from ..lib.manifest import FileManifest
+
+# Files kept by the plugin in the working directory (matched on name prefix, e.g. the journal's -wal file).
+# They do not make the directory "not empty" and are kept when the old files are removed.
+WORKING_DIRECTORY_STATE_NAMES = [journal.JOURNAL_FILE_NAME,
+                                 cast_cache.CACHE_DIRECTORY_NAME,
+                                 profiling.RUN_LOG_FILE_NAME]
+
 
 class PageAdvanced(tk.Frame):
 
@@ -78,7 +92,18 @@ class PageAdvanced(tk.Frame):
                    text='Create standard format files',
                    command=self._create_standard_format_files).grid(row=0, column=0, **padding)
 
+        self.boolean_incremental_standard_format = tk.BooleanVar()
+        ttk.Checkbutton(frame, text='Only process new or changed files',
+                        variable=self.boolean_incremental_standard_format).grid(row=0, column=1, **padding)
+        self.boolean_incremental_standard_format.set(
+            self.user.create_options.setdefault('incremental_standard_format', True))
+
     def _create_standard_format_files(self):
+        from ctdpy.core import session as ctdpy_session
+        from ctdpy.core.utils import generate_filepaths
+        if self.copy_runner.is_running:
+            messagebox.showinfo('Create standard files', 'Wait until the CNV files have been copied')
+            return
         try:
             working_directory = self._get_working_directory()
             if not self._is_validate_working_directory(working_directory):
@@ -92,44 +117,87 @@ class PageAdvanced(tk.Frame):
                 return
 
             save_directory = Path(working_directory, 'standard_format_files')
+            manifest = FileManifest(save_directory)
+            incremental = self.boolean_incremental_standard_format.get()
+            self.user.create_options.set('incremental_standard_format', incremental)
+
+            files = list(generate_filepaths(working_directory,
+                                            pattern_list=['.cnv', '.xlsx'],
+                                            only_from_dir=True))
+            cnv_files = [path for path in files if Path(path).suffix == '.cnv']
+            metadata_files = [path for path in files if Path(path).suffix == '.xlsx']
+
             if save_directory.exists():
-                if os.listdir(save_directory):
+                if incremental and manifest.entries:
+                    if manifest.get_changed_files(metadata_files):
+                        self.logger.info('Metadata file has changed. All cnv files will be processed')
+                    else:
+                        cnv_files = manifest.get_changed_files(cnv_files)
+                    if not cnv_files:
+                        messagebox.showinfo('Create standard files', 'No new or changed files to process')
+                        return
+                    self.logger.info(f'{len(cnv_files)} new or changed cnv files will be processed')
+                elif os.listdir(save_directory):
                     if messagebox.askyesno('Create standard files', 'Output files already exist. Do you want to delete the old ones?'):
                         self._delete_files_in_directory(save_directory)
+                        manifest.clear()
                     else:
                         messagebox.showinfo('Create standard files', 'Aborted by user')
+                        return
             else:
                 os.makedirs(save_directory)
 
-            files = generate_filepaths(working_directory,
-                                       pattern_list=['.cnv', '.xlsx'],
-                                       only_from_dir=True)
-
-            session = ctdpy_session.Session(filepaths=files,
-                                            reader='smhi')
-
-            start_time = time.time()
-            datasets = session.read()
-            self.logger.debug("Datasets loaded--%.3f sec" % (time.time() - start_time))
-
-            start_time = time.time()
-            data_path = session.save_data(datasets,
-                                          writer='ctd_standard_template',
-                                          return_data_path=True,
-                                          # save_path=save_directory,
-                                          )
-            for file_name in os.listdir(data_path):
-                source_path = Path(data_path, file_name)
-                target_path = Path(save_directory, file_name)
-                shutil.copy2(source_path, target_path)
-
-            self.logger.debug(f"Datasets saved in {time.time() - start_time} sec at location: {data_path}. Files copied to: {save_directory}")
+            profiler = profiling.Profiler(working_directory, logger=self.logger)
+            cast_by_cast = self.boolean_cast_by_cast.get()
+            self.user.create_options.set('cast_by_cast_standard_format', cast_by_cast)
+            if cast_by_cast:
+                with profiler.measure(profiling.STAGE_STANDARD_FORMAT) as record:
+                    saved_paths = self._save_standard_format_cast_by_cast(cnv_files, metadata_files,
+                                                                          save_directory, manifest, profiler)
+                    record['nr_files'] = len(saved_paths)
+            else:
+                session = ctdpy_session.Session(filepaths=cnv_files + metadata_files,
+                                                reader='smhi')
+
+                with profiler.measure(f'{profiling.STAGE_STANDARD_FORMAT}.read', nr_files=len(cnv_files)) as record:
+                    datasets = self._read_datasets(session, cnv_files + metadata_files,
+                                                   cache_directory=working_directory)
+                self.logger.debug(f"Datasets loaded--{record['wall_time']:.3f} sec")
+
+                with profiler.measure(f'{profiling.STAGE_STANDARD_FORMAT}.save') as record:
+                    saved_paths = self._save_data(session, datasets,
+                                                  writer='ctd_standard_template',
+                                                  target_directory=save_directory)
+                    record['nr_files'] = len(saved_paths)
+
+                manifest.update(cnv_files + metadata_files)
+                manifest.save()
+
+            self.logger.debug(f"{len(saved_paths)} files saved in {record['wall_time']} sec at location: {save_directory}")
             messagebox.showinfo('Create standard files', f'Standard format files created in directory: {save_directory}')
 
         except Exception as e:
             self.logger.error(e)
             messagebox.showerror('Internal error', e)
 
+    def _save_standard_format_cast_by_cast(self, cnv_files, metadata_files, save_directory, manifest, profiler):
+        """
+        Reads and saves one cast at a time, so peak memory is bounded by the largest cast and not by the
+        whole cruise. The manifest is saved after each cast, so an interrupted run keeps the casts already done.
+        """
+        saved_paths = []
+        batches = reading.iter_datasets(cnv_files + metadata_files, reader='smhi', batch_size=1,
+                                        cache_directory=save_directory.parent)
+        for cnv_file in cnv_files:
+            with profiler.measure(f'{profiling.STAGE_STANDARD_FORMAT}.cast', cast=Path(cnv_file).stem, nr_files=1):
+                session, datasets = next(batches)
+                saved_paths.extend(self._save_data(session, datasets,
+                                                   writer='ctd_standard_template',
+                                                   target_directory=save_directory))
+            manifest.update([cnv_file] + metadata_files)
+            manifest.save()
+        return saved_paths
+
     def _build_frame_metadata_file(self, frame):
         padding = dict(padx=10,
                        pady=5)
@@ -199,6 +267,93 @@ class PageAdvanced(tk.Frame):
         ttk.Checkbutton(frame, text='Overwrite metadata', variable=self.boolean_overwrite_metadata).grid(row=0, column=0, **padding)
         self.boolean_overwrite_metadata.set(self.user.create_options.setdefault('overwrite_metadata', False))
 
+        self.boolean_direct_save = tk.BooleanVar()
+        ttk.Checkbutton(frame, text='Write files directly to target directory',
+                        variable=self.boolean_direct_save).grid(row=1, column=0, **padding)
+        self.boolean_direct_save.set(self.user.create_options.setdefault('direct_save', True))
+
+        self.boolean_parallel_read = tk.BooleanVar()
+        ttk.Checkbutton(frame, text='Read files in parallel',
+                        variable=self.boolean_parallel_read).grid(row=2, column=0, **padding)
+        self.boolean_parallel_read.set(self.user.create_options.setdefault('parallel_read', False))
+
+        self.boolean_header_only_metadata = tk.BooleanVar()
+        ttk.Checkbutton(frame, text='Read only cnv headers for metadata file',
+                        variable=self.boolean_header_only_metadata).grid(row=3, column=0, **padding)
+        self.boolean_header_only_metadata.set(self.user.create_options.setdefault('header_only_metadata', False))
+
+        self.boolean_cast_by_cast = tk.BooleanVar()
+        ttk.Checkbutton(frame, text='Create standard format one cast at a time (less memory)',
+                        variable=self.boolean_cast_by_cast).grid(row=4, column=0, **padding)
+        self.boolean_cast_by_cast.set(self.user.create_options.setdefault('cast_by_cast_standard_format', False))
+
+    def _read_datasets(self, session, file_paths, cache_directory=None):
+        """
+        Reads the files in session. In parallel read mode the files are read in several processes
+        and merged. The result is the same as for session.read().
+
+        :param cache_directory: working directory holding the cast cache. Unchanged files are loaded from
+        the cache instead of being parsed again
+        """
+        parallel_read = self.boolean_parallel_read.get()
+        self.user.create_options.set('parallel_read', parallel_read)
+        nr_workers = batch.get_default_nr_workers() if parallel_read else 1
+        if cache_directory:
+            return reading.read_datasets_cached(session, cache_directory,
+                                                reader='smhi',
+                                                nr_workers=nr_workers,
+                                                logger=self.logger)
+        if not parallel_read:
+            return session.read()
+        return reading.read_datasets(file_paths,
+                                     reader='smhi',
+                                     nr_workers=batch.get_default_nr_workers(),
+                                     logger=self.logger)
+
+    def _save_data(self, session, datasets, writer, target_directory):
+        """
+        Saves datasets with the given ctdpy writer and returns the paths of the files in target_directory.
+        In direct save mode the writer writes to a staging directory inside target_directory and each file
+        is renamed in place, so a crash never leaves partial outputs. Otherwise the files are written
+        to the default ctdpy location and copied.
+        """
+        direct_save = self.boolean_direct_save.get()
+        self.user.create_options.set('direct_save', direct_save)
+        if direct_save:
+            return files.save_in_directory(lambda staging: self._save_data_in_staging(session, datasets, writer,
+                                                                                      staging),
+                                           target_directory)
+
+        data_path = Path(session.save_data(datasets,
+                                           writer=writer,
+                                           return_data_path=True))
+        if data_path.is_file():
+            source_paths = [data_path]
+        else:
+            source_paths = [Path(data_path, file_name) for file_name in os.listdir(data_path)]
+        target_paths = []
+        for source_path in source_paths:
+            target_path = Path(target_directory, source_path.name)
+            shutil.copy2(source_path, target_path)
+            target_paths.append(target_path)
+        return target_paths
+
+    @staticmethod
+    def _save_data_in_staging(session, datasets, writer, staging):
+        """
+        Saves datasets with session.save_data(save_path=...) into the staging directory. The ctdpy metadata writer
+        appends its folder name directly to the export path, so the path must end with a separator. Raises
+        ValueError if the writer did not write inside the staging directory.
+        """
+        data_path = session.save_data(datasets,
+                                      writer=writer,
+                                      save_path=f'{staging}{os.sep}',
+                                      return_data_path=True)
+        try:
+            Path(data_path).resolve().relative_to(Path(staging).resolve())
+        except (TypeError, ValueError):
+            raise ValueError(f'Files were not written to the staging directory {staging}: {data_path}')
+
     def _build_frame_create_metadata_file(self, frame):
         padding = dict(padx=10,
                        pady=5,
@@ -208,6 +363,11 @@ class PageAdvanced(tk.Frame):
                                                       command=self._callback_create_metadata_file)
         self.button_create_metadata_file.grid(row=0, column=0, **padding)
 
+        self.progressbar_copy = ttk.Progressbar(frame, orient='horizontal', length=200, mode='determinate')
+        self.progressbar_copy.grid(row=1, column=0, **padding)
+        self.strvar_copy_progress = tk.StringVar()
+        tk.Label(frame, textvariable=self.strvar_copy_progress).grid(row=2, column=0, **padding)
+
     def _select_working_directory(self):
         directory = filedialog.askdirectory()
         if not directory:
@@ -245,7 +405,7 @@ class PageAdvanced(tk.Frame):
 
     @staticmethod
     def directory_is_empty(directory):
-        if os.listdir(directory):
+        if [name for name in os.listdir(directory) if not name.startswith(tuple(WORKING_DIRECTORY_STATE_NAMES))]:
             return False
         return True
     
@@ -280,19 +440,57 @@ class PageAdvanced(tk.Frame):
             self.logger.debug(f'Directory is not a valid working directory: {directory}')
             return False
 
-        for file_name in os.listdir(directory):
-            file_path = Path(directory, file_name)
-            try:
-                if file_path.is_file():
-                    os.remove(str(file_path))
-                elif file_path.is_dir():
-                    shutil.rmtree(str(file_path))
-            except Exception as e:
-                self.logger.error(e)
-                messagebox.showerror('Removing files', e)
+        # The old content is renamed aside so that the directory can be used at once and deleted in the
+        # background. Entries that can not be renamed are deleted in place. The cast journal, cast cache and run
+        # log are kept, only the casts of the journal are removed.
+        trash_directory, not_moved = files.move_contents_aside(directory, keep=WORKING_DIRECTORY_STATE_NAMES)
+        if not_moved:
+            self.logger.debug(f'Could not move {len(not_moved)} entries aside, deleting in place: {directory}')
+            self._report_delete_errors(files.delete_paths(not_moved))
+        if Path(directory, journal.JOURNAL_FILE_NAME).exists():
+            with journal.Journal(directory, logger=self.logger) as cast_journal:
+                cast_journal.clear()
+        stale_directories = [path for path in files.get_stale_trash_directories(Path(directory).parent)
+                             if path != trash_directory and path not in self.trash_directories]
+        if trash_directory:
+            stale_directories.insert(0, trash_directory)
+        if stale_directories:
+            self._delete_in_background(stale_directories)
         self.logger.debug(f'Deleted files in directory: {directory}')
         return True
 
+    def _delete_in_background(self, directories):
+        self.trash_directories.update(directories)
+
+        def target(job):
+            errors = []
+            for directory in directories:
+                errors.extend(files.delete_tree(directory))
+            return errors
+
+        def on_done(errors):
+            self.trash_directories.difference_update(directories)
+            self._report_delete_errors(errors)
+
+        def on_error(error, trace):
+            self.trash_directories.difference_update(directories)
+            self._report_delete_errors([trace])
+
+        jobs.JobRunner(self, logger=self.logger).start(target,
+                                                       title='Removing files',
+                                                       on_done=on_done,
+                                                       on_error=on_error)
+
+    def _report_delete_errors(self, errors, max_nr_lines=20):
+        if not errors:
+            return
+        for error in errors:
+            self.logger.error(error)
+        lines = errors[:max_nr_lines]
+        if len(errors) > max_nr_lines:
+            lines.append(f'... and {len(errors) - max_nr_lines} more')
+        messagebox.showerror('Removing files', f'{len(errors)} files could not be removed:\n' + '\n'.join(lines))
+
     def _generate_subdirectory(self):
         working_directory = self.strvar_working_directory.get()
         if not working_directory:
@@ -372,6 +570,10 @@ class PageAdvanced(tk.Frame):
         self.logger.info('CNV files loaded')
 
     def _callback_create_metadata_file(self, *args, **kwargs):
+        from ctdpy.core import session as ctdpy_session
+        if self.copy_runner.is_running:
+            messagebox.showinfo('Create metadata file', 'Wait until the CNV files have been copied')
+            return
         try:
             # Check working path
             working_directory = self._get_working_directory()
@@ -418,11 +620,9 @@ class PageAdvanced(tk.Frame):
                 return
 
             file_paths = [str(self.cnv_files_paths.get(file_name)) for file_name in file_names]
-            session = ctdpy_session.Session(filepaths=file_paths,
-                                            reader='smhi')
-            start_time = time.time()
-            datasets = session.read()
-            self.logger.debug(f'{len(file_paths)} CNV files loaded in {time.time()-start_time} seconds.')
+            profiler = profiling.Profiler(working_directory, logger=self.logger)
+            header_only = self.boolean_header_only_metadata.get()
+            self.user.create_options.set('header_only_metadata', header_only)
 
             # Check metadata
             metadata = {}
@@ -432,38 +632,42 @@ class PageAdvanced(tk.Frame):
                     continue
                 metadata[key] = value
             self.logger.debug(f'{len(metadata)} metadata parameters selected for update')
-
-            # Update metadata in datasets
             overwrite = self.boolean_overwrite_metadata.get()
             self.logger.debug(f'Overwrite metadata is set to {overwrite}')
-            session.update_metadata(datasets=datasets[0], metadata=metadata, overwrite=overwrite)
-            self.logger.debug('Metadata updated in dataset')
 
-            # Save data
-            self._create_working_directory(working_directory)
-            start_time = time.time()
-            save_path = session.save_data(datasets[0],
-                                          writer='metadata_template',
-                                          return_data_path=True)
-            self.logger.debug(f'Data saved in {time.time()-start_time} seconds at location {save_path}')
+            with tempfile.TemporaryDirectory(prefix='svea_ctd_headers_') as header_directory:
+                read_paths = file_paths
+                if header_only:
+                    # The metadata template only needs the header of each cast. ctdpy reads copies holding
+                    # the header and the first and last scan instead of the full files.
+                    with profiler.measure(f'{profiling.STAGE_METADATA}.headers', nr_files=len(file_paths)) as record:
+                        read_paths = [str(path) for path in cnv.iter_header_copies(file_paths, header_directory)]
+                    self.logger.debug(f"{len(file_paths)} CNV headers copied in {record['wall_time']} seconds.")
+
+                session = ctdpy_session.Session(filepaths=read_paths,
+                                                reader='smhi')
+                with profiler.measure(f'{profiling.STAGE_METADATA}.read', nr_files=len(read_paths)) as record:
+                    # Header copies are temporary and not worth caching
+                    datasets = self._read_datasets(session, read_paths,
+                                                   cache_directory=None if header_only else working_directory)
+                self.logger.debug(f"{len(read_paths)} CNV files loaded in {record['wall_time']} seconds.")
+
+                # Update metadata in datasets
+                session.update_metadata(datasets=datasets[0], metadata=metadata, overwrite=overwrite)
+                self.logger.debug('Metadata updated in dataset')
+
+                # Save data
+                self._create_working_directory(working_directory)
+                with profiler.measure(f'{profiling.STAGE_METADATA}.save') as record:
+                    self._save_data(session, datasets[0],
+                                    writer='metadata_template',
+                                    target_directory=working_directory)
+                self.logger.debug(f"Data saved in {record['wall_time']} seconds at location {working_directory}")
 
             # Save options
             self.user.create_options.set('overwrite_metadata', overwrite)
 
-            # Copy metadata file
-            source_path = Path(save_path)
-            target_path = Path(working_directory, source_path.name)
-            shutil.copy2(source_path, target_path)
-
-            # Copy cnv files
-            for file_path in file_paths:
-                source_path = Path(file_path)
-                target_path = Path(working_directory, source_path.name)
-                shutil.copy2(source_path, target_path)
-
-            self.main_app.update_help_information(f'Data copied to: {working_directory}')
-            self.user.directory.set('working_directory', working_directory)
-            self.logger.info(f'Data moved to {working_directory}')
+            self._copy_cnv_files(file_paths, working_directory, profiler)
 
         except ImportError as e:
             self.logger.error(e)
@@ -471,11 +675,60 @@ class PageAdvanced(tk.Frame):
 
         self._update_working_directory_information()
 
+    def _copy_cnv_files(self, file_paths, working_directory, profiler):
+        """
+        Copies the cnv files to the working directory in the background. The progress is shown below the
+        create metadata button, which is disabled until the copy is done.
+        """
+        def target(job):
+            def progress(nr_done, nr_total, result):
+                job.report_progress(nr_done, nr_total, f'{nr_done}/{nr_total} {Path(result.source_path).name}')
+            job.report_progress(0, len(file_paths), f'0/{len(file_paths)}')
+            with profiler.measure(f'{profiling.STAGE_METADATA}.copy', nr_files=len(file_paths)):
+                return transfer.copy_files(file_paths, working_directory, logger=self.logger,
+                                           progress_callback=progress)
+
+        def on_progress(value, maximum, text):
+            self.progressbar_copy.configure(maximum=maximum or 100, value=value or 0)
+            self.strvar_copy_progress.set(text)
+
+        def on_done(result):
+            copy_results, seconds = result
+            copy_summary = transfer.get_summary(copy_results, seconds)
+            failed = [res for res in copy_results if not res.ok]
+            if failed:
+                messagebox.showwarning('Create metadata file',
+                                       f'{copy_summary}\n\n' + '\n'.join(f'{Path(res.source_path).name}: {res.message}'
+                                                                     for res in failed))
+
+            self.main_app.update_help_information(f'Data copied to: {working_directory} ({copy_summary})')
+            self.user.directory.set('working_directory', working_directory)
+            self.logger.info(f'Data moved to {working_directory}')
+
+        def on_error(error, trace):
+            main_gui.show_error('Copying CNV files', trace)
+
+        def on_finished():
+            self.progressbar_copy.configure(value=0)
+            self.strvar_copy_progress.set('')
+            self.button_create_metadata_file.configure(state='normal')
+            self._update_working_directory_information()
+
+        self.button_create_metadata_file.configure(state='disabled')
+        self.copy_runner.start(target,
+                               title='Copying CNV files',
+                               on_done=on_done,
+                               on_error=on_error,
+                               on_progress=on_progress,
+                               on_finished=on_finished)
+
     def startup(self):
         self.manual_metadata_items = ['WINDIR', 'WINSP', 'AIRTEMP', 'AIRPRES', 'WEATH', 'CLOUD', 'WAVES', 'ICEOB']
         self.manual_metadata_entry_linking = {}
         self.manual_metadata_stringvars = {}
         self.cnv_files_paths = {}
+        self.trash_directories = set()
+        self.copy_runner = jobs.JobRunner(self, logger=self.logger)
 
         self._build()
         self.update_page()
@@ -3,23 +3,44 @@
 #
 # Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
 # License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+import contextlib
 import datetime
 import os
 import tkinter as tk
 import traceback
 from pathlib import Path
 from tkinter import ttk, filedialog, messagebox
-from svea import SveaController
-from ctd_processing import exceptions as ctd_exeptions
 
 import sharkpylib
 from sharkpylib.tklib import tkinter_widgets as tkw
-from sharkpylib.file import Directory
+
+from ..lib import batch
+from ..lib import cast_index
+from ..lib.directory_cache import DirectorySummaryCache, DirectoryWatcher
+from ..lib import jobs
+from ..lib import journal
+from ..lib import profiling
+from ..lib import qc
+from ..lib.raw_scanner import RawScanner
+from ..lib.settings import SettingsWriter
+from ..lib import visual_qc
 
 DEBUG = True
 
+DIRECTORY_CACHE = DirectorySummaryCache()
+RAW_SCANNER = RawScanner()
+
 
 class PageBasic(tk.Frame):
+    PROCESS_SELECTED = 'Vald fil'
+    PROCESS_ALL = 'Alla filer i mappen'
+    VISUAL_QC_LEVELS = {'Full upplösning': None,
+                        'Översikt (2 m)': 'overview',
+                        'Medel (0.5 m)': 'medium'}
+    INDEX_STAGES = {'raw_files_dir': cast_index.STAGE_RAW,
+                    'cnv_files_dir': cast_index.STAGE_CNV,
+                    'standard_files_dir': cast_index.STAGE_STANDARD_FORMAT,
+                    'qc_dir': cast_index.STAGE_QC}
 
     def __init__(self, parent, parent_app, **kwargs):
         tk.Frame.__init__(self, parent, **kwargs)
@@ -32,10 +53,15 @@ class PageBasic(tk.Frame):
         self.user = self.user_manager.user
         
         self.lockable_buttons = []
+        # Widgets that change paths or the state of the controller. Disabled while a job is running
+        self.job_locked_widgets = []
         self.buttons = {}
         self.stringvars = {}
         self.set_svea_paths = {}
-        self.raw_files = None
+        self.raw_files = {}
+        self.cast_index = None
+        self._pending_index_keys = set()
+        self._page_state = {}
 
         self.venv_path = Path(Path(__file__).parent.parent.parent.parent.parent, 'venv')
 
@@ -44,6 +70,8 @@ class PageBasic(tk.Frame):
 
         :return:
         """
+        # Imported here and not at module level to keep the plugin startup fast
+        from svea import SveaController
         self.svea_controller = SveaController(logger=self.logger)
 
         self.set_svea_paths['working_dir'] = self.svea_controller.set_path_working_directory
@@ -52,11 +80,34 @@ class PageBasic(tk.Frame):
         self.set_svea_paths['standard_files_dir'] = self.svea_controller.set_path_standard_format_files
         self.set_svea_paths['qc_dir'] = self.svea_controller.set_path_standard_format_files_qc
 
+        self.job_runner = jobs.JobRunner(self, logger=self.logger)
+        # The cast index reads new files, which can take a while, so it is updated in its own runner
+        self.index_runner = jobs.JobRunner(self, logger=self.logger)
+        self.settings_writer = SettingsWriter(self, logger=self.logger)
+
         self._build()
         self._load_user_setting()
 
+        self.directory_watcher = DirectoryWatcher(DIRECTORY_CACHE)
+        self.directory_watcher.start()
+        self._poll_directory_watcher()
+
     def close(self):
-        self.svea_controller.close_visual_qc()
+        self.settings_writer.flush()
+        self.job_runner.cancel()
+        self.index_runner.cancel()
+        self.directory_watcher.stop()
+        visual_qc.get_server(logger=self.logger).close()
+
+    def _poll_directory_watcher(self):
+        keys = ['working_dir', 'raw_files_dir', 'cnv_files_dir', 'standard_files_dir', 'qc_dir']
+        self.directory_watcher.set_directories([self.stringvars[key].get() for key in keys])
+        changed = self.directory_watcher.pop_changed()
+        if changed:
+            self._update_directory_content()
+            if self.stringvars['raw_files_dir'].get() in changed:
+                self._update_frame_seb_processing()
+        self.after(1000, self._poll_directory_watcher)
 
     def _build(self):
         padding = dict(padx=15,
@@ -148,18 +199,27 @@ class PageBasic(tk.Frame):
         self.lockable_buttons.append(self.buttons['set_standard_dir'])
         self.lockable_buttons.append(self.buttons['set_qc_dir'])
 
+        self.job_locked_widgets.append(self.buttons['set_working_dir'])
+
     def _build_frame_options(self, frame):
         padding = dict(padx=10,
                        pady=5,
                        sticky='w')
 
         self.booleanvar_unlock_selections = tk.BooleanVar()
-        tk.Checkbutton(frame, text='Lås upp val', variable=self.booleanvar_unlock_selections,
-                       command=self._toggle_unlock_selections).grid(row=0, column=0, **padding)
+        checkbutton_unlock_selections = tk.Checkbutton(frame, text='Lås upp val',
+                                                       variable=self.booleanvar_unlock_selections,
+                                                       command=self._toggle_unlock_selections)
+        checkbutton_unlock_selections.grid(row=0, column=0, **padding)
 
         self.booleanvar_allow_overwrite = tk.BooleanVar()
-        tk.Checkbutton(frame, text='Skriv över filer', variable=self.booleanvar_allow_overwrite,
-                       command=self._toggle_overwrite).grid(row=1, column=0, **padding)
+        checkbutton_allow_overwrite = tk.Checkbutton(frame, text='Skriv över filer',
+                                                     variable=self.booleanvar_allow_overwrite,
+                                                     command=self._toggle_overwrite)
+        checkbutton_allow_overwrite.grid(row=1, column=0, **padding)
+
+        self.job_locked_widgets.append(checkbutton_unlock_selections)
+        self.job_locked_widgets.append(checkbutton_allow_overwrite)
 
     def _build_frame_seb_processing(self, frame):
         padding = dict(padx=10,
@@ -183,6 +243,17 @@ class PageBasic(tk.Frame):
                 self.ctd_processing_option_widgets[text] = comb
             r += 1
 
+        tk.Label(frame, text='Filer').grid(row=r, column=0, **padding)
+        self.combobox_processing_mode = tkw.ComboboxWidget(frame, items=[self.PROCESS_SELECTED, self.PROCESS_ALL],
+                                                           prop_combobox=dict(width=30), row=r, column=1, **padding)
+        r += 1
+
+        tk.Label(frame, text='Antal processer').grid(row=r, column=0, **padding)
+        nr_workers_items = [str(nr) for nr in range(1, (os.cpu_count() or 1) + 1)]
+        self.combobox_nr_workers = tkw.ComboboxWidget(frame, items=nr_workers_items,
+                                                      prop_combobox=dict(width=30), row=r, column=1, **padding)
+        r += 1
+
         self.button_run_processing = tk.Button(frame, text='Kör processering', command=self._callback_run_seb_processing)
         self.button_run_processing.grid(row=r, column=0, **padding)
         self.lockable_buttons.append(self.button_run_processing)
@@ -211,6 +282,10 @@ class PageBasic(tk.Frame):
         self.button_run_automatic_qc.grid(row=0, column=0, **padding)
         self.lockable_buttons.append(self.button_run_automatic_qc)
 
+        self.booleanvar_incremental_qc = tk.BooleanVar()
+        tk.Checkbutton(frame, text='Endast nya eller ändrade kast', variable=self.booleanvar_incremental_qc,
+                       command=self._save_user_settings).grid(row=1, column=0, **padding)
+
     def _build_frame_man_qc(self, frame):
         padding = dict(padx=10,
                        pady=5,
@@ -233,11 +308,39 @@ class PageBasic(tk.Frame):
         self.button_run_bokeh_server.grid(row=3, column=0, columnspan=2, **padding)
         self.lockable_buttons.append(self.button_run_bokeh_server)
 
+        self.button_restart_bokeh_server = tk.Button(frame, text='Starta om server',
+                                                     command=self._callback_restart_bokeh_server)
+        self.button_restart_bokeh_server.grid(row=4, column=0, columnspan=2, **padding)
+
+        self.job_locked_widgets.append(self.buttons['set_bokeh_venv_path'])
+        self.job_locked_widgets.append(self.buttons['set_shark_package_root'])
+        self.job_locked_widgets.append(self.button_restart_bokeh_server)
+
+        tk.Label(frame, text='Upplösning').grid(row=5, column=0, **padding)
+        self.combobox_visual_qc_level = tkw.ComboboxWidget(frame, items=list(self.VISUAL_QC_LEVELS),
+                                                           prop_combobox=dict(width=30), row=5, column=1, **padding)
+
     def _build_frame_other(self, frame):
         padding = dict(padx=10,
                        pady=5,
                        sticky='w')
 
+        self.stringvars['progress_title'] = tk.StringVar()
+        tk.Label(frame, textvariable=self.stringvars['progress_title']).grid(row=0, column=0, **padding)
+
+        self.progressbar = ttk.Progressbar(frame, orient='horizontal', length=200, mode='determinate')
+        self.progressbar.grid(row=1, column=0, **padding)
+
+        self.stringvars['progress_text'] = tk.StringVar()
+        tk.Label(frame, textvariable=self.stringvars['progress_text']).grid(row=2, column=0, **padding)
+
+        self.button_cancel_job = tk.Button(frame, text='Avbryt', command=self._callback_cancel_job, state='disabled')
+        self.button_cancel_job.grid(row=3, column=0, **padding)
+
+        tk.Label(frame, text='Körlogg (arbetsmapp)').grid(row=4, column=0, **padding)
+        self.stringvars['run_log_summary'] = tk.StringVar()
+        tk.Label(frame, textvariable=self.stringvars['run_log_summary'], justify='left').grid(row=5, column=0, **padding)
+
     def _set_working_directory(self, directory=None):
         old_dir = self.stringvars['working_dir'].get()
         if directory is None:
@@ -252,7 +355,8 @@ class PageBasic(tk.Frame):
 
         self.stringvars['working_dir'].set(directory)
         self.svea_controller.working_directory = directory
-        self.stringvars['working_dir_info'].set(get_directory_info(directory))
+        self._update_directory_info('working_dir')
+        self._update_run_log_summary()
         self._save_user_settings()
         self._update_svea_paths('working_dir')
 
@@ -269,7 +373,7 @@ class PageBasic(tk.Frame):
         if not directory:
             return
         self.stringvars['raw_files_dir'].set(directory)
-        self.stringvars['raw_files_dir_info'].set(get_directory_info(directory))
+        self._update_directory_info('raw_files_dir')
 
         self._update_svea_paths('raw_files_dir')
 
@@ -291,7 +395,7 @@ class PageBasic(tk.Frame):
         if not directory:
             return
         self.stringvars['cnv_files_dir'].set(directory)
-        self.stringvars['cnv_files_dir_info'].set(get_directory_info(directory))
+        self._update_directory_info('cnv_files_dir')
         self._update_svea_paths('cnv_files_dir')
 
         if not d:
@@ -303,7 +407,7 @@ class PageBasic(tk.Frame):
         if not directory:
             return
         self.stringvars['standard_files_dir'].set(directory)
-        self.stringvars['standard_files_dir_info'].set(get_directory_info(directory))
+        self._update_directory_info('standard_files_dir')
         self._save_user_settings()
         self._update_svea_paths('standard_files_dir')
 
@@ -313,7 +417,7 @@ class PageBasic(tk.Frame):
         if not directory:
             return
         self.stringvars['qc_dir'].set(directory)
-        self.stringvars['qc_dir_info'].set(get_directory_info(directory))
+        self._update_directory_info('qc_dir')
         self._save_user_settings()
         
     def _set_bokeh_venv_path(self, directory=None):
@@ -333,12 +437,23 @@ class PageBasic(tk.Frame):
         self._save_user_settings()
 
     def _update_frame_seb_processing(self):
+        """
+        Lists the raw casts with their status in the combobox. Headers already in the cast index are not read
+        again, the index itself is updated in the background (see _update_cast_index).
+        """
         d = self.stringvars['raw_files_dir'].get()
         if not d:
+            self.raw_files = {}
             self.combobox_raw_files.update_items([])
             return
-        self.raw_files = Directory(d, file_type='hdr')
-        self.combobox_raw_files.update_items(self.raw_files.get_list())
+        self.raw_files = {}
+        for cast in RAW_SCANNER.scan(d, index=self._get_cast_index()):
+            name = Path(cast.hdr_path).name
+            status = cast.get_status()
+            if status:
+                name = f'{name} ({status})'
+            self.raw_files[name] = cast.hdr_path
+        self.combobox_raw_files.update_items(list(self.raw_files))
 
     def _update_svea_paths(self, _id=None):
         def none_if_empty(item):
@@ -357,21 +472,72 @@ class PageBasic(tk.Frame):
                 self.set_svea_paths[key](none_if_empty(path))
 
     def _update_directory_content(self):
-        self.stringvars['working_dir_info'].set(get_directory_info(self.stringvars['working_dir'].get()))
-        self.stringvars['raw_files_dir_info'].set(get_directory_info(self.stringvars['raw_files_dir'].get()))
-        self.stringvars['cnv_files_dir_info'].set(get_directory_info(self.stringvars['cnv_files_dir'].get()))
-        self.stringvars['standard_files_dir_info'].set(get_directory_info(self.stringvars['standard_files_dir'].get()))
-        self.stringvars['qc_dir_info'].set(get_directory_info(self.stringvars['qc_dir'].get()))
+        for key in ['working_dir', 'raw_files_dir', 'cnv_files_dir', 'standard_files_dir', 'qc_dir']:
+            self._update_directory_info(key)
+
+    def _get_cast_index(self):
+        working_dir = self.stringvars['working_dir'].get() or None
+        if self.cast_index is None or self.cast_index.working_directory != working_dir:
+            self.cast_index = cast_index.CastIndex(working_dir)
+        return self.cast_index
+
+    def _update_directory_info(self, key):
+        """
+        Updates the info label of the directory in stringvar key. For processing directories the cast index
+        is updated in the background (only new or changed files are read) and its summary is added to the
+        label when done.
+        """
+        directory = self.stringvars[key].get()
+        self.stringvars[f'{key}_info'].set(get_directory_info(directory))
+        if key in self.INDEX_STAGES:
+            self._pending_index_keys.add(key)
+            self._update_cast_index()
+
+    def _update_cast_index(self):
+        """
+        Updates the cast index for the directories in self._pending_index_keys in the index runner.
+        Requests made while an update is running are collected and run when it has finished.
+        """
+        if self.index_runner.is_running or not self._pending_index_keys:
+            return
+        directories = {key: self.stringvars[key].get() for key in self._pending_index_keys}
+        self._pending_index_keys = set()
+        index = self._get_cast_index()
+
+        def target(job):
+            index.update({self.INDEX_STAGES[key]: directory for key, directory in directories.items()})
+            return {key: index.get_summary(self.INDEX_STAGES[key]) for key in directories}
+
+        def on_done(summaries):
+            for key, summary in summaries.items():
+                directory = directories[key]
+                if not summary or self.stringvars[key].get() != directory:
+                    continue
+                self.stringvars[f'{key}_info'].set(f'{get_directory_info(directory)}\n{summary}')
+
+        def on_error(error, trace):
+            self.logger.warning(f'Could not update cast index: {error}')
+
+        self.index_runner.start(target,
+                                title='Kastindex',
+                                on_done=on_done,
+                                on_error=on_error,
+                                on_finished=self._update_cast_index)
 
     def _toggle_overwrite(self, *args, **kwargs):
+        self._apply_overwrite()
+        self._save_user_settings()
+
+    def _apply_overwrite(self):
         overwrite = self.booleanvar_allow_overwrite.get()
         self.svea_controller.set_overwrite_permission(overwrite)
-        self._save_user_settings()
 
     def _toggle_unlock_selections(self, *args, **kwargs):
-        unlock = self.booleanvar_unlock_selections.get()
         self._save_user_settings()
-        if unlock:
+        self._apply_unlock_selections()
+
+    def _apply_unlock_selections(self):
+        if self.booleanvar_unlock_selections.get():
             self._unlock()
         else:
             self._lock()
@@ -430,23 +596,36 @@ class PageBasic(tk.Frame):
         self.svea_controller.reset_paths()
 
     def _save_user_settings(self):
-        self.user.basic_dirs.set('working', self.stringvars['working_dir'].get())
-        self.user.basic_dirs.set('raw_files', self.stringvars['raw_files_dir'].get())
-        self.user.basic_dirs.set('cnv_files', self.stringvars['cnv_files_dir'].get())
-        self.user.basic_dirs.set('standard_files', self.stringvars['standard_files_dir'].get())
-        self.user.basic_dirs.set('qc_dir', self.stringvars['qc_dir'].get())
-        self.user.basic_dirs.set('shark_package_root', self.stringvars['shark_package_root'].get())
-        self.user.basic_dirs.set('bokeh_venv_path', self.stringvars['bokeh_venv_path'].get())
-
-        self.user.basic_options.set('overwrite', self.booleanvar_allow_overwrite.get())
-        self.user.basic_options.set('unlock_selections', self.booleanvar_unlock_selections.get())
-        self.user.basic_options.set('vis', self.combobox_vis.get())
-
+        """
+        Queues the current settings. They are written by self.settings_writer when the gui has been quiet
+        for a short while, and only values that have changed are written.
+        """
+        self.settings_writer.update(self.user.basic_dirs, {
+            'working': self.stringvars['working_dir'].get(),
+            'raw_files': self.stringvars['raw_files_dir'].get(),
+            'cnv_files': self.stringvars['cnv_files_dir'].get(),
+            'standard_files': self.stringvars['standard_files_dir'].get(),
+            'qc_dir': self.stringvars['qc_dir'].get(),
+            'shark_package_root': self.stringvars['shark_package_root'].get(),
+            'bokeh_venv_path': self.stringvars['bokeh_venv_path'].get(),
+        })
+
+        options = {
+            'overwrite': self.booleanvar_allow_overwrite.get(),
+            'unlock_selections': self.booleanvar_unlock_selections.get(),
+            'vis': self.combobox_vis.get(),
+            'processing_mode': self.combobox_processing_mode.get(),
+            'nr_workers': self.combobox_nr_workers.get(),
+            'incremental_qc': self.booleanvar_incremental_qc.get(),
+            'visual_qc_level': self.combobox_visual_qc_level.get(),
+        }
         for text, opt in self.ctd_processing_option_widgets.items():
-            # print('OPT', text, opt.get())
-            self.user.basic_options.set(text, opt.get())
+            options[text] = opt.get()
+        self.settings_writer.update(self.user.basic_options, options)
 
     def _load_user_setting(self):
+        # Settings not yet written would otherwise be lost when the widgets are reloaded
+        self.settings_writer.flush()
         self.stringvars['working_dir'].set(self.user.basic_dirs.setdefault('working', ''))
         self.stringvars['raw_files_dir'].set(self.user.basic_dirs.setdefault('raw_files', ''))
         self.stringvars['cnv_files_dir'].set(self.user.basic_dirs.setdefault('cnv_files', ''))
@@ -475,6 +654,12 @@ class PageBasic(tk.Frame):
         self.booleanvar_allow_overwrite.set(self.user.basic_options.setdefault('overwrite', False))
         self.booleanvar_unlock_selections.set(self.user.basic_options.setdefault('unlock_selections', False))
         self.combobox_vis.set(self.user.basic_options.setdefault('vis', self.combobox_vis.values))
+        self.combobox_processing_mode.set(self.user.basic_options.setdefault('processing_mode', self.PROCESS_SELECTED))
+        self.combobox_nr_workers.set(self.user.basic_options.setdefault('nr_workers',
+                                                                        str(batch.get_default_nr_workers())))
+        self.booleanvar_incremental_qc.set(self.user.basic_options.setdefault('incremental_qc', True))
+        self.combobox_visual_qc_level.set(self.user.basic_options.setdefault('visual_qc_level',
+                                                                             list(self.VISUAL_QC_LEVELS)[0]))
 
         for text, opt in self.ctd_processing_option_widgets.items():
             try:
@@ -492,123 +677,437 @@ class PageBasic(tk.Frame):
                 button.configure(state='normal')
                 button.configure(bg='green')
 
+    def _get_sbe_processing_options(self):
+        options = {}
+        for key, opt in self.ctd_processing_option_widgets.items():
+            options[key] = opt.get()
+        options['root_directory'] = self.stringvars['working_dir'].get()
+        return options
+
+    def _start_job(self, target, title='', on_done=None, button=None):
+        """
+        Runs target(job) in the background. Buttons and the widgets changing paths or controller state are
+        locked while the job is running. If the job fails the button that started the job is highlighted again.
+        If the job is cancelled after target has returned (e.g. with the casts done before the cancel) the
+        result is kept and passed to on_done, otherwise the button is highlighted again.
+        """
+        if self._job_is_running():
+            return
+
+        def on_error(error, trace):
+            from ctd_processing import exceptions as ctd_exeptions
+            if isinstance(error, ctd_exeptions.FileExists):
+                messagebox.showerror('Har inte tillstånd att skriva över fil', error)
+            else:
+                messagebox.showerror('Internal error', trace)
+            self._restore_buttons(button)
+
+        def on_cancel(result):
+            if result is None or not on_done:
+                messagebox.showinfo(title, 'Avbruten av användaren')
+                self._restore_buttons(button)
+                return
+            messagebox.showinfo(title, 'Avbruten av användaren. Det som hann bli klart är sparat.')
+            on_done(result)
+
+        self._lock_buttons()
+        self._set_job_locked_widgets_state('disabled')
+        self.parent_app.progress_running = True
+        self.stringvars['progress_title'].set(title)
+        self.stringvars['progress_text'].set('')
+        self.progressbar.configure(mode='indeterminate')
+        self.progressbar.start()
+        self.button_cancel_job.configure(state='normal')
+        self.job_runner.start(target,
+                              title=title,
+                              on_done=on_done,
+                              on_error=on_error,
+                              on_progress=self._on_job_progress,
+                              on_cancel=on_cancel,
+                              on_finished=self._on_job_finished)
+
+    def _set_job_locked_widgets_state(self, state):
+        for widget in self.job_locked_widgets:
+            widget.configure(state=state)
+
+    def _job_is_running(self):
+        if not self.job_runner.is_running:
+            return False
+        messagebox.showinfo('Pågående körning', f'Vänta tills "{self.job_runner.job.title}" är klar')
+        return True
+
+    def _open_journal(self, run_id):
+        return journal.Journal(self.stringvars['working_dir'].get(), run_id=run_id, logger=self.logger)
+
+    def _ask_resume(self, cast_journal, stage, file_paths, title):
+        """
+        Asks whether to only run the casts that are not done when an earlier run of stage did not finish.
+        Returns True to resume, False to run all casts and None to abort.
+        """
+        if not cast_journal.has_unfinished_work(stage, file_paths):
+            return False
+        states = cast_journal.get_states(stage)
+        nr_unfinished = len([path for path in file_paths
+                             if states.get(cast_index.get_cast_id(path)) != journal.STATE_DONE])
+        return messagebox.askyesnocancel(title,
+                                         f'En tidigare körning blev inte klar ({nr_unfinished} kast '
+                                         f'återstår).\n\nVill du bara köra de kast som inte är klara?\n'
+                                         f'Välj "Nej" för att köra alla kast igen.')
+
+    @contextlib.contextmanager
+    def _record_in_journal(self, run_id, stage, file_paths):
+        """
+        Records a step that works on a whole directory as running for the casts of file_paths, and as done
+        or failed when the block has finished. Runs in the job thread.
+        """
+        with self._open_journal(run_id) as cast_journal:
+            cast_journal.add(stage, file_paths)
+            for path in file_paths:
+                cast_journal.claim(stage, path, redo=True)
+            try:
+                yield
+            except Exception:
+                cast_journal.mark_failed(stage, file_paths, traceback.format_exc())
+                raise
+            cast_journal.mark_done(stage, file_paths)
+
+    def _on_job_progress(self, value, maximum, text):
+        if value is None:
+            self.progressbar.configure(mode='indeterminate')
+            self.progressbar.start()
+        else:
+            self.progressbar.stop()
+            self.progressbar.configure(mode='determinate', maximum=maximum or 100, value=value)
+        self.stringvars['progress_text'].set(text)
+
+    def _get_profiler(self):
+        return profiling.Profiler(self.stringvars['working_dir'].get(), logger=self.logger)
+
+    def _update_run_log_summary(self):
+        working_dir = self.stringvars['working_dir'].get()
+        summary = ''
+        if working_dir:
+            try:
+                summary = profiling.get_summary(profiling.read_run_log(working_dir))
+            except OSError:
+                self.logger.warning(traceback.format_exc())
+        self.stringvars['run_log_summary'].set(summary)
+
+    def _on_job_finished(self):
+        self._update_run_log_summary()
+        self.parent_app.progress_running = False
+        self.progressbar.stop()
+        self.progressbar.configure(mode='determinate', value=0)
+        self.stringvars['progress_title'].set('')
+        self.stringvars['progress_text'].set('')
+        self.button_cancel_job.configure(state='disabled')
+        self._set_job_locked_widgets_state('normal')
+
+    def _restore_buttons(self, button=None):
+        if self._is_locked() and button:
+            self._highlight_button(button)
+        else:
+            self._unlock_buttons()
+
+    def _callback_cancel_job(self):
+        self.job_runner.cancel()
+
     def _callback_run_seb_processing(self):
-        try:
-            file_path = self.raw_files.get_path(self.combobox_raw_files.get())
-            options = {}
-            for key, opt in self.ctd_processing_option_widgets.items():
-                options[key] = opt.get()
-            options['root_directory'] = self.stringvars['working_dir'].get()
-            self.svea_controller.sbe_processing(file_path, **options)
-        except ctd_exeptions.FileExists as e:
-            messagebox.showerror('Har inte tillstånd att skriva över fil', e)
-            self.logger.warning(self.logger.error(traceback.format_exc()))
+        if self.combobox_processing_mode.get() == self.PROCESS_ALL:
+            self._run_seb_processing_all()
             return
+        try:
+            file_path = str(self.raw_files[self.combobox_raw_files.get()])
         except Exception:
             messagebox.showerror('Internal error', traceback.format_exc())
             self.logger.error(traceback.format_exc())
             return
-        self._set_raw_files_directory(self.svea_controller.dirs['raw_files'])
-        self._set_cnv_files_directory(self.svea_controller.dirs['cnv_files'])
+        options = self._get_sbe_processing_options()
+        profiler = self._get_profiler()
+
+        def target(job):
+            job.report_progress(text=Path(file_path).name)
+            with profiler.measure(profiling.STAGE_SBE_PROCESSING, cast=Path(file_path).stem, nr_files=1):
+                self.svea_controller.sbe_processing(file_path, **options)
+            return dict(self.svea_controller.dirs)
+
+        self._start_job(target,
+                        title='SEB processering',
+                        on_done=self._on_seb_processing_done,
+                        button=self.button_run_processing)
+
+    def _run_seb_processing_all(self):
+        if not self.raw_files:
+            messagebox.showinfo('SEB processering', 'Inga råfiler att processera')
+            return
+        if self._job_is_running():
+            return
+        file_paths = [str(path) for path in self.raw_files.values()]
+        paths = {key: self.stringvars[key].get() for key in batch.PATH_SETTERS}
+        profiler = self._get_profiler()
+        cast_journal = self._open_journal(profiler.run_id)
+        resume = self._ask_resume(cast_journal, profiling.STAGE_SBE_PROCESSING, file_paths, 'SEB processering')
+        if resume is None:
+            cast_journal.close()
+            return
+        kwargs = dict(paths=paths,
+                      overwrite=self.booleanvar_allow_overwrite.get(),
+                      options=self._get_sbe_processing_options(),
+                      nr_workers=int(self.combobox_nr_workers.get()),
+                      logger=self.logger,
+                      profiler=profiler,
+                      journal=cast_journal,
+                      resume=resume)
+
+        def target(job):
+            def progress(nr_done, nr_total, result):
+                job.report_progress(nr_done, nr_total, f'{nr_done}/{nr_total} {Path(result.file_path).name}')
+            job.report_progress(0, len(file_paths), f'0/{len(file_paths)}')
+            try:
+                with kwargs['profiler'].measure(profiling.STAGE_SBE_PROCESSING, nr_files=len(file_paths)):
+                    results = batch.sbe_process_files(file_paths,
+                                                      progress_callback=progress,
+                                                      cancel_event=job.cancel_event,
+                                                      **kwargs)
+            finally:
+                cast_journal.close()
+            return results
+
+        def on_done(results):
+            ok_results = [res for res in results if res.ok]
+            if ok_results:
+                self._on_seb_processing_done(ok_results[-1].dirs)
+            else:
+                self._restore_buttons(self.button_run_processing)
+            if not results:
+                messagebox.showinfo('SEB processering', 'Alla kast är redan processerade')
+                return
+            if len(ok_results) == len(results):
+                messagebox.showinfo('SEB processering', batch.get_summary(results))
+            else:
+                messagebox.showwarning('SEB processering', batch.get_summary(results))
+
+        self._start_job(target,
+                        title='SEB processering',
+                        on_done=on_done,
+                        button=self.button_run_processing)
+
+    def _on_seb_processing_done(self, dirs):
+        self._set_raw_files_directory(dirs['raw_files'])
+        self._set_cnv_files_directory(dirs['cnv_files'])
         self._save_user_settings()
         if self._is_locked():
             self._highlight_button(self.button_create_metadata)
+        else:
+            self._unlock_buttons()
 
     def _callback_create_metadata_file(self):
-        try:
-            new_dir = self.svea_controller.create_metadata_file()
-        except Exception as e:
-            raise e
-        except ctd_exeptions.FileExists as e:
-            messagebox.showerror('Har inte tillstånd att skriva över fil', e)
-            return
-        except Exception:
-            messagebox.showerror('Internal error', traceback.format_exc())
-            self.logger.error(traceback.format_exc())
-            return
-        self._set_cnv_files_directory(new_dir)
-        if self._is_locked():
-            self._highlight_button(self.button_create_standard_files)
+        def on_done(new_dir):
+            self._set_cnv_files_directory(new_dir)
+            if self._is_locked():
+                self._highlight_button(self.button_create_standard_files)
+            else:
+                self._unlock_buttons()
+
+        profiler = self._get_profiler()
+        cnv_directory = self.stringvars['cnv_files_dir'].get()
+
+        def target(job):
+            cnv_paths = sorted(Path(cnv_directory).glob('*.cnv')) if cnv_directory else []
+            with self._record_in_journal(profiler.run_id, profiling.STAGE_METADATA, cnv_paths):
+                with profiler.measure(profiling.STAGE_METADATA):
+                    return self.svea_controller.create_metadata_file()
+
+        self._start_job(target,
+                        title='Skapa leveransmall',
+                        on_done=on_done,
+                        button=self.button_create_metadata)
 
     def _callback_create_standard_format(self):
-        try:
-            new_dir = self.svea_controller.create_standard_format()
-        except ctd_exeptions.FileExists as e:
-            messagebox.showerror('Har inte tillstånd att skriva över fil', e)
-            return
-        except Exception:
-            messagebox.showerror('Internal error', traceback.format_exc())
-            self.logger.error(traceback.format_exc())
-            return
-        self._set_standard_files_directory(new_dir)
-        if self._is_locked():
-            self._highlight_button(self.button_run_automatic_qc)
+        def on_done(new_dir):
+            self._set_standard_files_directory(new_dir)
+            if self._is_locked():
+                self._highlight_button(self.button_run_automatic_qc)
+            else:
+                self._unlock_buttons()
+
+        profiler = self._get_profiler()
+        cnv_directory = self.stringvars['cnv_files_dir'].get()
+
+        def target(job):
+            cnv_paths = sorted(Path(cnv_directory).glob('*.cnv')) if cnv_directory else []
+            with self._record_in_journal(profiler.run_id, profiling.STAGE_STANDARD_FORMAT, cnv_paths):
+                with profiler.measure(profiling.STAGE_STANDARD_FORMAT) as record:
+                    new_dir = self.svea_controller.create_standard_format()
+                    record['nr_files'] = len(qc.get_standard_format_files(new_dir))
+            return new_dir
+
+        self._start_job(target,
+                        title='Skapa standardformat',
+                        on_done=on_done,
+                        button=self.button_create_standard_files)
 
     def _callback_run_automatic_qc(self):
-        try:
-            new_dir = self.svea_controller.perform_automatic_qc()
-        except Exception:
-            messagebox.showerror('Internal error', traceback.format_exc())
-            self.logger.error(traceback.format_exc())
+        def on_done(new_dir):
+            self._set_qc_files_directory(new_dir)
+            if self._is_locked():
+                self._highlight_button(self.button_run_bokeh_server)
+            else:
+                self._unlock_buttons()
+
+        if self._job_is_running():
             return
-        self._set_qc_files_directory(new_dir)
-        if self._is_locked():
-            self._highlight_button(self.button_run_bokeh_server)
+        file_paths = qc.get_standard_format_files(self.stringvars['standard_files_dir'].get())
+        if not file_paths:
+            messagebox.showinfo('Automatisk QC', 'Inga standardformatfiler att kontrollera')
+            return
+        profiler = self._get_profiler()
+        cast_journal = self._open_journal(profiler.run_id)
+        resume = self._ask_resume(cast_journal, profiling.STAGE_AUTOMATIC_QC, file_paths, 'Automatisk QC')
+        if resume is None:
+            cast_journal.close()
+            return
+        kwargs = dict(working_directory=self.stringvars['working_dir'].get(),
+                      qc_directory=self.stringvars['qc_dir'].get() or None,
+                      overwrite=self.booleanvar_allow_overwrite.get(),
+                      nr_workers=int(self.combobox_nr_workers.get()),
+                      incremental=self.booleanvar_incremental_qc.get(),
+                      logger=self.logger,
+                      profiler=profiler,
+                      journal=cast_journal,
+                      resume=resume)
+
+        def target(job):
+            def progress(nr_done, nr_total, result):
+                job.report_progress(nr_done, nr_total, f'{nr_done}/{nr_total} {Path(result.file_path).name}')
+            job.report_progress(text='Söker ändrade kast')
+            try:
+                with profiler.measure(profiling.STAGE_AUTOMATIC_QC, nr_files=len(file_paths)):
+                    return qc.run_automatic_qc(file_paths,
+                                               progress_callback=progress,
+                                               cancel_event=job.cancel_event,
+                                               **kwargs)
+            finally:
+                cast_journal.close()
+
+        def on_parallel_done(result):
+            qc_directory, results = result
+            failed = [res for res in results if not res.ok]
+            if not results:
+                messagebox.showinfo('Automatisk QC', 'Alla kast är redan kontrollerade med samma inställningar')
+            if qc_directory:
+                on_done(qc_directory)
+            else:
+                self._restore_buttons(self.button_run_automatic_qc)
+            if failed:
+                messagebox.showwarning('Automatisk QC', batch.get_summary(results))
+
+        self._start_job(target,
+                        title='Automatisk QC',
+                        on_done=on_parallel_done,
+                        button=self.button_run_automatic_qc)
 
     def _callback_run_bokeh_server(self):
-        try:
-            self.svea_controller.bokeh_visualize_setting = self.combobox_vis.get_value()
-            # server_directory
-            server_directory = Path(Path(__file__).parent.parent, 'bokeh_server')
-
-            self.svea_controller.open_visual_qc(server_file_directory=server_directory,
-                                                venv_path=self.stringvars['bokeh_venv_path'].get(), 
-                                                shark_package_root=self.stringvars['shark_package_root'].get()
-                                                # month_list=[4, 5, 6],
-                                                )
-        except Exception:
-            messagebox.showerror('Internal error', traceback.format_exc())
-            self.logger.error(traceback.format_exc())
+        if not self.stringvars['qc_dir'].get():
+            messagebox.showinfo('Visuell granskning', 'Ingen mapp med QC-filer är vald')
+            return
+        level_name = self.combobox_visual_qc_level.get()
+        if self.VISUAL_QC_LEVELS.get(level_name) and not messagebox.askokcancel(
+                'Visuell granskning',
+                f'"{level_name}" visar nedsamplade, skrivskyddade kopior av QC-filerna. '
+                f'QC-flaggor kan inte sparas på den här nivån.\n\n'
+                f'Välj "{list(self.VISUAL_QC_LEVELS)[0]}" för att flagga. Fortsätta ändå?'):
             return
+        server_directory = Path(Path(__file__).parent.parent, 'bokeh_server')
+        qc_directory = self.stringvars['qc_dir'].get()
+        level = self.VISUAL_QC_LEVELS.get(level_name)
+        server = visual_qc.get_server(logger=self.logger)
+        profiler = self._get_profiler()
+
+        def target(job):
+            # Creating a decimated level reads and writes every standard format file
+            job.report_progress(text=level_name)
+            with profiler.measure(profiling.STAGE_VISUAL_QC) as record:
+                record['nr_files'] = len(qc.get_standard_format_files(qc_directory))
+                directory = server.get_directory(qc_directory, level)
+            # Do not open the server after a cancel
+            job.check_cancelled()
+            return directory
+
+        def on_done(directory):
+            self._restore_buttons(self.button_run_bokeh_server)
+            try:
+                with profiler.measure(f'{profiling.STAGE_VISUAL_QC}.open'):
+                    started = server.open(lambda: batch.create_svea_controller(logger=self.logger),
+                                          directory,
+                                          server_file_directory=server_directory,
+                                          venv_path=self.stringvars['bokeh_venv_path'].get(),
+                                          shark_package_root=self.stringvars['shark_package_root'].get(),
+                                          visualize_setting=self.combobox_vis.get_value(),
+                                          # month_list=[4, 5, 6],
+                                          )
+            except Exception:
+                messagebox.showerror('Internal error', traceback.format_exc())
+                self.logger.error(traceback.format_exc())
+                return
+            finally:
+                self._update_run_log_summary()
+            if not started:
+                messagebox.showinfo('Visuell granskning', 'Servern är redan igång och data är uppdaterad. '
+                                                          'Öppna en ny flik eller ladda om sidan i webbläsaren.')
+
+        self._start_job(target,
+                        title='Visuell granskning',
+                        on_done=on_done,
+                        button=self.button_run_bokeh_server)
+
+    def _callback_restart_bokeh_server(self):
+        visual_qc.get_server(logger=self.logger).close()
+        self._callback_run_bokeh_server()
 
     def update_page(self):
-        self.user = self.user_manager.user
-        self._load_user_setting()
-        self._update_frame_seb_processing()
-
-        self._update_svea_paths()
-
-        self._toggle_overwrite()
-        self._toggle_unlock_selections()
+        """
+        Called each time the page is shown. Only the parts whose inputs have changed since the last call are
+        updated: settings are reloaded when the user has changed, and raw files, svea paths, overwrite
+        permission and lock state are applied when their values differ from the last snapshot.
+        Nothing is saved from here.
+        """
+        user = self.user_manager.user
+        if user is not self.user or not self._page_state:
+            self.user = user
+            self._load_user_setting()
+
+        state = self._get_page_state()
+        changed = set(key for key, value in state.items() if self._page_state.get(key) != value)
+        if 'raw_files_dir' in changed:
+            self._update_frame_seb_processing()
+        if changed & set(self.set_svea_paths):
+            self._update_svea_paths()
+        if 'overwrite' in changed:
+            self._apply_overwrite()
+        if 'unlock_selections' in changed:
+            self._apply_unlock_selections()
+        self._page_state = self._get_page_state()
+
+    def _get_page_state(self):
+        state = {key: self.stringvars[key].get() for key in self.set_svea_paths}
+        state['overwrite'] = self.booleanvar_allow_overwrite.get()
+        state['unlock_selections'] = self.booleanvar_unlock_selections.get()
+        return state
 
     def _raw_files_are_present(self):
-        if 'btl' in self.stringvars['raw_files_dir_info'].get():
-            return True
-        return False
+        return any(cast.is_complete for cast in RAW_SCANNER.scan(self.stringvars['raw_files_dir'].get(),
+                                                                 index=self._get_cast_index()))
 
 
 def get_directory_info(directory):
+    """
+    Returns a summary of the content in directory. The summary is cached and only rebuilt when the
+    modification time of the directory has changed.
+    """
     if not directory:
         return ''
-    directory = Path(directory)
-    if not directory.exists():
-        return ''
-    content = {}
-    for file_name in os.listdir(directory):
-        file_path = Path(directory, file_name)
-        if file_path.is_dir():
-            content.setdefault('dirs', 0)
-            content['dirs'] += 1
-        else:
-            suffix = file_path.suffix
-            content.setdefault(suffix, 0)
-            content[suffix] += 1
-
-    return_list = []
-    for key, value in content.items():
-        string = f'{value} ({key})'
-        return_list.append(string)
-    return ' - '.join(return_list)
+    return DIRECTORY_CACHE.get_summary(directory)
 
 
 def get_sub_directory(directory, new=False):
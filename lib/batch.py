@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+import logging
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from . import profiling
+
+# Maps the path keys used in the gui to the corresponding setter in SveaController
+PATH_SETTERS = {'working_dir': 'set_path_working_directory',
+                'raw_files_dir': 'set_path_raw_files',
+                'cnv_files_dir': 'set_path_cnv_files',
+                'standard_files_dir': 'set_path_standard_format_files',
+                'qc_dir': 'set_path_standard_format_files_qc'}
+
+
+def get_default_nr_workers():
+    return max(1, (os.cpu_count() or 2) - 1)
+
+
+class BatchResult:
+    """
+    Outcome of processing one file in a batch.
+    """
+    def __init__(self, file_path, ok=True, message='', dirs=None, profile=None):
+        self.file_path = str(file_path)
+        self.ok = ok
+        self.message = message
+        self.dirs = dirs or {}
+        self.profile = profile
+
+    def __repr__(self):
+        status = 'ok' if self.ok else 'failed'
+        return f'BatchResult({Path(self.file_path).name}: {status})'
+
+
+def create_svea_controller(paths=None, overwrite=False, logger=None):
+    """
+    Creates a SveaController with the given paths set. Used in worker processes where
+    the controller of the gui is not available.
+    """
+    from svea import SveaController
+    controller = SveaController(logger=logger or logging.getLogger(__name__))
+    controller.set_overwrite_permission(overwrite)
+    for key, path in (paths or {}).items():
+        if key not in PATH_SETTERS:
+            continue
+        if key == 'working_dir':
+            controller.working_directory = path
+        getattr(controller, PATH_SETTERS[key])(path or None)
+    return controller
+
+
+def _sbe_process_file(file_path, paths, overwrite, options):
+    """
+    Worker function. Processes one raw file in its own SveaController.
+    Exceptions are caught here so that one bad cast does not abort the rest of the batch.
+    The measurement of the cast is returned in BatchResult.profile.
+    """
+    with profiling.measure(profiling.STAGE_SBE_PROCESSING, cast=Path(file_path).stem, nr_files=1) as record:
+        result = _run_sbe_processing(file_path, paths, overwrite, options)
+        record['ok'] = result.ok
+    result.profile = record
+    return result
+
+
+def _run_sbe_processing(file_path, paths, overwrite, options):
+    from ctd_processing import exceptions as ctd_exceptions
+    try:
+        controller = create_svea_controller(paths=paths, overwrite=overwrite)
+        controller.sbe_processing(file_path, **options)
+        return BatchResult(file_path, dirs=dict(controller.dirs))
+    except ctd_exceptions.FileExists as e:
+        return BatchResult(file_path, ok=False, message=f'Har inte tillstånd att skriva över fil: {e}')
+    except Exception:
+        return BatchResult(file_path, ok=False, message=traceback.format_exc())
+
+
+def sbe_process_files(file_paths, paths=None, overwrite=False, options=None, nr_workers=None, logger=None,
+                      progress_callback=None, cancel_event=None, profiler=None, journal=None, resume=False):
+    """
+    Runs SBE processing for all given raw files in a process pool.
+
+    :param file_paths: list of paths to .hdr files
+    :param paths: dict with paths to set in each SveaController. Keys as in PATH_SETTERS
+    :param overwrite: overwrite permission passed to each SveaController
+    :param options: options passed on to SveaController.sbe_processing
+    :param nr_workers: number of worker processes. Defaults to one less than the number of cpus
+    :param progress_callback: called with (nr_done, nr_total, result) each time a file is finished
+    :param cancel_event: threading.Event. When set, files not yet started are skipped
+    :param profiler: profiling.Profiler that the measurement of each file is added to
+    :param journal: journal.Journal where the state of each cast is recorded. Casts that are running
+                    elsewhere are skipped
+    :param resume: skip casts that are already done according to journal
+    :return: list of BatchResult in the same order as file_paths. Skipped files are not included
+    """
+    logger = logger or logging.getLogger(__name__)
+    options = options or {}
+    if journal:
+        journal.add(profiling.STAGE_SBE_PROCESSING, file_paths)
+        file_paths = [path for path in file_paths
+                      if journal.claim(profiling.STAGE_SBE_PROCESSING, path, redo=not resume)]
+        if not file_paths:
+            return []
+    nr_workers = min(nr_workers or get_default_nr_workers(), len(file_paths)) or 1
+    results = {}
+    logger.info(f'Starting SBE processing of {len(file_paths)} files using {nr_workers} workers')
+    with ProcessPoolExecutor(max_workers=nr_workers) as executor:
+        futures = {executor.submit(_sbe_process_file, str(path), paths, overwrite, options): str(path)
+                   for path in file_paths}
+        for future in as_completed(futures):
+            file_path = futures[future]
+            if future.cancelled():
+                continue
+            try:
+                result = future.result()
+            except Exception:
+                # Worker process died (e.g. BrokenProcessPool)
+                result = BatchResult(file_path, ok=False, message=traceback.format_exc())
+            if result.ok:
+                logger.info(f'SBE processing done: {file_path}')
+            else:
+                logger.error(f'SBE processing failed: {file_path}\n{result.message}')
+            if profiler:
+                profiler.add(result.profile)
+            if journal and result.ok:
+                journal.mark_done(profiling.STAGE_SBE_PROCESSING, [file_path])
+            elif journal:
+                journal.mark_failed(profiling.STAGE_SBE_PROCESSING, [file_path], result.message)
+            results[file_path] = result
+            if progress_callback:
+                progress_callback(len(results), len(file_paths), result)
+            if cancel_event and cancel_event.is_set():
+                for fut in futures:
+                    fut.cancel()
+    if journal:
+        journal.release(profiling.STAGE_SBE_PROCESSING, [path for path in file_paths if str(path) not in results])
+    return [results[str(path)] for path in file_paths if str(path) in results]
+
+
+def get_summary(results):
+    """
+    Returns a short text summary of a list of BatchResult.
+    """
+    nr_ok = len([res for res in results if res.ok])
+    lines = [f'{nr_ok} av {len(results)} filer processerade.']
+    failed = [res for res in results if not res.ok]
+    if failed:
+        lines.append('')
+        lines.append('Misslyckades:')
+        for res in failed:
+            last_line = (res.message.strip().splitlines() or [''])[-1]
+            lines.append(f'{Path(res.file_path).name}: {last_line}')
+    return '\n'.join(lines)
@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+"""
+Benchmarks of the non gui processing paths on synthetic cruises. A cruise of the given size is generated
+(cnv files and standard format files), each benchmark is run on it and throughput, latency per cast and
+memory are reported. Results are appended to a json lines file together with package versions, so that
+runs with different plugin, ctdpy or ctd_processing versions can be compared.
+
+    python -m lib.benchmark --sizes 10 100 1000 [--repeat 3] [--results benchmark_results.jsonl]
+    python -m lib.benchmark --compare [--results benchmark_results.jsonl]
+
+Benchmarks of the ctdpy metadata and standard format paths and of the automatic QC are skipped, with a
+message, when ctdpy or svea is not installed.
+"""
+import argparse
+import datetime
+import importlib
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+from . import cast_index
+from . import cnv
+from . import decimate
+from . import profiling
+from . import qc
+from . import reading
+
+DEFAULT_SIZES = [10, 100, 1000]
+DEFAULT_RESULTS_FILE_NAME = 'benchmark_results.jsonl'
+CRUISE_INFO_FILE_NAME = '.benchmark_cruise.json'
+VERSION_PACKAGES = ['numpy', 'ctdpy', 'ctd_processing', 'svea']
+
+CNV_PARAMETERS = [('prDM', 'Pressure, Digiquartz [db]'),
+                  ('depSM', 'Depth [salt water, m]'),
+                  ('t090C', 'Temperature [ITS-90, deg C]'),
+                  ('c0S/m', 'Conductivity [S/m]'),
+                  ('sal00', 'Salinity, Practical [PSU]'),
+                  ('flag', '0.000e+00')]
+
+STANDARD_FORMAT_COLUMNS = ['MYEAR', 'STATN', 'SDATE', 'STIME', 'LATIT', 'LONGI', 'PRES_CTD [dbar]', 'DEPH [m]',
+                           'TEMP_CTD [deg C]', 'Q_TEMP_CTD', 'SALT_CTD [psu]', 'Q_SALT_CTD']
+
+
+def _get_profile(rng, nr_scans):
+    pres = np.linspace(1, nr_scans / 10, nr_scans) + rng.normal(0, 0.01, nr_scans)
+    depth = pres * 0.99
+    temp = 15 * np.exp(-depth / 30) + 4 + rng.normal(0, 0.01, nr_scans)
+    salt = 7 + 28 / (1 + np.exp(-(depth - 50) / 5)) + rng.normal(0, 0.01, nr_scans)
+    cond = salt / 10 + temp / 20
+    return pres, depth, temp, cond, salt
+
+
+def write_cnv_file(file_path, rng, nr_scans, station, time_obj, lat, lon):
+    pres, depth, temp, cond, salt = _get_profile(rng, nr_scans)
+    data = np.column_stack([pres, depth, temp, cond, salt, np.zeros(nr_scans)])
+    lines = ['* Sea-Bird SBE 9 Data File:',
+             f'* FileName = {Path(file_path).name}',
+             f'* NMEA Latitude = {int(lat):02d} {(lat % 1) * 60:05.2f} N',
+             f'* NMEA Longitude = {int(lon):03d} {(lon % 1) * 60:05.2f} E',
+             f'* NMEA UTC (Time) = {time_obj.strftime("%b %d %Y %H:%M:%S")}',
+             f'** Station: {station}',
+             f'# nquan = {len(CNV_PARAMETERS)}',
+             f'# nvalues = {nr_scans}']
+    for i, (name, description) in enumerate(CNV_PARAMETERS):
+        lines.append(f'# name {i} = {name}: {description}')
+    for i in range(len(CNV_PARAMETERS)):
+        lines.append(f'# span {i} = {data[:, i].min():11.4f}, {data[:, i].max():11.4f}')
+    lines.append('# bad_flag = -9.990e-29')
+    lines.append('*END*')
+    with open(file_path, 'w', encoding='cp1252', newline='\n') as fid:
+        fid.write('\n'.join(lines) + '\n')
+        np.savetxt(fid, data, fmt='%11.4f', delimiter='')
+
+
+def write_standard_format_file(file_path, rng, nr_scans, station, time_obj, lat, lon):
+    pres, depth, temp, cond, salt = _get_profile(rng, nr_scans)
+    fixed = [time_obj.strftime('%Y'), station, time_obj.strftime('%Y-%m-%d'), time_obj.strftime('%H:%M'),
+             f'{lat:.4f}', f'{lon:.4f}']
+    with open(file_path, 'w', encoding='cp1252', newline='\n') as fid:
+        fid.write('//FORMAT=PROFILE\n//COMNT_DATA;synthetic benchmark data\n')
+        fid.write('\t'.join(STANDARD_FORMAT_COLUMNS) + '\n')
+        for i in range(nr_scans):
+            row = fixed + [f'{pres[i]:.3f}', f'{depth[i]:.3f}', f'{temp[i]:.4f}', '', f'{salt[i]:.4f}', '']
+            fid.write('\t'.join(row) + '\n')
+
+
+def generate_cruise(directory, nr_casts, nr_scans=2000, seed=0):
+    """
+    Generates a synthetic cruise with nr_casts cnv files in directory/cnv and standard format files in
+    directory/standard_format. An existing cruise generated with the same arguments is reused.
+    """
+    directory = Path(directory)
+    info = dict(nr_casts=nr_casts, nr_scans=nr_scans, seed=seed)
+    info_path = Path(directory, CRUISE_INFO_FILE_NAME)
+    if info_path.exists():
+        with open(info_path, encoding='utf-8') as fid:
+            if json.load(fid) == info:
+                return directory
+    if directory.exists():
+        shutil.rmtree(directory)
+    cnv_directory = Path(directory, 'cnv')
+    standard_format_directory = Path(directory, 'standard_format')
+    os.makedirs(cnv_directory)
+    os.makedirs(standard_format_directory)
+    rng = np.random.default_rng(seed)
+    start_time = datetime.datetime(2020, 2, 7, 8, 0)
+    for i in range(nr_casts):
+        serno = i + 1
+        time_obj = start_time + datetime.timedelta(hours=2 * i)
+        station = f'ST{i % 50:02d}'
+        lat = 55 + (i % 50) * 0.1
+        lon = 11 + (i % 50) * 0.1
+        date_str = time_obj.strftime('%Y%m%d')
+        write_cnv_file(Path(cnv_directory, f'SBE09_1387_{date_str}_{time_obj.strftime("%H%M")}_77SE_00_{serno:04d}.cnv'),
+                       rng, nr_scans, station, time_obj, lat, lon)
+        write_standard_format_file(Path(standard_format_directory, f'ctd_profile_{date_str}_77SE_{serno:04d}.txt'),
+                                   rng, nr_scans, station, time_obj, lat, lon)
+    with open(info_path, 'w', encoding='utf-8') as fid:
+        json.dump(info, fid)
+    return directory
+
+
+class Benchmark:
+    """
+    function(cruise_directory, work_directory) runs the benchmark once. setup is called before each run
+    with the same arguments and is not timed. stage is the sub directory of the cruise that is the input.
+    """
+    def __init__(self, name, function, setup=None, stage='cnv', requires=None):
+        self.name = name
+        self.function = function
+        self.setup = setup
+        self.stage = stage
+        self.requires = requires or []
+
+    def is_available(self):
+        for name in self.requires:
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                return False
+        return True
+
+
+def _get_files(cruise_directory, stage):
+    suffix = '.cnv' if stage == 'cnv' else '.txt'
+    return sorted(Path(cruise_directory, stage).glob(f'*{suffix}'))
+
+
+def _clear_work_directory(cruise_directory, work_directory):
+    shutil.rmtree(work_directory, ignore_errors=True)
+    os.makedirs(work_directory)
+
+
+def _warm_cast_cache(cruise_directory, work_directory):
+    reading.read_cnv_files(_get_files(cruise_directory, 'cnv'), cache_directory=work_directory)
+
+
+def _warm_cast_index(cruise_directory, work_directory):
+    _clear_work_directory(cruise_directory, work_directory)
+    _run_cast_index(cruise_directory, work_directory)
+
+
+def _run_cnv_read(cruise_directory, work_directory):
+    for path in _get_files(cruise_directory, 'cnv'):
+        cnv.read_cnv(path)
+
+
+def _run_cnv_iter_blocks(cruise_directory, work_directory):
+    for path in _get_files(cruise_directory, 'cnv'):
+        for block in cnv.iter_blocks(path, block_size=500):
+            float(np.nansum(block.data))
+
+
+def _run_cast_cache(cruise_directory, work_directory):
+    cnv_files = reading.read_cnv_files(_get_files(cruise_directory, 'cnv'), cache_directory=work_directory)
+    # Touch the data so that memory mapped casts are actually read
+    for cnv_file in cnv_files.values():
+        float(np.nansum(cnv_file.data))
+
+
+def _run_cast_index(cruise_directory, work_directory):
+    index = cast_index.CastIndex(work_directory)
+    index.update({cast_index.STAGE_CNV: str(Path(cruise_directory, 'cnv')),
+                  cast_index.STAGE_STANDARD_FORMAT: str(Path(cruise_directory, 'standard_format'))})
+
+
+def _run_decimate(cruise_directory, work_directory):
+    decimate.create_level(_get_files(cruise_directory, 'standard_format'),
+                          Path(work_directory, 'overview'),
+                          decimate.LEVELS['overview'])
+
+
+def _run_ctdpy_read(cruise_directory, work_directory):
+    reading.read_sequential(_get_files(cruise_directory, 'cnv'))
+
+
+def _run_ctdpy_metadata(cruise_directory, work_directory):
+    from ctdpy.core import session as ctdpy_session
+    session = ctdpy_session.Session(filepaths=[str(path) for path in _get_files(cruise_directory, 'cnv')],
+                                    reader='smhi')
+    datasets = session.read()
+    # ctdpy appends its folder name directly to the export path, so it must end with a separator
+    session.save_data(datasets[0],
+                      writer='metadata_template',
+                      save_path=f'{Path(work_directory, "metadata")}{os.sep}')
+
+
+def _create_metadata_file(cruise_directory, work_directory):
+    _clear_work_directory(cruise_directory, work_directory)
+    _run_ctdpy_metadata(cruise_directory, work_directory)
+
+
+def _run_ctdpy_standard_format(cruise_directory, work_directory):
+    from ctdpy.core import session as ctdpy_session
+    file_paths = _get_files(cruise_directory, 'cnv') + sorted(Path(work_directory, 'metadata').rglob('*.xlsx'))
+    session = ctdpy_session.Session(filepaths=[str(path) for path in file_paths], reader='smhi')
+    datasets = session.read()
+    session.save_data(datasets,
+                      writer='ctd_standard_template',
+                      save_path=f'{Path(work_directory, "standard_format")}{os.sep}')
+
+
+def _run_automatic_qc(cruise_directory, work_directory):
+    qc.run_automatic_qc(_get_files(cruise_directory, 'standard_format'),
+                        working_directory=work_directory,
+                        qc_directory=str(Path(work_directory, 'qc')),
+                        overwrite=True,
+                        incremental=False)
+
+
+BENCHMARKS = [Benchmark('cnv_read', _run_cnv_read),
+              Benchmark('cnv_iter_blocks', _run_cnv_iter_blocks),
+              Benchmark('cast_cache_cold', _run_cast_cache, setup=_clear_work_directory),
+              Benchmark('cast_cache_warm', _run_cast_cache, setup=_warm_cast_cache),
+              Benchmark('cast_index_cold', _run_cast_index, setup=_clear_work_directory),
+              Benchmark('cast_index_warm', _run_cast_index, setup=_warm_cast_index),
+              Benchmark('decimate', _run_decimate, setup=_clear_work_directory, stage='standard_format'),
+              Benchmark('ctdpy_read', _run_ctdpy_read, requires=['ctdpy']),
+              Benchmark('ctdpy_metadata', _run_ctdpy_metadata, setup=_clear_work_directory, requires=['ctdpy']),
+              Benchmark('ctdpy_standard_format', _run_ctdpy_standard_format, setup=_create_metadata_file,
+                        requires=['ctdpy']),
+              Benchmark('automatic_qc', _run_automatic_qc, setup=_clear_work_directory, stage='standard_format',
+                        requires=['svea'])]
+
+# Benchmarks whose required packages are missing are skipped with a message
+DEFAULT_BENCHMARKS = [bench.name for bench in BENCHMARKS]
+
+
+def get_versions():
+    versions = {}
+    for name in VERSION_PACKAGES:
+        try:
+            module = importlib.import_module(name)
+        except ImportError:
+            continue
+        versions[name] = getattr(module, '__version__', '')
+    return versions
+
+
+def get_git_revision():
+    head_path = Path(Path(__file__).parent.parent, '.git', 'HEAD')
+    try:
+        ref = head_path.read_text().strip()
+        if ref.startswith('ref:'):
+            return Path(head_path.parent, ref.split(' ', 1)[1]).read_text().strip()
+        return ref
+    except OSError:
+        return None
+
+
+def run_benchmark(benchmark, cruise_directory, work_directory, repeat=3):
+    """
+    Runs benchmark repeat times and returns a result dict. Times are the best of the runs. Memory is the
+    peak of python allocations (tracemalloc) in an extra run, and the process lifetime peak RSS (see
+    profiling.get_peak_rss), which includes the earlier benchmarks and cruise sizes of the run.
+    """
+    file_paths = _get_files(cruise_directory, benchmark.stage)
+    nr_casts = len(file_paths)
+    nr_bytes = sum(os.path.getsize(path) for path in file_paths)
+    records = []
+    for _ in range(repeat):
+        if benchmark.setup:
+            benchmark.setup(cruise_directory, work_directory)
+        with profiling.measure(benchmark.name, nr_files=nr_casts) as record:
+            benchmark.function(cruise_directory, work_directory)
+        records.append(record)
+
+    if benchmark.setup:
+        benchmark.setup(cruise_directory, work_directory)
+    tracemalloc.start()
+    try:
+        benchmark.function(cruise_directory, work_directory)
+        _, peak_alloc = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    best = min(records, key=lambda rec: rec['wall_time'])
+    wall_time = max(best['wall_time'], 1e-9)
+    return dict(benchmark=benchmark.name,
+                nr_casts=nr_casts,
+                nr_bytes=nr_bytes,
+                wall_time=best['wall_time'],
+                cpu_time=best['cpu_time'],
+                casts_per_second=nr_casts / wall_time,
+                mb_per_second=nr_bytes / 1e6 / wall_time,
+                ms_per_cast=1000 * wall_time / max(nr_casts, 1),
+                peak_alloc=peak_alloc,
+                peak_rss=max(rec['peak_rss'] or 0 for rec in records) or None,
+                repeat=repeat)
+
+
+def run_suite(sizes=None, names=None, repeat=3, nr_scans=2000, directory=None, logger=print):
+    """
+    Generates the cruises and runs the benchmarks. Returns a list of result dicts.
+    """
+    sizes = sizes or DEFAULT_SIZES
+    names = names or DEFAULT_BENCHMARKS
+    directory = Path(directory or Path(tempfile.gettempdir(), 'svea_ctd_benchmark'))
+    run_info = dict(time=datetime.datetime.now().isoformat(timespec='seconds'),
+                    revision=get_git_revision(),
+                    versions=get_versions(),
+                    python=platform.python_version(),
+                    platform=platform.platform(),
+                    nr_scans=nr_scans)
+    results = []
+    for size in sizes:
+        start_time = time.perf_counter()
+        cruise_directory = generate_cruise(Path(directory, f'cruise_{size}'), size, nr_scans=nr_scans)
+        logger(f'Cruise with {size} casts ready in {time.perf_counter() - start_time:.1f} s: {cruise_directory}')
+        work_directory = Path(directory, f'work_{size}')
+        for benchmark in BENCHMARKS:
+            if benchmark.name not in names:
+                continue
+            if not benchmark.is_available():
+                logger(f'{benchmark.name}: skipped, requires {", ".join(benchmark.requires)}')
+                continue
+            try:
+                result = run_benchmark(benchmark, cruise_directory, work_directory, repeat=repeat)
+            except Exception as e:
+                logger(f'{benchmark.name}: failed: {e}')
+                continue
+            result.update(run_info)
+            results.append(result)
+            logger(format_result(result))
+        shutil.rmtree(work_directory, ignore_errors=True)
+    return results
+
+
+def save_results(results, file_path):
+    with open(file_path, 'a', encoding='utf-8') as fid:
+        for result in results:
+            fid.write(json.dumps(result) + '\n')
+
+
+def load_results(file_path):
+    if not Path(file_path).exists():
+        return []
+    with open(file_path, encoding='utf-8') as fid:
+        return [json.loads(line) for line in fid if line.strip()]
+
+
+def format_result(result):
+    peak_alloc = result['peak_alloc'] / 1e6
+    return (f'{result["benchmark"]:>16} {result["nr_casts"]:6d} casts: {result["wall_time"]:8.3f} s  '
+            f'{result["casts_per_second"]:8.1f} casts/s  {result["ms_per_cast"]:8.2f} ms/cast  '
+            f'{result["mb_per_second"]:7.1f} MB/s  {peak_alloc:7.1f} MB alloc')
+
+
+def compare_results(results, threshold=0.1):
+    """
+    Compares the last two runs of each benchmark and cruise size. Returns text lines, changes larger than
+    threshold (relative) are marked.
+    """
+    latest = {}
+    for result in results:
+        key = (result['benchmark'], result['nr_casts'])
+        latest.setdefault(key, []).append(result)
+    lines = []
+    for (name, nr_casts), runs in sorted(latest.items()):
+        if len(runs) < 2:
+            continue
+        previous, current = runs[-2], runs[-1]
+        ratio = current['wall_time'] / max(previous['wall_time'], 1e-9)
+        mark = ''
+        if ratio > 1 + threshold:
+            mark = '  SLOWER'
+        elif ratio < 1 - threshold:
+            mark = '  faster'
+        lines.append(f'{name:>16} {nr_casts:6d} casts: {previous["wall_time"]:8.3f} s -> '
+                     f'{current["wall_time"]:8.3f} s ({ratio:5.2f}x){mark}')
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Svea CTD processing paths on synthetic cruises')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Number of casts per cruise')
+    parser.add_argument('--benchmarks', nargs='+', choices=[bench.name for bench in BENCHMARKS],
+                        help='Benchmarks to run')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--scans', type=int, default=2000, help='Number of scans per cast')
+    parser.add_argument('--directory', help='Directory for the synthetic cruises')
+    parser.add_argument('--results', default=DEFAULT_RESULTS_FILE_NAME, help='Json lines file for the results')
+    parser.add_argument('--compare', action='store_true', help='Only compare the last two runs in the results file')
+    args = parser.parse_args(argv)
+
+    if not args.compare:
+        names = args.benchmarks or DEFAULT_BENCHMARKS
+        results = run_suite(sizes=args.sizes,
+                            names=names,
+                            repeat=args.repeat,
+                            nr_scans=args.scans,
+                            directory=args.directory)
+        save_results(results, args.results)
+    lines = compare_results(load_results(args.results))
+    if lines:
+        print('Compared to previous run:')
+        print('\n'.join(lines))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+"""
+Compares the fast cnv reader in lib.cnv with the ctdpy smhi reader on a directory of cnv files.
+
+    python -m lib.benchmark_cnv <directory with cnv files> [--repeat 3]
+"""
+import argparse
+import os
+import time
+from pathlib import Path
+
+from . import cnv
+from . import reading
+
+
+def time_function(function, repeat=1):
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+
+def run_benchmark(directory, repeat=1, include_ctdpy=True):
+    """
+    Returns a dict with the best time in seconds for each reader.
+    """
+    file_paths = sorted(Path(directory).glob('*.cnv'))
+    nr_bytes = sum(os.path.getsize(path) for path in file_paths)
+    result = dict(nr_files=len(file_paths), nr_bytes=nr_bytes)
+    result['fast'] = time_function(lambda: [cnv.read_cnv(path) for path in file_paths], repeat=repeat)
+    if include_ctdpy:
+        result['ctdpy'] = time_function(lambda: reading.read_sequential(file_paths), repeat=repeat)
+    return result
+
+
+def format_result(result):
+    lines = [f'{result["nr_files"]} files, {result["nr_bytes"] / 1e6:.1f} MB']
+    for reader in ['ctdpy', 'fast']:
+        if reader not in result:
+            continue
+        seconds = result[reader]
+        lines.append(f'{reader:>6}: {seconds:8.3f} s  {result["nr_bytes"] / 1e6 / seconds:8.1f} MB/s  '
+                     f'{1000 * seconds / max(result["nr_files"], 1):8.1f} ms/file')
+    if 'ctdpy' in result:
+        lines.append(f'speedup: {result["ctdpy"] / result["fast"]:.1f}x')
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark cnv readers')
+    parser.add_argument('directory')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-ctdpy', action='store_true', help='Only time the fast reader')
+    args = parser.parse_args(argv)
+    print(format_result(run_benchmark(args.directory, repeat=args.repeat, include_ctdpy=not args.no_ctdpy)))
+
+
+if __name__ == '__main__':
+    main()
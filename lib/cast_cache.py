@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+"""
+Binary cache of parsed casts in a hidden directory in the working directory. Entries are named after the
+content hash of the source file, so a copy of a file (e.g. a cnv file copied into the working directory)
+is found in the cache as well. Two kinds of entries are kept:
+
+- datasets read by ctdpy. The entry of each cnv file in Session.read() is stored per file, reader and
+  ctdpy version (see lib.reading.read_datasets_cached): the data frames and series as columns in a .npz file
+  and everything else as json. Entries that can not be stored exactly that way are not cached. This is what
+  the metadata and standard format steps of the advanced page load instead of parsing the text files again.
+- casts parsed by the fast reader in lib.cnv, stored as a .npy file (the data array, loaded memory mapped)
+  and a .json file (header).
+
+Nothing in the cache is unpickled, the arrays are loaded with allow_pickle=False. The manifest with the hash
+and path of each source file is loaded once per CastCache and written once per batch by the process owning
+the CastCache, after entries of source files that are gone or changed have been pruned. Worker processes
+only write entry files, whose names are unique.
+"""
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from . import cnv
+from .manifest import FileManifest, write_json_atomic
+
+CACHE_DIRECTORY_NAME = '.cast_cache'
+DATASET_SUFFIX = '.npz'
+ENTRY_SUFFIXES = ['.npy', '.json', DATASET_SUFFIX]
+
+
+def _get_tmp_path(path):
+    path = Path(path)
+    return Path(path.parent, f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+
+
+def get_ctdpy_version():
+    try:
+        import ctdpy
+    except ImportError:
+        return None
+    return getattr(ctdpy, '__version__', '')
+
+
+class NotCacheable(Exception):
+    pass
+
+
+def _get_array(series):
+    """
+    Returns the values of a pandas Series as an array that can be saved without pickle.
+    """
+    import pandas as pd
+    if series.dtype == object or pd.api.types.is_string_dtype(series.dtype):
+        if not all(isinstance(value, str) for value in series):
+            raise NotCacheable(f'Column {series.name} holds values that are not strings')
+        return np.array(list(series), dtype=str)
+    array = series.to_numpy()
+    if array.dtype.hasobject:
+        raise NotCacheable(f'Column {series.name} can not be stored as an array')
+    return array
+
+
+def _get_series(array, dtype):
+    import pandas as pd
+    if dtype == 'object':
+        return pd.Series(array, dtype=object)
+    return pd.Series(array).astype(dtype)
+
+
+def _check_index(value):
+    import pandas as pd
+    if not isinstance(value.index, pd.RangeIndex) or value.index.start != 0 or value.index.step != 1:
+        raise NotCacheable('Only data with a default index is cached')
+
+
+def encode_entry(entry):
+    """
+    Splits a dataset entry (dict) in arrays and a json description. Data frames and series are stored as one
+    array per column, other values as json. Raises NotCacheable for values that can not be stored that way.
+
+    :return: (description, dict of arrays)
+    """
+    import pandas as pd
+    if not isinstance(entry, dict) or not all(isinstance(key, str) for key in entry):
+        raise NotCacheable('Only dicts with string keys are cached')
+    description = {}
+    arrays = {}
+    for key, value in entry.items():
+        if isinstance(value, pd.DataFrame):
+            _check_index(value)
+            columns = list(value.columns)
+            if not all(isinstance(column, str) for column in columns):
+                raise NotCacheable('Only data frames with string column names are cached')
+            for i in range(len(columns)):
+                arrays[f'{key}.{i}'] = _get_array(value.iloc[:, i])
+            description[key] = dict(type='dataframe', columns=columns,
+                                    dtypes=[str(dtype) for dtype in value.dtypes])
+        elif isinstance(value, pd.Series):
+            _check_index(value)
+            if value.name is not None and not isinstance(value.name, str):
+                raise NotCacheable('Only series with a string name are cached')
+            arrays[key] = _get_array(value)
+            description[key] = dict(type='series', name=value.name, dtype=str(value.dtype))
+        else:
+            try:
+                is_json = json.loads(json.dumps(value)) == value
+            except (TypeError, ValueError):
+                is_json = False
+            if not is_json:
+                raise NotCacheable(f'{key} can not be stored as json')
+            description[key] = dict(type='json', value=value)
+    return description, arrays
+
+
+def decode_entry(description, arrays):
+    """
+    Rebuilds the dataset entry from the output of encode_entry.
+    """
+    import pandas as pd
+    entry = {}
+    for key, item in description.items():
+        if item['type'] == 'dataframe':
+            columns = [_get_series(arrays[f'{key}.{i}'], dtype) for i, dtype in enumerate(item['dtypes'])]
+            data = pd.concat(columns, axis=1) if columns else pd.DataFrame()
+            data.columns = item['columns']
+            entry[key] = data
+        elif item['type'] == 'series':
+            entry[key] = _get_series(arrays[key], item['dtype']).rename(item['name'])
+        else:
+            entry[key] = item['value']
+    return entry
+
+
+def _entries_are_equal(entry, other):
+    if entry.keys() != other.keys():
+        return False
+    for key, value in entry.items():
+        if hasattr(value, 'equals'):
+            if not (type(value) is type(other[key]) and value.equals(other[key])):
+                return False
+        elif value != other[key]:
+            return False
+    return True
+
+
+class _CnvWriter:
+    """
+    Picklable callable parsing one cnv file with the fast reader and writing its cache entry.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def __call__(self, file_path, file_hash):
+        cnv_file = cnv.read_cnv(file_path)
+        write_cnv_entry(self.directory, file_hash, cnv_file)
+        return cnv_file
+
+
+def write_cnv_entry(directory, file_hash, cnv_file):
+    data_path = Path(directory, f'{file_hash}.npy')
+    tmp_data_path = _get_tmp_path(data_path)
+    with open(tmp_data_path, 'wb') as fid:
+        np.save(fid, np.ascontiguousarray(cnv_file.data))
+    os.replace(tmp_data_path, data_path)
+    write_json_atomic(Path(directory, f'{file_hash}.json'), dict(names=cnv_file.names,
+                                                                descriptions=cnv_file.descriptions,
+                                                                bad_flag=cnv_file.bad_flag,
+                                                                metadata=cnv_file.metadata,
+                                                                header_lines=cnv_file.header_lines))
+
+
+class CastCache:
+
+    def __init__(self, working_directory):
+        self.directory = Path(working_directory, CACHE_DIRECTORY_NAME)
+        self.manifest = FileManifest(self.directory)
+        self._lock = threading.Lock()
+
+    def _create_directory(self):
+        if not self.directory.exists():
+            os.makedirs(self.directory, exist_ok=True)
+
+    def get_hash(self, file_path):
+        """
+        Returns the content hash of file_path. The hash in the cache manifest is used if size and mtime
+        of the file are unchanged. The manifest is only updated in memory, see save_manifest.
+        """
+        file_path = Path(file_path)
+        with self._lock:
+            if self.manifest.is_changed(file_path):
+                self.manifest.update([file_path], path=str(file_path))
+            return self.manifest.entries[file_path.name]['hash']
+
+    def save_manifest(self):
+        """
+        Prunes the cache and writes the manifest.
+        """
+        self._create_directory()
+        self.prune()
+        with self._lock:
+            self.manifest.save()
+
+    def get(self, file_path):
+        """
+        Returns the cached CnvFile for file_path or None if not in cache.
+        """
+        file_hash = self.get_hash(file_path)
+        data_path = Path(self.directory, f'{file_hash}.npy')
+        header_path = Path(self.directory, f'{file_hash}.json')
+        if not (data_path.exists() and header_path.exists()):
+            return None
+        try:
+            with open(header_path, encoding='utf-8') as fid:
+                header = json.load(fid)
+            data = np.load(data_path, mmap_mode='r')
+        except (ValueError, OSError):
+            return None
+        return cnv.CnvFile(file_path, header['header_lines'], data, header=header)
+
+    def load_cnv_files(self, file_paths, nr_workers=1):
+        """
+        Returns a dict with file stem as key and CnvFile as value. Casts not in the cache are parsed, in
+        nr_workers processes, and added to it. The manifest is written once when all casts are loaded.
+        """
+        file_paths = [str(path) for path in file_paths]
+        cnv_files = {path: self.get(path) for path in file_paths}
+        missing = [path for path, cnv_file in cnv_files.items() if cnv_file is None]
+        if missing:
+            self._create_directory()
+            writer = _CnvWriter(self.directory)
+            hashes = [self.get_hash(path) for path in missing]
+            if nr_workers <= 1 or len(missing) < 2:
+                parsed = [writer(path, file_hash) for path, file_hash in zip(missing, hashes)]
+            else:
+                with ProcessPoolExecutor(max_workers=nr_workers) as executor:
+                    parsed = list(executor.map(writer, missing, hashes, chunksize=4))
+            cnv_files.update(zip(missing, parsed))
+        self.save_manifest()
+        return {cnv_file.key: cnv_file for cnv_file in cnv_files.values()}
+
+    def load(self, file_path):
+        """
+        Returns the cast from the cache if valid, otherwise parses the cnv file and adds it to the cache.
+        """
+        return self.load_cnv_files([file_path])[Path(file_path).stem]
+
+    def _get_dataset_path(self, file_path, reader, dataset):
+        key = json.dumps([reader, dataset, get_ctdpy_version()])
+        key_hash = hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+        return Path(self.directory, f'{self.get_hash(file_path)}_{key_hash}{DATASET_SUFFIX}')
+
+    def get_dataset_entry(self, file_path, reader, dataset):
+        """
+        Returns the cached ctdpy entry of file_path in dataset (e.g. 'cnv') read with reader, or None.
+        """
+        data_path = self._get_dataset_path(file_path, reader, dataset)
+        header_path = data_path.with_suffix('.json')
+        if not (data_path.exists() and header_path.exists()):
+            return None
+        try:
+            with open(header_path, encoding='utf-8') as fid:
+                description = json.load(fid)
+            with np.load(data_path, allow_pickle=False) as arrays:
+                return decode_entry(description, arrays)
+        except (ValueError, KeyError, TypeError, OSError):
+            return None
+
+    def put_dataset_entry(self, file_path, reader, dataset, entry):
+        """
+        Adds the ctdpy entry of file_path to the cache. Returns False if the entry can not be stored exactly
+        (see encode_entry).
+        """
+        try:
+            description, arrays = encode_entry(entry)
+            if not _entries_are_equal(entry, decode_entry(description, arrays)):
+                return False
+        except NotCacheable:
+            return False
+        self._create_directory()
+        data_path = self._get_dataset_path(file_path, reader, dataset)
+        tmp_path = _get_tmp_path(data_path)
+        with open(tmp_path, 'wb') as fid:
+            np.savez(fid, **arrays)
+        os.replace(tmp_path, data_path)
+        # The json file is written last, an entry is only valid when it exists
+        write_json_atomic(data_path.with_suffix('.json'), description)
+        return True
+
+    def prune(self):
+        """
+        Removes the manifest entries of source files that are gone or have changed and the cached entries
+        whose source file is not in the manifest.
+        """
+        with self._lock:
+            for file_name, entry in list(self.manifest.entries.items()):
+                path = entry.get('path')
+                if not path or not Path(path).exists() or self.manifest.is_changed(path):
+                    self.manifest.entries.pop(file_name)
+            valid_hashes = set(entry['hash'] for entry in self.manifest.entries.values())
+        if not self.directory.exists():
+            return
+        for path in self.directory.iterdir():
+            if path.suffix not in ENTRY_SUFFIXES or path.name.startswith('.'):
+                continue
+            if path.stem.split('_')[0] not in valid_hashes:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+"""
+On disk index over the casts in a working directory. For each cast the index holds station, time,
+position, depth range and the file of each processing stage. Files are only read again when their size
+or mtime has changed, so keeping the index up to date costs one directory listing per stage.
+"""
+import datetime
+import json
+import os
+import re
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from . import cnv
+from . import decimate
+from .manifest import write_json_atomic
+
+INDEX_FILE_NAME = '.cast_index.json'
+
+STAGE_RAW = 'raw'
+STAGE_CNV = 'cnv'
+STAGE_STANDARD_FORMAT = 'standard_format'
+STAGE_QC = 'qc'
+
+STAGES = [STAGE_RAW, STAGE_CNV, STAGE_STANDARD_FORMAT, STAGE_QC]
+
+STAGE_SUFFIXES = {STAGE_RAW: '.hdr',
+                  STAGE_CNV: '.cnv',
+                  STAGE_STANDARD_FORMAT: '.txt',
+                  STAGE_QC: '.txt'}
+
+_span_pattern = re.compile(r'^# span (\d+) = ([^,]+),(.+)$')
+_date_pattern = re.compile(r'^\d{8}$')
+_ship_pattern = re.compile(r'^\d{2}[A-Z]{2}$')
+_serno_pattern = re.compile(r'^\d{4}$')
+
+SEABIRD_TIME_KEYS = ['NMEA UTC (Time)', 'System UTC', 'System UpLoad Time']
+SEABIRD_DEPTH_PREFIXES = ['depSM', 'depFM', 'prDM', 'prSM']
+SEABIRD_SERIAL_KEYS = ['Serial Number', 'SerialNumber', 'Temperature SN']
+STANDARD_FORMAT_COLUMNS = dict(station=['STATN'],
+                               date=['SDATE'],
+                               time=['STIME'],
+                               lat=['LATIT'],
+                               lon=['LONGI'])
+
+
+def get_cast_id(file_path):
+    """
+    Returns an id that is the same for the files of a cast in all processing stages, built from date, ship
+    and series number in the file name (e.g. SBE09_1387_20200207_0801_77SE_00_0120.hdr and
+    ctd_profile_20200207_77SE_0120.txt both give 20200207_77SE_0120). Falls back to the file stem.
+    """
+    parts = Path(file_path).stem.split('_')
+    date = next((part for part in parts if _date_pattern.match(part)), None)
+    ship = next((part for part in parts if _ship_pattern.match(part)), None)
+    serno = next((part for part in reversed(parts) if _serno_pattern.match(part)), None)
+    if not (date and ship and serno):
+        return Path(file_path).stem
+    return f'{date}_{ship}_{serno}'
+
+
+def parse_position(value):
+    """
+    Converts a Seabird NMEA position like "58 15.02 N" to decimal degrees.
+    """
+    parts = value.split()
+    try:
+        degrees = float(parts[0]) + float(parts[1]) / 60
+    except (IndexError, ValueError):
+        return None
+    if parts[-1].upper() in ['S', 'W']:
+        degrees = -degrees
+    return round(degrees, 6)
+
+
+def parse_time(value):
+    try:
+        return datetime.datetime.strptime(value[:20], '%b %d %Y %H:%M:%S').isoformat()
+    except ValueError:
+        return None
+
+
+def get_serial_number(file_path, metadata):
+    serial = next((metadata[key] for key in SEABIRD_SERIAL_KEYS if metadata.get(key)), None)
+    if not serial:
+        # File names like SBE09_1387_20200207_0801_77SE_00_0120 hold the serial number as second part
+        parts = Path(file_path).stem.split('_')
+        if len(parts) > 1 and parts[1].isdigit():
+            serial = parts[1]
+    return serial
+
+
+def read_seabird_info(file_path):
+    """
+    Reads station, time, instrument serial number, position and depth range from the header of a .hdr or
+    .cnv file.
+    """
+    header_lines = cnv.read_header(file_path)
+    header = cnv.parse_header(header_lines)
+    metadata = header['metadata']
+    info = dict(station=metadata.get('Station'),
+                time=next((parse_time(metadata[key]) for key in SEABIRD_TIME_KEYS if key in metadata), None),
+                serial=get_serial_number(file_path, metadata),
+                lat=parse_position(metadata['NMEA Latitude']) if 'NMEA Latitude' in metadata else None,
+                lon=parse_position(metadata['NMEA Longitude']) if 'NMEA Longitude' in metadata else None)
+    spans = {}
+    for line in header_lines:
+        match = _span_pattern.match(line.strip())
+        if match:
+            spans[int(match.group(1))] = (match.group(2), match.group(3))
+    for prefix in SEABIRD_DEPTH_PREFIXES:
+        index = next((i for i, name in enumerate(header['names']) if name.startswith(prefix)), None)
+        if index is None:
+            continue
+        if index in spans:
+            try:
+                info['depth_min'], info['depth_max'] = [float(value) for value in spans[index]]
+            except ValueError:
+                pass
+        elif Path(file_path).suffix.lower() == '.cnv':
+            info['depth_min'], info['depth_max'] = read_cnv_range(file_path, index)
+        break
+    return info
+
+
+def read_cnv_range(file_path, column_index):
+    """
+    Returns min and max (None if there is no valid value) of a column in the data of a cnv file. Used
+    when the header has no span for the column. The file is read in blocks with the fast reader, so memory use
+    does not depend on the length of the cast.
+    """
+    minimum = maximum = None
+    for block in cnv.iter_blocks(file_path):
+        values = block.data[:, column_index]
+        values = values[~np.isnan(values)]
+        if not values.size:
+            continue
+        block_min, block_max = float(values.min()), float(values.max())
+        minimum = block_min if minimum is None else min(minimum, block_min)
+        maximum = block_max if maximum is None else max(maximum, block_max)
+    return minimum, maximum
+
+
+def read_standard_format_info(file_path, encoding='cp1252'):
+    """
+    Reads station, time, position and depth range from the data of a standard format file. Only the first
+    data row is split in all columns, for the other rows only the depth (or pressure) column is parsed.
+    """
+    columns = None
+    first_row = None
+    depth_index = None
+    depth_min = depth_max = None
+    with open(file_path, encoding=encoding) as fid:
+        for line in fid:
+            if line.startswith(decimate.METADATA_PREFIX):
+                continue
+            if columns is None:
+                columns = decimate.StandardFormatFile([], line.rstrip('\r\n').split('\t'), [])
+                depth_index = columns.get_column_index(decimate.DEPTH_PREFIXES)
+                continue
+            if not line.strip():
+                continue
+            if first_row is None:
+                first_row = line.rstrip('\r\n').split('\t')
+            if depth_index is None:
+                break
+            values = line.split('\t', depth_index + 1)
+            try:
+                depth = float(values[depth_index])
+            except (IndexError, ValueError):
+                continue
+            if depth != depth:
+                # nan
+                continue
+            depth_min = depth if depth_min is None else min(depth_min, depth)
+            depth_max = depth if depth_max is None else max(depth_max, depth)
+    info = {}
+    if first_row is None:
+        return info
+    values = {}
+    for key, prefixes in STANDARD_FORMAT_COLUMNS.items():
+        index = columns.get_column_index(prefixes)
+        if index is not None and index < len(first_row):
+            values[key] = first_row[index].strip()
+    info['station'] = values.get('station')
+    if values.get('date'):
+        info['time'] = f"{values['date']}T{values.get('time') or '00:00'}"
+    for key in ['lat', 'lon']:
+        try:
+            info[key] = float(values[key].replace(',', '.'))
+        except (KeyError, ValueError):
+            pass
+    if depth_min is not None:
+        info['depth_min'] = depth_min
+        info['depth_max'] = depth_max
+    return info
+
+
+STAGE_READERS = {STAGE_RAW: read_seabird_info,
+                 STAGE_CNV: read_seabird_info,
+                 STAGE_STANDARD_FORMAT: read_standard_format_info,
+                 STAGE_QC: read_standard_format_info}
+
+
+class CastIndex:
+    """
+    Index of casts in a working directory, saved as a hidden json file in the working directory.
+    If working_directory is None the index is only kept in memory.
+
+    Each entry is keyed on the cast id and looks like:
+        {'station': ..., 'time': ..., 'lat': ..., 'lon': ..., 'depth_min': ..., 'depth_max': ...,
+         'files': {stage: {'path': ..., 'size': ..., 'mtime': ...}}}
+    """
+    def __init__(self, working_directory=None):
+        self.working_directory = working_directory
+        self.entries = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    @property
+    def file_path(self):
+        if not self.working_directory:
+            return None
+        return Path(self.working_directory, INDEX_FILE_NAME)
+
+    def load(self):
+        self.entries = {}
+        if not self.file_path or not self.file_path.exists():
+            return
+        try:
+            with open(self.file_path, encoding='utf-8') as fid:
+                self.entries = json.load(fid)
+        except (ValueError, OSError):
+            self.entries = {}
+
+    def save(self):
+        if not self.file_path or not Path(self.working_directory).is_dir():
+            return
+        with self._lock:
+            write_json_atomic(self.file_path, self.entries)
+
+    def update_directory(self, directory, stage):
+        """
+        Updates the files of stage from directory. New and changed files are read, files of stage that are no
+        longer in directory are removed from the index.
+
+        :return: number of added, changed or removed files
+        """
+        suffix = STAGE_SUFFIXES[stage]
+        current = {}
+        if directory and Path(directory).is_dir():
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.name.startswith('.') or not entry.name.lower().endswith(suffix) or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    current[get_cast_id(entry.name)] = dict(path=str(Path(directory, entry.name)),
+                                                            size=stat.st_size,
+                                                            mtime=stat.st_mtime_ns)
+        with self._lock:
+            indexed = {cast_id: entry['files'][stage] for cast_id, entry in self.entries.items()
+                       if stage in entry['files']}
+        changed = [cast_id for cast_id, file_info in current.items() if indexed.get(cast_id) != file_info]
+        removed = [cast_id for cast_id in indexed if cast_id not in current]
+        infos = {}
+        for cast_id in changed:
+            try:
+                infos[cast_id] = STAGE_READERS[stage](current[cast_id]['path'])
+            except (OSError, ValueError):
+                infos[cast_id] = {}
+        with self._lock:
+            for cast_id in changed:
+                entry = self.entries.setdefault(cast_id, {'files': {}})
+                for key, value in infos[cast_id].items():
+                    if value is not None:
+                        entry[key] = value
+                entry['files'][stage] = current[cast_id]
+            for cast_id in removed:
+                entry = self.entries[cast_id]
+                entry['files'].pop(stage, None)
+                if not entry['files']:
+                    self.entries.pop(cast_id)
+        return len(changed) + len(removed)
+
+    def update(self, directories):
+        """
+        Updates the index from a dict with stage as key and directory as value and saves it if anything changed.
+        """
+        nr_changed = 0
+        for stage, directory in directories.items():
+            nr_changed += self.update_directory(directory, stage)
+        if nr_changed:
+            self.save()
+        return nr_changed
+
+    def get_casts(self, stage=None):
+        """
+        Returns a list of (cast_id, entry) sorted on cast id. If stage is given only casts having a file in
+        that stage are returned.
+        """
+        with self._lock:
+            return [(cast_id, entry) for cast_id, entry in sorted(self.entries.items())
+                    if stage is None or stage in entry['files']]
+
+    def get_summary(self, stage):
+        casts = self.get_casts(stage)
+        if not casts:
+            return ''
+        stations = set(entry.get('station') for _, entry in casts if entry.get('station'))
+        times = sorted(entry['time'] for _, entry in casts if entry.get('time'))
+        summary = f'{len(casts)} kast, {len(stations)} stationer'
+        if times:
+            summary = f'{summary}, {times[0][:10]} - {times[-1][:10]}'
+        return summary
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+"""
+Headless processing of a directory of raw Seabird files.
+
+Run from the plugin directory:
+
+    python -m lib.cli --user default --raw-dir <directory with .hdr files>
+
+Paths and options not given on the command line are taken from users/<user>/basic_dirs.json
+and users/<user>/basic_options.json, i.e. the settings saved by the gui.
+"""
+import argparse
+import json
+import logging
+import sys
+from pathlib import Path
+
+from . import batch
+from . import journal
+from . import pipeline
+
+USERS_DIRECTORY = Path(Path(__file__).parent.parent, 'users')
+
+# Keys in basic_dirs.json for the paths used by the pipeline
+DIR_KEYS = {'working_dir': 'working',
+            'raw_files_dir': 'raw_files',
+            'cnv_files_dir': 'cnv_files',
+            'standard_files_dir': 'standard_files',
+            'qc_dir': 'qc_dir'}
+
+
+def load_user_settings(user, name, users_directory=USERS_DIRECTORY):
+    file_path = Path(users_directory, user, f'{name}.json')
+    if not file_path.exists():
+        return {}
+    with open(file_path, encoding='utf-8') as fid:
+        return json.load(fid)
+
+
+def get_sbe_options(basic_options, controller=None):
+    """
+    Returns the options for SveaController.sbe_processing that are stored in the user settings.
+    """
+    if controller is None:
+        controller = batch.create_svea_controller()
+    options = {}
+    for key in controller.ctd_processing_options:
+        if key in ['overwrite', 'root_directory']:
+            continue
+        if key in basic_options:
+            options[key] = basic_options[key]
+    return options
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Process Svea CTD casts without the gui')
+    parser.add_argument('--user', default='default', help='User whose saved settings are used')
+    parser.add_argument('--working-dir', help='Working directory (root directory for the processing)')
+    parser.add_argument('--raw-dir', help='Directory with raw files (.hdr, .hex etc.)')
+    parser.add_argument('--stages', nargs='+', choices=pipeline.ALL_STAGES, default=pipeline.ALL_STAGES,
+                        help='Stages to run. They are always run in pipeline order')
+    parser.add_argument('--workers', type=int, help='Number of worker processes for SBE processing')
+    parser.add_argument('--overwrite', action='store_true', default=None, help='Allow overwriting files')
+    parser.add_argument('--resume', action='store_true',
+                        help='Only run the casts and stages that an earlier run did not finish')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    logger = logging.getLogger('svea_ctd')
+
+    basic_dirs = load_user_settings(args.user, 'basic_dirs')
+    basic_options = load_user_settings(args.user, 'basic_options')
+
+    paths = {key: basic_dirs.get(name, '') for key, name in DIR_KEYS.items()}
+    if args.working_dir:
+        paths['working_dir'] = args.working_dir
+    if args.raw_dir:
+        paths['raw_files_dir'] = args.raw_dir
+
+    if not paths['working_dir']:
+        logger.error('No working directory given')
+        return 1
+
+    overwrite = args.overwrite if args.overwrite is not None else basic_options.get('overwrite', False)
+    nr_workers = args.workers or int(basic_options.get('nr_workers') or batch.get_default_nr_workers())
+
+    stages = [name for name in pipeline.ALL_STAGES if name in args.stages]
+
+    raw_file_paths = []
+    if pipeline.STAGE_SBE_PROCESSING in stages:
+        if not paths['raw_files_dir']:
+            logger.error('No raw file directory given')
+            return 1
+        raw_file_paths = pipeline.get_raw_file_paths(paths['raw_files_dir'])
+        logger.info(f'{len(raw_file_paths)} raw files found in {paths["raw_files_dir"]}')
+
+    svea_pipeline = pipeline.SveaPipeline(paths,
+                                          overwrite=overwrite,
+                                          sbe_options=get_sbe_options(basic_options),
+                                          nr_workers=nr_workers,
+                                          stages=stages,
+                                          logger=logger,
+                                          resume=args.resume)
+    results = svea_pipeline.run(raw_file_paths)
+    print(pipeline.get_summary(results))
+    print(svea_pipeline.profiler.get_summary())
+    with journal.Journal(paths['working_dir']) as cast_journal:
+        print(cast_journal.get_summary())
+    if any(not res.ok for res in results):
+        return 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
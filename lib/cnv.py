@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+"""
+Fast reader for Seabird cnv files. The header is parsed once and the data block is converted to a
+contiguous float array in one pass with numpy. Very long casts can be read in blocks of scans with
+iter_blocks.
+"""
+import itertools
+import os
+import re
+from pathlib import Path
+
+import numpy as np
+
+END_OF_HEADER = b'*END*'
+COLUMN_WIDTH = 11
+DEFAULT_BLOCK_SIZE = 100000
+
+_name_pattern = re.compile(r'^# name (\d+) = ([^:]+):\s*(.*)$')
+
+
+class CnvFile:
+    """
+    Parsed cnv file. data is a 2d float array with one column per parameter in the same order as names.
+    For a block from iter_blocks, data holds the scans from first_scan on.
+    """
+    def __init__(self, file_path, header_lines, data, header=None, first_scan=0):
+        self.file_path = Path(file_path)
+        self.header_lines = header_lines
+        self.data = data
+        self.first_scan = first_scan
+        header = header or parse_header(header_lines)
+        self.names = header['names']
+        self.descriptions = header['descriptions']
+        self.bad_flag = header['bad_flag']
+        self.metadata = header['metadata']
+
+    def __repr__(self):
+        return f'CnvFile({self.file_path.name}: {self.nr_scans} scans, {len(self.names)} parameters)'
+
+    @property
+    def key(self):
+        return self.file_path.stem
+
+    @property
+    def nr_scans(self):
+        return self.data.shape[0]
+
+    def get(self, name):
+        return self.data[:, self.names.index(name)]
+
+    def get_column_index(self, *prefixes):
+        """
+        Returns the index of the first parameter whose name starts with any of the given prefixes.
+        """
+        for prefix in prefixes:
+            for i, name in enumerate(self.names):
+                if name.startswith(prefix):
+                    return i
+        return None
+
+
+def parse_header(header_lines):
+    """
+    Extracts parameter names, descriptions, bad flag and key/value metadata from cnv header lines.
+    Metadata is taken from lines like "** Station: 0120" and "* NMEA Latitude = 58 15.02 N".
+    """
+    names = {}
+    descriptions = {}
+    bad_flag = None
+    metadata = {}
+    for line in header_lines:
+        line = line.rstrip()
+        match = _name_pattern.match(line)
+        if match:
+            index = int(match.group(1))
+            names[index] = match.group(2).strip()
+            descriptions[index] = match.group(3).strip()
+        elif line.startswith('# bad_flag'):
+            bad_flag = float(line.split('=', 1)[1])
+        elif line.startswith('**') and ':' in line:
+            key, value = line[2:].split(':', 1)
+            metadata[key.strip()] = value.strip()
+        elif line.startswith('* ') and '=' in line:
+            key, value = line[2:].split('=', 1)
+            metadata.setdefault(key.strip(), value.strip())
+    return dict(names=[names[i] for i in sorted(names)],
+                descriptions=[descriptions[i] for i in sorted(descriptions)],
+                bad_flag=bad_flag,
+                metadata=metadata)
+
+
+def split_header(content):
+    """
+    Splits the content of a cnv file (bytes) in header lines and the data block.
+    """
+    index = content.find(END_OF_HEADER)
+    if index == -1:
+        raise ValueError('No end of header found in cnv file')
+    line_end = content.find(b'\n', index)
+    if line_end == -1:
+        line_end = len(content)
+    header_lines = content[:line_end].decode('cp1252').splitlines()
+    return header_lines, content[line_end + 1:]
+
+
+def read_header(file_path):
+    """
+    Returns the header lines of a cnv file without reading the data block.
+    """
+    header_lines = []
+    with open(file_path, 'rb') as fid:
+        for line in fid:
+            header_lines.append(line.decode('cp1252').rstrip('\r\n'))
+            if line.startswith(END_OF_HEADER):
+                break
+    return header_lines
+
+
+def read_header_and_edge_rows(file_path, tail_size=4096):
+    """
+    Returns the header lines and the first and last data lines (bytes) of a cnv file. Only the header and the
+    end of the file are read, so the cost does not depend on the number of scans.
+    """
+    header_lines = []
+    with open(file_path, 'rb') as fid:
+        for line in iter(fid.readline, b''):
+            header_lines.append(line.decode('cp1252').rstrip('\r\n'))
+            if line.startswith(END_OF_HEADER):
+                break
+        data_start = fid.tell()
+        first_row = fid.readline().rstrip(b'\r\n')
+        tail_start = max(data_start, os.fstat(fid.fileno()).st_size - tail_size)
+        fid.seek(tail_start)
+        tail_rows = [row for row in fid.read().splitlines() if row.strip()]
+    if not first_row.strip():
+        return header_lines, []
+    if tail_start == data_start and len(tail_rows) == 1:
+        # Only one data row in the file
+        return header_lines, [first_row]
+    return header_lines, [first_row, tail_rows[-1]]
+
+
+def write_header_copy(file_path, target_directory):
+    """
+    Writes a copy of a cnv file with the full header and only the first and last data rows to
+    target_directory. nvalues in the header is set to the number of rows kept. Readers that only need the
+    header metadata (and the start and end of the cast) can use the copy instead of the full file.
+    Returns the path of the copy.
+    """
+    header_lines, rows = read_header_and_edge_rows(file_path)
+    header_lines = [f'# nvalues = {len(rows)}' if line.startswith('# nvalues') else line for line in header_lines]
+    target_path = Path(target_directory, Path(file_path).name)
+    with open(target_path, 'wb') as fid:
+        fid.write('\r\n'.join(header_lines).encode('cp1252') + b'\r\n')
+        for row in rows:
+            fid.write(row + b'\r\n')
+    return target_path
+
+
+def iter_header_copies(file_paths, target_directory):
+    """
+    Generator writing header copies (see write_header_copy) of the cnv files one at a time and yielding
+    their paths. Only one header is in memory at a time.
+    """
+    for file_path in file_paths:
+        yield write_header_copy(file_path, target_directory)
+
+
+def parse_data_block(data_block, nr_columns):
+    """
+    Converts the whitespace separated data block to a 2d float array. Falls back to fixed width
+    columns if values are written without space in between (e.g. large negative numbers).
+    """
+    # Only strip the end, leading spaces are part of the first fixed width column
+    data_block = data_block.rstrip()
+    if not data_block.strip():
+        return np.empty((0, nr_columns), dtype=np.float64)
+    nr_lines = data_block.count(b'\n') + 1
+    try:
+        values = np.fromstring(data_block.decode('latin-1'), dtype=np.float64, sep=' ')
+    except ValueError:
+        values = None
+    if values is not None and values.size == nr_lines * nr_columns:
+        return values.reshape(nr_lines, nr_columns)
+    lines = [line for line in data_block.splitlines() if line.strip()]
+    width = COLUMN_WIDTH
+    data = np.empty((len(lines), nr_columns), dtype=np.float64)
+    for i, line in enumerate(lines):
+        data[i] = [float(line[j * width:(j + 1) * width]) for j in range(nr_columns)]
+    return data
+
+
+def read_cnv(file_path, bad_flag_to_nan=True):
+    """
+    Reads a cnv file.
+
+    :param bad_flag_to_nan: replace values equal to the bad flag in the header with nan
+    :return: CnvFile
+    """
+    with open(file_path, 'rb') as fid:
+        content = fid.read()
+    header_lines, data_block = split_header(content)
+    header = parse_header(header_lines)
+    data = parse_data_block(data_block, len(header['names']))
+    if bad_flag_to_nan and header['bad_flag'] is not None:
+        data[data == header['bad_flag']] = np.nan
+    return CnvFile(file_path, header_lines, data, header=header)
+
+
+def iter_blocks(file_path, block_size=DEFAULT_BLOCK_SIZE, bad_flag_to_nan=True):
+    """
+    Generator reading a cnv file in blocks of at most block_size scans. Yields a CnvFile per block, all
+    sharing the same header, with first_scan set to the index of the first scan in the block. Only one block
+    is in memory at a time, so memory use does not depend on the length of the cast.
+    """
+    with open(file_path, 'rb') as fid:
+        header_lines = []
+        for line in iter(fid.readline, b''):
+            header_lines.append(line.decode('cp1252').rstrip('\r\n'))
+            if line.startswith(END_OF_HEADER):
+                break
+        header = parse_header(header_lines)
+        nr_columns = len(header['names'])
+        first_scan = 0
+        while True:
+            lines = [line for line in itertools.islice(fid, block_size) if line.strip()]
+            if not lines:
+                break
+            data = parse_data_block(b''.join(lines), nr_columns)
+            if bad_flag_to_nan and header['bad_flag'] is not None:
+                data[data == header['bad_flag']] = np.nan
+            yield CnvFile(file_path, header_lines, data, header=header, first_scan=first_scan)
+            first_scan += data.shape[0]
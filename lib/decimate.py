@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+"""
+Level of detail versions of standard format files for the visual QC. Profiles are decimated with min/max
+per depth bin: for every depth bin and parameter the rows holding the minimum and maximum value are kept,
+so spikes and the envelope of each profile are preserved while the number of rows drops a lot.
+The kept rows are written unchanged, including their QC flags.
+
+Decimated files are only for viewing. QC flags set on them would be lost, so levels created for the visual
+QC are written read only.
+"""
+import os
+import stat
+from pathlib import Path
+
+import numpy as np
+
+from .manifest import FileManifest
+
+METADATA_PREFIX = '//'
+DEPTH_PREFIXES = ['DEPH', 'PRES']
+FLAG_PREFIXES = ['Q_', 'QFLAG', 'Q0_']
+
+# Bin size in meters for each level
+LEVELS = {'overview': 2.0,
+          'medium': 0.5}
+
+
+class StandardFormatFile:
+    """
+    Standard format file split in metadata lines, column names and data lines (kept as text).
+    """
+    def __init__(self, metadata_lines, columns, lines):
+        self.metadata_lines = metadata_lines
+        self.columns = columns
+        self.lines = lines
+
+    def get_column_index(self, prefixes):
+        for prefix in prefixes:
+            for i, name in enumerate(self.columns):
+                if name.startswith(prefix):
+                    return i
+        return None
+
+    def get_numeric_columns(self):
+        """
+        Returns a dict with column index as key and float array as value for all numeric parameter columns.
+        """
+        rows = [line.split('\t') for line in self.lines]
+        numeric = {}
+        for i, name in enumerate(self.columns):
+            if any(name.startswith(prefix) for prefix in FLAG_PREFIXES):
+                continue
+            try:
+                numeric[i] = np.array([row[i] if row[i].strip() else 'nan' for row in rows], dtype=np.float64)
+            except (ValueError, IndexError):
+                continue
+        return numeric
+
+
+def read_standard_format(file_path, encoding='cp1252'):
+    metadata_lines = []
+    columns = None
+    lines = []
+    with open(file_path, encoding=encoding) as fid:
+        for line in fid:
+            line = line.rstrip('\r\n')
+            if line.startswith(METADATA_PREFIX):
+                metadata_lines.append(line)
+            elif columns is None:
+                columns = line.split('\t')
+            elif line.strip():
+                lines.append(line)
+    return StandardFormatFile(metadata_lines, columns or [], lines)
+
+
+def make_writable(file_path):
+    """
+    Removes the read only flag of file_path if it exists. Needed before replacing or removing it on Windows.
+    """
+    try:
+        os.chmod(file_path, stat.S_IREAD | stat.S_IWRITE)
+    except FileNotFoundError:
+        pass
+
+
+def write_standard_format(file_path, standard_format_file, line_indices=None, encoding='cp1252', read_only=False):
+    lines = standard_format_file.lines
+    if line_indices is not None:
+        lines = [lines[i] for i in line_indices]
+    file_path = Path(file_path)
+    tmp_path = Path(file_path.parent, f'.{file_path.name}.tmp')
+    with open(tmp_path, 'w', encoding=encoding, newline='') as fid:
+        for line in standard_format_file.metadata_lines:
+            fid.write(line + '\n')
+        fid.write('\t'.join(standard_format_file.columns) + '\n')
+        for line in lines:
+            fid.write(line + '\n')
+    if read_only:
+        os.chmod(tmp_path, stat.S_IREAD)
+    make_writable(file_path)
+    os.replace(tmp_path, file_path)
+
+
+def minmax_indices(depth, columns, bin_size):
+    """
+    Returns the sorted row indices holding the min and max of each column in each depth bin.
+
+    :param depth: 1d array
+    :param columns: list of 1d arrays with the same length as depth
+    :param bin_size: size of the depth bins
+    """
+    nr_rows = len(depth)
+    if not nr_rows:
+        return np.array([], dtype=int)
+    bins = np.floor(np.nan_to_num(depth, nan=-1.0) / bin_size).astype(np.int64)
+    order = np.argsort(bins, kind='stable')
+    sorted_bins = bins[order]
+    starts = np.flatnonzero(np.r_[True, sorted_bins[1:] != sorted_bins[:-1]])
+    group = np.cumsum(np.r_[False, sorted_bins[1:] != sorted_bins[:-1]])
+    keep = [order[starts]]  # Always keep the first row of each bin
+    for values in columns:
+        values = values[order]
+        for reduce, fill in [(np.minimum, np.inf), (np.maximum, -np.inf)]:
+            filled = np.where(np.isnan(values), fill, values)
+            extreme = reduce.reduceat(filled, starts)
+            mask = (filled == extreme[group]) & ~np.isnan(values)
+            _, first = np.unique(group[mask], return_index=True)
+            keep.append(order[np.flatnonzero(mask)[first]])
+    return np.unique(np.concatenate(keep))
+
+
+def decimate_file(file_path, target_path, bin_size, read_only=False):
+    """
+    Writes a min/max decimated version of a standard format file. Returns (nr_rows_in, nr_rows_out).
+    """
+    standard_format_file = read_standard_format(file_path)
+    depth_index = standard_format_file.get_column_index(DEPTH_PREFIXES)
+    numeric = standard_format_file.get_numeric_columns()
+    if depth_index is None or depth_index not in numeric:
+        write_standard_format(target_path, standard_format_file, read_only=read_only)
+        return len(standard_format_file.lines), len(standard_format_file.lines)
+    depth = numeric.pop(depth_index)
+    indices = minmax_indices(depth, list(numeric.values()), bin_size)
+    write_standard_format(target_path, standard_format_file, line_indices=indices, read_only=read_only)
+    return len(standard_format_file.lines), len(indices)
+
+
+def create_level(file_paths, target_directory, bin_size, read_only=False):
+    """
+    Creates the decimated versions of file_paths in target_directory. Only new or changed files are decimated
+    and decimated files whose source is not among file_paths are removed, so target_directory holds exactly
+    the level of file_paths. Returns the paths of all decimated files.
+
+    :param read_only: write the decimated files read only
+    """
+    os.makedirs(target_directory, exist_ok=True)
+    manifest = FileManifest(target_directory)
+    file_paths = [Path(path) for path in file_paths]
+    changed = manifest.get_changed_files(file_paths)
+    for path in changed:
+        decimate_file(path, Path(target_directory, path.name), bin_size, read_only=read_only)
+    names = set(path.name for path in file_paths)
+    removed = [path.name for path in Path(target_directory).iterdir()
+               if path.is_file() and not path.name.startswith('.') and path.name not in names]
+    for name in removed:
+        make_writable(Path(target_directory, name))
+        os.remove(Path(target_directory, name))
+    manifest.remove([name for name in list(manifest.entries) if name not in names])
+    manifest.update(changed)
+    manifest.save()
+    return [Path(target_directory, path.name) for path in file_paths]
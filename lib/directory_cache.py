@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+import os
+import threading
+from pathlib import Path
+
+
+def scan_directory(directory):
+    """
+    Counts sub directories and files per suffix in directory.
+    os.scandir gives the entry type from the directory listing, so no extra stat is needed per entry.
+    """
+    content = {}
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_dir():
+                key = 'dirs'
+            else:
+                key = Path(entry.name).suffix
+            content.setdefault(key, 0)
+            content[key] += 1
+    return content
+
+
+def format_summary(content):
+    return_list = []
+    for key, value in content.items():
+        string = f'{value} ({key})'
+        return_list.append(string)
+    return ' - '.join(return_list)
+
+
+def _get_mtime(directory):
+    try:
+        stat = os.stat(directory)
+    except OSError:
+        return None
+    return stat.st_mtime_ns
+
+
+class DirectorySummaryCache:
+    """
+    Cache of directory summaries keyed on the modification time of the directory.
+    A directory is only listed again when its mtime has changed, i.e. when files have been added,
+    removed or renamed. Thread safe.
+    """
+    def __init__(self):
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def get_content(self, directory):
+        if not directory:
+            return {}
+        directory = str(directory)
+        mtime = _get_mtime(directory)
+        if mtime is None:
+            with self._lock:
+                self._cache.pop(directory, None)
+            return {}
+        with self._lock:
+            cached = self._cache.get(directory)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        try:
+            content = scan_directory(directory)
+        except OSError:
+            return {}
+        with self._lock:
+            self._cache[directory] = (mtime, content)
+        return content
+
+    def get_summary(self, directory):
+        return format_summary(self.get_content(directory))
+
+    def is_current(self, directory):
+        directory = str(directory)
+        with self._lock:
+            cached = self._cache.get(directory)
+        mtime = _get_mtime(directory)
+        if not cached:
+            # A missing directory that has never been cached has not changed
+            return mtime is None
+        return cached[0] == mtime
+
+    def refresh(self, directories):
+        """
+        Updates the cache for the given directories. Returns a list of the directories that had changed.
+        """
+        changed = []
+        for directory in directories:
+            if not directory:
+                continue
+            if self.is_current(directory):
+                continue
+            self.get_content(directory)
+            changed.append(directory)
+        return changed
+
+    def invalidate(self, directory=None):
+        with self._lock:
+            if directory is None:
+                self._cache = {}
+            else:
+                self._cache.pop(str(directory), None)
+
+
+class DirectoryWatcher(threading.Thread):
+    """
+    Polling thread that keeps a DirectorySummaryCache up to date for a set of directories.
+    Each poll is a single stat per directory. Changed directories are collected and fetched
+    from the gui thread with pop_changed().
+    """
+    def __init__(self, cache, interval=2.0):
+        threading.Thread.__init__(self, daemon=True)
+        self.cache = cache
+        self.interval = interval
+        self._directories = []
+        self._changed = set()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def set_directories(self, directories):
+        with self._lock:
+            self._directories = [str(d) for d in directories if d]
+
+    def pop_changed(self):
+        with self._lock:
+            changed = self._changed
+            self._changed = set()
+        return changed
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            with self._lock:
+                directories = list(self._directories)
+            try:
+                changed = self.cache.refresh(directories)
+            except OSError:
+                continue
+            if changed:
+                with self._lock:
+                    self._changed.update(changed)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+import contextlib
+import datetime
+import os
+import shutil
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+STAGING_PREFIX = '.staging_'
+TRASH_PREFIX = '.trash_'
+
+
+def get_staging_directory(target_directory):
+    time_str = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
+    return Path(target_directory, f'{STAGING_PREFIX}{os.getpid()}_{time_str}')
+
+
+def remove_stale_staging_directories(target_directory):
+    """
+    Removes staging directories left behind by a crash, i.e. the ones whose owner process is no longer running.
+    Staging directories of running processes, this one included, may be in use and are left in place.
+    """
+    from .journal import is_process_alive
+    target_directory = Path(target_directory)
+    if not target_directory.exists():
+        return
+    for path in target_directory.iterdir():
+        if not path.is_dir() or not path.name.startswith(STAGING_PREFIX):
+            continue
+        pid = get_directory_owner(path)
+        if pid is None or pid == os.getpid():
+            continue
+        if is_process_alive(pid) is False:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def staging_directory(target_directory):
+    """
+    Context manager giving a temporary directory inside target_directory. Files written there are on
+    the same file system as the target, so moving them in place is a rename and not a copy.
+    The staging directory is always removed on exit.
+    """
+    target_directory = Path(target_directory)
+    if not target_directory.exists():
+        os.makedirs(target_directory)
+    staging = get_staging_directory(target_directory)
+    os.makedirs(staging)
+    try:
+        yield staging
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def move_files(source_directory, target_directory):
+    """
+    Moves all files found (recursively) under source_directory to target_directory using os.replace.
+    Each file is replaced atomically. Returns the list of target paths.
+    """
+    target_paths = []
+    for root, dirs, files in os.walk(source_directory):
+        for file_name in files:
+            target_path = Path(target_directory, file_name)
+            os.replace(Path(root, file_name), target_path)
+            target_paths.append(target_path)
+    return target_paths
+
+
+def save_in_directory(save_function, target_directory):
+    """
+    Calls save_function(staging_directory) and moves the written files into target_directory.
+    If save_function raises, nothing is moved and the target directory is left untouched.
+
+    :return: list of paths to the files in target_directory
+    """
+    remove_stale_staging_directories(target_directory)
+    with staging_directory(target_directory) as staging:
+        save_function(staging)
+        return move_files(staging, target_directory)
+
+
+def get_trash_directory(directory):
+    directory = Path(directory)
+    time_str = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
+    return Path(directory.parent, f'{TRASH_PREFIX}{directory.name}_{os.getpid()}_{time_str}')
+
+
+def get_directory_owner(directory):
+    """
+    Returns the pid of the process that created the trash or staging directory or None if it can not be read
+    from the name.
+    """
+    parts = Path(directory).name.rsplit('_', 2)
+    try:
+        return int(parts[-2])
+    except (IndexError, ValueError):
+        return None
+
+
+def move_contents_aside(directory, keep=None):
+    """
+    Moves the content of directory to a new hidden sibling directory, so that the directory can be used again
+    at once while the old content is deleted in the background. Renames are done entry by entry, so
+    directory itself and the entries whose names start with a name in keep are left in place.
+
+    :return: (trash directory or None if nothing was moved, list of paths that could not be moved, e.g. a
+    file in use on Windows)
+    """
+    directory = Path(directory)
+    keep = tuple(keep or ())
+    trash_directory = get_trash_directory(directory)
+    not_moved = []
+    for path in list(directory.iterdir()):
+        if keep and path.name.startswith(keep):
+            continue
+        try:
+            os.makedirs(trash_directory, exist_ok=True)
+            os.rename(path, Path(trash_directory, path.name))
+        except OSError:
+            not_moved.append(path)
+    if not trash_directory.exists():
+        return None, not_moved
+    return trash_directory, not_moved
+
+
+def get_stale_trash_directories(parent_directory):
+    """
+    Returns trash directories in parent_directory left behind by deletions that did not finish: the ones
+    created by this process and the ones whose owner process is no longer running. Trash of other running
+    instances is left to them.
+    """
+    from .journal import is_process_alive
+    parent_directory = Path(parent_directory)
+    if not parent_directory.exists():
+        return []
+    stale = []
+    for path in parent_directory.iterdir():
+        if not path.is_dir() or not path.name.startswith(TRASH_PREFIX):
+            continue
+        pid = get_directory_owner(path)
+        if pid is None:
+            continue
+        if pid == os.getpid() or is_process_alive(pid) is False:
+            stale.append(path)
+    return stale
+
+
+def _remove(path, is_dir=False):
+    try:
+        if is_dir:
+            os.rmdir(path)
+        else:
+            try:
+                os.remove(path)
+            except PermissionError:
+                # Read only files (e.g. decimated levels) can not be removed on Windows
+                os.chmod(path, stat.S_IREAD | stat.S_IWRITE)
+                os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        return f'{path}: {e}'
+    return None
+
+
+def delete_tree(directory, nr_workers=8, keep_root=False):
+    """
+    Deletes everything under directory. Files are unlinked in a thread pool (deleting on network shares is
+    latency bound), then the directories are removed bottom up.
+
+    :param keep_root: only delete the content of directory
+    :return: list of error messages, one per entry that could not be removed
+    """
+    file_paths = []
+    directories = []
+    for root, dir_names, file_names in os.walk(directory):
+        file_paths.extend(Path(root, file_name) for file_name in file_names)
+        directories.extend(Path(root, dir_name) for dir_name in dir_names)
+    with ThreadPoolExecutor(max_workers=nr_workers) as executor:
+        errors = [error for error in executor.map(_remove, file_paths) if error]
+    # Deepest directories first. Directories that are not empty because a file could not be removed are
+    # not reported again.
+    if not keep_root:
+        directories.insert(0, Path(directory))
+    for path in sorted(directories, key=lambda p: len(p.parts), reverse=True):
+        error = _remove(path, is_dir=True)
+        if error and not errors:
+            errors.append(error)
+    return errors
+
+
+def delete_paths(paths, nr_workers=8):
+    """
+    Deletes the given files and directory trees.
+
+    :return: list of error messages, one per entry that could not be removed
+    """
+    errors = []
+    for path in paths:
+        if Path(path).is_dir():
+            errors.extend(delete_tree(path, nr_workers=nr_workers))
+        else:
+            error = _remove(path)
+            if error:
+                errors.append(error)
+    return errors
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+import logging
+import queue
+import threading
+import traceback
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobRunnerBusy(Exception):
+    pass
+
+
+class Job:
+    """
+    Handle to a job running in a JobRunner. The target function gets the job as its first argument
+    and uses it to report progress and to check for cancellation.
+    """
+    def __init__(self, runner, title=''):
+        self._runner = runner
+        self._cancel_event = threading.Event()
+        self.title = title
+
+    @property
+    def cancel_event(self):
+        return self._cancel_event
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled(self.title)
+
+    def report_progress(self, value=None, maximum=None, text=''):
+        """
+        Thread safe. The progress is passed on to the on_progress callback in the gui thread.
+        value=None means that the progress is unknown.
+        """
+        self._runner._put('progress', self, (value, maximum, text))
+
+
+class JobRunner:
+    """
+    Runs one job at a time in a background thread. Results, errors and progress are put on a queue
+    that is polled from the tkinter main loop so that all callbacks are called in the gui thread.
+    """
+    def __init__(self, widget, poll_interval=100, logger=None):
+        self.widget = widget
+        self.poll_interval = poll_interval
+        self.logger = logger or logging.getLogger(__name__)
+        self._queue = queue.Queue()
+        self._callbacks = {}
+        self._job = None
+        self._thread = None
+        self._polling = False
+
+    @property
+    def is_running(self):
+        return self._job is not None
+
+    @property
+    def job(self):
+        return self._job
+
+    def cancel(self):
+        if self._job:
+            self.logger.info(f'Cancelling job: {self._job.title}')
+            self._job.cancel()
+
+    def start(self, target, *args, title='', on_done=None, on_error=None, on_progress=None, on_cancel=None,
+              on_finished=None, **kwargs):
+        """
+        Starts target(job, *args, **kwargs) in a background thread.
+
+        :param on_done: called with the return value of target
+        :param on_error: called with the exception and the formatted traceback
+        :param on_progress: called with value, maximum and text
+        :param on_cancel: called if the job was cancelled. Called with the return value of target if target
+                          returned after being cancelled (e.g. the casts done before the cancel), or with None
+                          if target raised JobCancelled
+        :param on_finished: always called last, without arguments
+        :return: Job
+        """
+        if self.is_running:
+            raise JobRunnerBusy(f'Another job is running: {self._job.title}')
+        job = Job(self, title=title)
+        self._job = job
+        self._callbacks = dict(done=on_done,
+                               error=on_error,
+                               progress=on_progress,
+                               cancelled=on_cancel,
+                               finished=on_finished)
+        self._thread = threading.Thread(target=self._run, args=(job, target, args, kwargs), daemon=True)
+        self.logger.debug(f'Starting job: {title}')
+        self._thread.start()
+        if not self._polling:
+            self._polling = True
+            self.widget.after(self.poll_interval, self._poll)
+        return job
+
+    def _put(self, kind, job, data=None):
+        self._queue.put((kind, job, data))
+
+    def _run(self, job, target, args, kwargs):
+        try:
+            result = target(job, *args, **kwargs)
+        except JobCancelled:
+            self._put('cancelled', job)
+        except Exception as e:
+            self._put('error', job, (e, traceback.format_exc()))
+        else:
+            if job.cancelled:
+                self._put('cancelled', job, result)
+            else:
+                self._put('done', job, result)
+
+    def _poll(self):
+        try:
+            while True:
+                kind, job, data = self._queue.get_nowait()
+                self._handle(kind, job, data)
+        except queue.Empty:
+            pass
+        if self.is_running or not self._queue.empty():
+            self.widget.after(self.poll_interval, self._poll)
+        else:
+            self._polling = False
+
+    def _handle(self, kind, job, data):
+        if job is not self._job:
+            return
+        if kind == 'progress':
+            self._call('progress', *data)
+            return
+        # Job has ended
+        self._job = None
+        callbacks = self._callbacks
+        try:
+            if kind == 'done':
+                self.logger.debug(f'Job done: {job.title}')
+                self._call('done', data, callbacks=callbacks)
+            elif kind == 'error':
+                self.logger.error(f'Job failed: {job.title}\n{data[1]}')
+                self._call('error', *data, callbacks=callbacks)
+            elif kind == 'cancelled':
+                self.logger.info(f'Job cancelled: {job.title}')
+                self._call('cancelled', data, callbacks=callbacks)
+        finally:
+            self._call('finished', callbacks=callbacks)
+
+    def _call(self, name, *args, callbacks=None):
+        callback = (callbacks or self._callbacks).get(name)
+        if not callback:
+            return
+        try:
+            callback(*args)
+        except Exception:
+            self.logger.error(traceback.format_exc())
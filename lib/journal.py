@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+"""
+Persistent journal of the state of each cast in each processing stage, stored as a sqlite database in the
+working directory. A run that is interrupted (crash, closed app) can be resumed with only the unfinished
+casts. Casts are claimed in a transaction so that several workers or processes can pull from the same
+journal without processing a cast twice.
+
+Each claim records the host and pid of the owner, and an open journal refreshes a heartbeat on the casts it
+is running. A running cast is only considered abandoned, and set back to pending, when its owner process is
+gone (same host) or its heartbeat is older than STALE_TIMEOUT (e.g. an owner on another host).
+"""
+import datetime
+import logging
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from .cast_index import get_cast_id
+
+JOURNAL_FILE_NAME = '.svea_ctd_journal.sqlite'
+
+# Seconds between heartbeats of an open journal and age of a heartbeat after which a running cast is abandoned
+HEARTBEAT_INTERVAL = 30
+STALE_TIMEOUT = 10 * 60
+
+STATE_PENDING = 'pending'
+STATE_RUNNING = 'running'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+
+_CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS casts (
+    cast_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    state TEXT NOT NULL,
+    source TEXT,
+    message TEXT,
+    run_id TEXT,
+    host TEXT,
+    pid INTEGER,
+    heartbeat REAL,
+    updated TEXT,
+    PRIMARY KEY (cast_id, stage)
+)
+"""
+
+# Columns added after the first version of the table
+_ADDED_COLUMNS = {'host': 'TEXT',
+                  'heartbeat': 'REAL'}
+
+
+def _now():
+    return datetime.datetime.now().isoformat(timespec='seconds')
+
+
+def is_process_alive(pid):
+    """
+    Returns True if a process with pid is running on this host, None if it can not be determined.
+    """
+    if psutil:
+        return psutil.pid_exists(pid)
+    if sys.platform.startswith('win'):
+        # os.kill with signal 0 would terminate the process on Windows
+        return None
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return None
+    return True
+
+
+class Journal:
+    """
+    Cast x stage journal for one working directory. Casts left running by owners that are gone are reset to
+    pending when the journal is opened. Casts still running in this journal when it is closed are set back
+    to pending.
+    """
+    def __init__(self, working_directory, run_id=None, logger=None, heartbeat_interval=HEARTBEAT_INTERVAL,
+                 stale_timeout=STALE_TIMEOUT):
+        self.working_directory = Path(working_directory)
+        self.file_path = Path(self.working_directory, JOURNAL_FILE_NAME)
+        self.run_id = run_id or uuid.uuid4().hex
+        self.logger = logger or logging.getLogger(__name__)
+        self.host = socket.gethostname()
+        self.stale_timeout = stale_timeout
+        self._lock = threading.Lock()
+        os.makedirs(self.working_directory, exist_ok=True)
+        # Autocommit mode. Transactions are started explicitly where several statements must be atomic
+        self._connection = sqlite3.connect(str(self.file_path), timeout=30, isolation_level=None,
+                                           check_same_thread=False)
+        self._create_table()
+        nr_reset = self.reset_stale()
+        if nr_reset:
+            self.logger.info(f'{nr_reset} abandoned casts from an earlier run reset to pending')
+        self._stop_heartbeat = threading.Event()
+        self._heartbeat_thread = threading.Thread(target=self._run_heartbeat, args=(heartbeat_interval,),
+                                                  daemon=True)
+        self._heartbeat_thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _create_table(self):
+        self._connection.execute(_CREATE_TABLE)
+        columns = [row[1] for row in self._connection.execute('PRAGMA table_info(casts)')]
+        for name, column_type in _ADDED_COLUMNS.items():
+            if name not in columns:
+                self._connection.execute(f'ALTER TABLE casts ADD COLUMN {name} {column_type}')
+
+    def _run_heartbeat(self, interval):
+        while not self._stop_heartbeat.wait(interval):
+            try:
+                self.heartbeat()
+            except sqlite3.Error as e:
+                self.logger.warning(f'Could not update journal heartbeat: {e}')
+
+    def heartbeat(self):
+        """
+        Marks the casts running in this journal as alive.
+        """
+        self._execute('UPDATE casts SET heartbeat = ? WHERE state = ? AND run_id = ?',
+                      (time.time(), STATE_RUNNING, self.run_id))
+
+    def close(self):
+        if self._stop_heartbeat.is_set():
+            return
+        self._stop_heartbeat.set()
+        self._heartbeat_thread.join()
+        with self._lock:
+            # Casts still claimed by this journal are not being run by anyone any more
+            self._connection.execute('UPDATE casts SET state = ?, updated = ? WHERE state = ? AND run_id = ?',
+                                     (STATE_PENDING, _now(), STATE_RUNNING, self.run_id))
+            self._connection.close()
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def _is_abandoned(self, host, pid, heartbeat, now):
+        if heartbeat is None or now - heartbeat > self.stale_timeout:
+            return True
+        if host == self.host and pid is not None:
+            return is_process_alive(pid) is False
+        return False
+
+    def reset_stale(self):
+        """
+        Sets casts that are running in other runs whose owner is gone to pending. Returns the number of
+        reset casts.
+        """
+        now = time.time()
+        with self._lock:
+            connection = self._connection
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                rows = connection.execute('SELECT cast_id, stage, host, pid, heartbeat FROM casts '
+                                          'WHERE state = ? AND run_id != ?', (STATE_RUNNING, self.run_id)).fetchall()
+                stale = [(STATE_PENDING, _now(), cast_id, stage) for cast_id, stage, host, pid, heartbeat in rows
+                         if self._is_abandoned(host, pid, heartbeat, now)]
+                connection.executemany('UPDATE casts SET state = ?, updated = ? WHERE cast_id = ? AND stage = ?',
+                                       stale)
+                connection.execute('COMMIT')
+            except sqlite3.Error:
+                connection.execute('ROLLBACK')
+                raise
+        return len(stale)
+
+    def add(self, stage, file_paths):
+        """
+        Adds the casts of file_paths as pending in stage. Casts already in the journal are left as they are.
+        """
+        rows = [(get_cast_id(path), stage, STATE_PENDING, str(path), _now()) for path in file_paths]
+        with self._lock:
+            self._connection.executemany('INSERT OR IGNORE INTO casts (cast_id, stage, state, source, updated) '
+                                         'VALUES (?, ?, ?, ?, ?)', rows)
+
+    def claim(self, stage, file_path, redo=False):
+        """
+        Marks the cast of file_path as running in stage if no one else is running it. Done casts are only
+        claimed if redo is True. Returns True if the cast was claimed.
+        """
+        cast_id = get_cast_id(file_path)
+        states = [STATE_PENDING, STATE_FAILED]
+        if redo:
+            states.append(STATE_DONE)
+        with self._lock:
+            connection = self._connection
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.execute('INSERT OR IGNORE INTO casts (cast_id, stage, state, source, updated) '
+                                   'VALUES (?, ?, ?, ?, ?)', (cast_id, stage, STATE_PENDING, str(file_path), _now()))
+                cursor = connection.execute(f'UPDATE casts SET state = ?, source = ?, message = NULL, run_id = ?, '
+                                            f'host = ?, pid = ?, heartbeat = ?, updated = ? '
+                                            f'WHERE cast_id = ? AND stage = ? '
+                                            f'AND state IN ({", ".join("?" * len(states))})',
+                                            (STATE_RUNNING, str(file_path), self.run_id, self.host, os.getpid(),
+                                             time.time(), _now(), cast_id, stage, *states))
+                connection.execute('COMMIT')
+            except sqlite3.Error:
+                connection.execute('ROLLBACK')
+                raise
+        return cursor.rowcount == 1
+
+    def claim_next(self, stage):
+        """
+        Claims the next pending cast in stage. Returns its source path or None if there is nothing left.
+        """
+        with self._lock:
+            connection = self._connection
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = connection.execute('SELECT cast_id, source FROM casts WHERE stage = ? AND state = ? '
+                                         'ORDER BY cast_id LIMIT 1', (stage, STATE_PENDING)).fetchone()
+                if row:
+                    connection.execute('UPDATE casts SET state = ?, run_id = ?, host = ?, pid = ?, heartbeat = ?, '
+                                       'updated = ? WHERE cast_id = ? AND stage = ?',
+                                       (STATE_RUNNING, self.run_id, self.host, os.getpid(), time.time(), _now(),
+                                        row[0], stage))
+                connection.execute('COMMIT')
+            except sqlite3.Error:
+                connection.execute('ROLLBACK')
+                raise
+        return row[1] if row else None
+
+    def _set_state(self, stage, file_paths, state, message=None):
+        rows = [(state, message, self.run_id, _now(), get_cast_id(path), stage) for path in file_paths]
+        with self._lock:
+            self._connection.executemany('UPDATE casts SET state = ?, message = ?, run_id = ?, updated = ? '
+                                         'WHERE cast_id = ? AND stage = ?', rows)
+
+    def mark_done(self, stage, file_paths):
+        self._set_state(stage, file_paths, STATE_DONE)
+
+    def mark_failed(self, stage, file_paths, message=''):
+        self._set_state(stage, file_paths, STATE_FAILED, message)
+
+    def release(self, stage, file_paths):
+        """
+        Sets claimed casts that were never run (e.g. cancelled) back to pending.
+        """
+        self._set_state(stage, file_paths, STATE_PENDING)
+
+    def get_states(self, stage):
+        """
+        Returns a dict with the state of each cast in stage.
+        """
+        return dict(self._execute('SELECT cast_id, state FROM casts WHERE stage = ?', (stage,)))
+
+    def get_unfinished(self, stage):
+        """
+        Returns the source paths of the casts in stage that are not done.
+        """
+        rows = self._execute('SELECT source FROM casts WHERE stage = ? AND state != ? ORDER BY cast_id',
+                             (stage, STATE_DONE))
+        return [row[0] for row in rows]
+
+    def is_done(self, stage, file_paths):
+        """
+        Returns True if the casts of all file_paths are done in stage.
+        """
+        states = self.get_states(stage)
+        return all(states.get(get_cast_id(path)) == STATE_DONE for path in file_paths)
+
+    def has_unfinished_work(self, stage, file_paths):
+        """
+        Returns True if some, but not all, of the casts of file_paths are done in stage,
+        i.e. an earlier run of the stage did not finish.
+        """
+        states = self.get_states(stage)
+        nr_done = len([path for path in file_paths if states.get(get_cast_id(path)) == STATE_DONE])
+        return 0 < nr_done < len(file_paths)
+
+    def clear(self):
+        """
+        Removes all casts from the journal, e.g. when the content of the working directory is removed.
+        """
+        self._execute('DELETE FROM casts')
+
+    def get_summary(self):
+        rows = self._execute('SELECT stage, state, COUNT(*) FROM casts GROUP BY stage, state ORDER BY stage')
+        summary = {}
+        for stage, state, count in rows:
+            summary.setdefault(stage, {})[state] = count
+        lines = []
+        for stage, counts in summary.items():
+            parts = [f'{counts[state]} {state}' for state in [STATE_DONE, STATE_FAILED, STATE_RUNNING, STATE_PENDING]
+                     if counts.get(state)]
+            lines.append(f"{stage}: {', '.join(parts)}")
+        return '\n'.join(lines)
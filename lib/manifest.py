@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+MANIFEST_FILE_NAME = '.manifest.json'
+
+
+def get_file_hash(file_path, chunk_size=1024 * 1024):
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as fid:
+        for chunk in iter(lambda: fid.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def write_json_atomic(file_path, data):
+    """
+    Writes data as json to a temporary file next to file_path and renames it in place.
+    """
+    file_path = Path(file_path)
+    tmp_path = Path(file_path.parent, f'.{file_path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as fid:
+        json.dump(data, fid, indent=4)
+    os.replace(tmp_path, file_path)
+
+
+class FileManifest:
+    """
+    Keeps track of size, mtime and content hash of the source files used to create the files in a directory.
+    The manifest is stored as a json file in the directory. Files are identified by file name.
+    """
+    def __init__(self, directory, file_name=MANIFEST_FILE_NAME):
+        self.directory = Path(directory)
+        self.file_path = Path(self.directory, file_name)
+        self.entries = {}
+        self._hash_cache = {}
+        self.load()
+
+    def __contains__(self, file_name):
+        return file_name in self.entries
+
+    def load(self):
+        self.entries = {}
+        if not self.file_path.exists():
+            return
+        try:
+            with open(self.file_path, encoding='utf-8') as fid:
+                self.entries = json.load(fid).get('files', {})
+        except (ValueError, OSError):
+            # A broken manifest only means that everything is considered changed
+            self.entries = {}
+
+    def save(self):
+        if not self.directory.exists():
+            os.makedirs(self.directory)
+        write_json_atomic(self.file_path, {'files': self.entries})
+
+    def clear(self):
+        self.entries = {}
+        if self.file_path.exists():
+            os.remove(self.file_path)
+
+    def _get_hash(self, file_path, stat):
+        key = (str(file_path), stat.st_size, stat.st_mtime_ns)
+        if key not in self._hash_cache:
+            self._hash_cache[key] = get_file_hash(file_path)
+        return self._hash_cache[key]
+
+    def is_changed(self, file_path):
+        """
+        Returns True if the file is not in the manifest or has changed since it was recorded.
+        Size and mtime are checked first. The content hash is only calculated if they differ,
+        so a file that has only been touched is not considered changed.
+        """
+        file_path = Path(file_path)
+        entry = self.entries.get(file_path.name)
+        if not entry:
+            return True
+        stat = file_path.stat()
+        if entry.get('size') == stat.st_size and entry.get('mtime') == stat.st_mtime_ns:
+            return False
+        if entry.get('size') != stat.st_size:
+            return True
+        return entry.get('hash') != self._get_hash(file_path, stat)
+
+    def get_changed_files(self, file_paths):
+        return [path for path in file_paths if self.is_changed(path)]
+
+    def update(self, file_paths, **extra):
+        """
+        Records the current state of the given files. Extra keyword arguments are stored in each entry.
+        """
+        for path in file_paths:
+            path = Path(path)
+            stat = path.stat()
+            entry = dict(size=stat.st_size,
+                         mtime=stat.st_mtime_ns,
+                         hash=self._get_hash(path, stat))
+            entry.update(extra)
+            self.entries[path.name] = entry
+
+    def remove(self, file_names):
+        for name in file_names:
+            self.entries.pop(Path(name).name, None)
@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+import contextlib
+import logging
+import queue
+import shutil
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+from . import batch
+from . import journal
+from . import profiling
+from . import qc
+from .profiling import STAGE_SBE_PROCESSING, STAGE_METADATA, STAGE_STANDARD_FORMAT, STAGE_AUTOMATIC_QC
+
+ALL_STAGES = [STAGE_SBE_PROCESSING, STAGE_METADATA, STAGE_STANDARD_FORMAT, STAGE_AUTOMATIC_QC]
+
+_END = object()
+
+
+class PipelineError(Exception):
+    pass
+
+
+class Stage:
+    """
+    One step in a Pipeline.
+
+    A per cast stage calls function(item) for each item as soon as it arrives from the previous stage and
+    passes the result on as soon as it is done. Items are run in an executor with nr_workers workers.
+
+    A stage that is not per cast (a barrier) waits for all items from the previous stage and
+    calls function(items) once. It should return the list of items to pass on.
+    """
+    def __init__(self, name, function, per_cast=True, nr_workers=1, use_processes=False):
+        self.name = name
+        self.function = function
+        self.per_cast = per_cast
+        self.nr_workers = nr_workers
+        self.use_processes = use_processes
+
+    def create_executor(self):
+        if self.use_processes:
+            return ProcessPoolExecutor(max_workers=self.nr_workers)
+        return ThreadPoolExecutor(max_workers=self.nr_workers)
+
+
+class StageResult:
+    def __init__(self, stage_name, item, ok=True, message=''):
+        self.stage_name = stage_name
+        self.item = item
+        self.ok = ok
+        self.message = message
+
+
+class Pipeline:
+    """
+    Runs items through a chain of stages. Each stage runs in its own thread and the stages are
+    connected with queues. Between two per cast stages a cast can be in the later stage while the next cast
+    is still in the earlier one. A barrier stage stops this overlap: no item passes it before all items have
+    arrived. Items that fail in a stage are reported and not passed on.
+
+    If claim_callback is given it is called with (stage_name, item) before an item is submitted in a per cast
+    stage. Items for which it returns False are skipped.
+    """
+    def __init__(self, stages, logger=None, progress_callback=None, cancel_event=None, claim_callback=None):
+        self.stages = stages
+        self.logger = logger or logging.getLogger(__name__)
+        self.progress_callback = progress_callback
+        self.cancel_event = cancel_event or threading.Event()
+        self.claim_callback = claim_callback
+        self.results = []
+        self._lock = threading.Lock()
+
+    def _add_result(self, result):
+        with self._lock:
+            self.results.append(result)
+        if result.ok:
+            self.logger.info(f'{result.stage_name} done: {result.item}')
+        else:
+            self.logger.error(f'{result.stage_name} failed: {result.item}\n{result.message}')
+        if self.progress_callback:
+            self.progress_callback(result)
+
+    def run(self, items):
+        """
+        Runs all items through the pipeline and blocks until done.
+
+        :return: list of StageResult
+        """
+        self.results = []
+        queues = [queue.Queue() for _ in range(len(self.stages) + 1)]
+        threads = []
+        for stage, in_queue, out_queue in zip(self.stages, queues[:-1], queues[1:]):
+            target = self._run_per_cast_stage if stage.per_cast else self._run_barrier_stage
+            thread = threading.Thread(target=target, args=(stage, in_queue, out_queue), daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        for item in items:
+            queues[0].put(item)
+        queues[0].put(_END)
+
+        for thread in threads:
+            thread.join()
+        return self.results
+
+    def _run_per_cast_stage(self, stage, in_queue, out_queue):
+        def on_done(future, item):
+            try:
+                new_item = future.result()
+            except Exception:
+                self._add_result(StageResult(stage.name, item, ok=False, message=traceback.format_exc()))
+                return
+            self._add_result(StageResult(stage.name, new_item))
+            out_queue.put(new_item)
+
+        futures = []
+        with stage.create_executor() as executor:
+            while True:
+                item = in_queue.get()
+                if item is _END:
+                    break
+                if self.cancel_event.is_set():
+                    continue
+                if self.claim_callback and not self.claim_callback(stage.name, item):
+                    self.logger.info(f'{stage.name} skipped: {item}')
+                    continue
+                future = executor.submit(stage.function, item)
+                future.add_done_callback(lambda fut, item=item: on_done(fut, item))
+                futures.append(future)
+            if self.cancel_event.is_set():
+                for future in futures:
+                    future.cancel()
+        out_queue.put(_END)
+
+    def _run_barrier_stage(self, stage, in_queue, out_queue):
+        items = []
+        while True:
+            item = in_queue.get()
+            if item is _END:
+                break
+            items.append(item)
+        if items and not self.cancel_event.is_set():
+            try:
+                new_items = stage.function(items) or []
+            except Exception:
+                self._add_result(StageResult(stage.name, ', '.join([str(item) for item in items]),
+                                             ok=False, message=traceback.format_exc()))
+                new_items = []
+            else:
+                for new_item in new_items:
+                    self._add_result(StageResult(stage.name, new_item))
+            for new_item in new_items:
+                out_queue.put(new_item)
+        out_queue.put(_END)
+
+
+def sbe_process_cast(file_path, paths=None, overwrite=False, options=None):
+    """
+    Per cast stage function for SBE processing. Raises PipelineError if the processing fails.
+    Returns the BatchResult so that the directories of the processed cast can be used in later stages.
+    """
+    result = batch._sbe_process_file(str(file_path), paths, overwrite, options or {})
+    if not result.ok:
+        raise PipelineError(result.message)
+    return result
+
+
+class SveaPipeline:
+    """
+    Chains SBE processing, metadata file, standard format and automatic QC without any gui.
+    SBE processing and automatic QC are done per cast in process pools. Metadata file and standard format
+    work on whole directories in SveaController (the metadata file covers the whole cruise and standard format
+    needs it) and are run as barrier stages in one controller. A run is therefore a parallel SBE stage, followed
+    by metadata file and standard format for all casts, followed by a parallel QC stage. Casts do not overlap
+    across the barriers.
+
+    The state of each cast in each stage is recorded in a journal.Journal in the working directory. With
+    resume, casts that are done are skipped and leading stages that are done for all casts are not run.
+    """
+    def __init__(self, paths, overwrite=False, sbe_options=None, nr_workers=None, stages=None, logger=None,
+                 progress_callback=None, cancel_event=None, resume=False):
+        self.paths = dict(paths)
+        self.overwrite = overwrite
+        self.sbe_options = dict(sbe_options or {})
+        self.sbe_options.setdefault('root_directory', self.paths.get('working_dir'))
+        self.nr_workers = nr_workers or batch.get_default_nr_workers()
+        self.stage_names = stages or ALL_STAGES
+        self.logger = logger or logging.getLogger(__name__)
+        self.progress_callback = progress_callback
+        self.cancel_event = cancel_event
+        self._controller = None
+        self._qc_fingerprint = None
+        self.profiler = profiling.Profiler(self.paths.get('working_dir'), logger=self.logger)
+        self.resume = resume
+        self.journal = None
+        self._cast_paths = []
+
+    @property
+    def controller(self):
+        if not self._controller:
+            self._controller = batch.create_svea_controller(paths=self.paths,
+                                                            overwrite=self.overwrite,
+                                                            logger=self.logger)
+        return self._controller
+
+    def _stage_create_metadata_file(self, items):
+        for item in items:
+            if isinstance(item, batch.BatchResult):
+                self.controller.set_path_raw_files(item.dirs.get('raw_files'))
+                self.controller.set_path_cnv_files(item.dirs.get('cnv_files'))
+        with self._journal_barrier(STAGE_METADATA):
+            with self.profiler.measure(STAGE_METADATA):
+                new_dir = self.controller.create_metadata_file()
+            self.journal.mark_done(STAGE_METADATA, self._cast_paths)
+        self.controller.set_path_cnv_files(new_dir)
+        return [new_dir]
+
+    def _stage_create_standard_format(self, items):
+        """
+        Returns the standard format files so that automatic QC can run per cast.
+        """
+        with self._journal_barrier(STAGE_STANDARD_FORMAT):
+            with self.profiler.measure(STAGE_STANDARD_FORMAT) as record:
+                new_dir = self.controller.create_standard_format()
+                file_paths = [str(path) for path in qc.get_standard_format_files(new_dir)]
+                record['nr_files'] = len(file_paths)
+            self.journal.mark_done(STAGE_STANDARD_FORMAT, file_paths)
+        self.controller.set_path_standard_format_files(new_dir)
+        return self._get_stale_qc_files(file_paths)
+
+    @contextlib.contextmanager
+    def _journal_barrier(self, stage_name):
+        """
+        Records a barrier stage as running for all casts of the run and as failed if the block raises.
+        """
+        self.journal.add(stage_name, self._cast_paths)
+        for path in self._cast_paths:
+            self.journal.claim(stage_name, path, redo=True)
+        try:
+            yield
+        except Exception:
+            self.journal.mark_failed(stage_name, self._cast_paths, traceback.format_exc())
+            raise
+
+    def _get_stale_qc_files(self, file_paths):
+        """
+        Returns the files that are not already QC:ed with the current configuration.
+        """
+        if STAGE_AUTOMATIC_QC not in self.stage_names or not self.paths.get('qc_dir'):
+            return file_paths
+        manifest = qc.QcManifest(self.paths['qc_dir'])
+        return manifest.get_stale_files(file_paths, self._qc_fingerprint)
+
+    def _record_qc_results(self, results):
+        qc_results = [res.item for res in results if res.ok and isinstance(res.item, qc.QcResult)]
+        if not qc_results:
+            return
+        manifests = {}
+        for result in qc_results:
+            qc_directory = str(Path(result.output_paths[0]).parent) if result.output_paths else self.paths.get('qc_dir')
+            if not qc_directory:
+                continue
+            manifest = manifests.setdefault(qc_directory, qc.QcManifest(qc_directory))
+            manifest.add_result(result, self._qc_fingerprint)
+        for manifest in manifests.values():
+            manifest.save()
+
+    def _claim(self, stage_name, item):
+        return self.journal.claim(stage_name, item, redo=not self.resume)
+
+    def _on_stage_result(self, result):
+        # Per cast measurements are made in the worker processes and returned with the item
+        self.profiler.add(getattr(result.item, 'profile', None))
+        if result.stage_name in [STAGE_SBE_PROCESSING, STAGE_AUTOMATIC_QC]:
+            file_path = getattr(result.item, 'file_path', result.item)
+            if result.ok:
+                self.journal.mark_done(result.stage_name, [file_path])
+            else:
+                self.journal.mark_failed(result.stage_name, [file_path], result.message)
+        if self.progress_callback:
+            self.progress_callback(result)
+
+    def get_stages(self, stage_names=None):
+        stages = []
+        for name in stage_names or self.stage_names:
+            if name == STAGE_SBE_PROCESSING:
+                stages.append(Stage(name,
+                                    _SbeStageFunction(self.paths, self.overwrite, self.sbe_options),
+                                    nr_workers=self.nr_workers,
+                                    use_processes=True))
+            elif name == STAGE_AUTOMATIC_QC:
+                stages.append(Stage(name,
+                                    _QcStageFunction(self.paths, self.overwrite),
+                                    nr_workers=self.nr_workers,
+                                    use_processes=True))
+            else:
+                stages.append(Stage(name, getattr(self, f'_stage_{name}'), per_cast=False))
+        return stages
+
+    def run(self, raw_file_paths=None):
+        """
+        Runs the pipeline. raw_file_paths are the .hdr files to process. If SBE processing is not
+        among the stages the first stage is run on the directories given in paths.
+
+        :return: list of StageResult
+        """
+        self.journal = journal.Journal(self.paths.get('working_dir'), run_id=self.profiler.run_id,
+                                       logger=self.logger)
+        self._cast_paths = self._get_cast_paths(raw_file_paths)
+        stage_names = self._get_stage_names_to_run()
+        if not stage_names:
+            self.logger.info('All stages are done for all casts')
+            self.journal.close()
+            return []
+        if stage_names[0] == STAGE_SBE_PROCESSING:
+            items = [str(path) for path in raw_file_paths or []]
+        elif stage_names[0] == STAGE_AUTOMATIC_QC:
+            items = [str(path) for path in qc.get_standard_format_files(self.paths.get('standard_files_dir'))]
+            items = self._get_stale_qc_files(items)
+        else:
+            items = [self.paths.get('working_dir')]
+        if stage_names[0] in [STAGE_SBE_PROCESSING, STAGE_AUTOMATIC_QC]:
+            self.journal.add(stage_names[0], items)
+        pipeline = Pipeline(self.get_stages(stage_names),
+                            logger=self.logger,
+                            progress_callback=self._on_stage_result,
+                            cancel_event=self.cancel_event,
+                            claim_callback=self._claim)
+        if STAGE_AUTOMATIC_QC in stage_names:
+            self._qc_fingerprint = qc.get_qc_fingerprint()
+        try:
+            with self.profiler.measure('pipeline', nr_files=len(items)):
+                results = pipeline.run(items)
+            self._record_qc_results(results)
+            return results
+        finally:
+            shutil.rmtree(Path(self.paths.get('working_dir'), qc.STAGING_DIRECTORY_NAME), ignore_errors=True)
+            self.journal.close()
+
+    def _get_cast_paths(self, raw_file_paths):
+        """
+        Returns the files identifying the casts of the run: the raw files if given, otherwise the files in the
+        directory of the first stage.
+        """
+        if raw_file_paths:
+            return [str(path) for path in raw_file_paths]
+        if self.stage_names[0] == STAGE_AUTOMATIC_QC:
+            return [str(path) for path in qc.get_standard_format_files(self.paths.get('standard_files_dir'))]
+        cnv_directory = self.paths.get('cnv_files_dir')
+        if not cnv_directory:
+            return []
+        return [str(path) for path in sorted(Path(cnv_directory).glob('*.cnv'))]
+
+    def _get_stage_names_to_run(self):
+        """
+        Returns the stages to run. When resuming, leading stages that are done for all casts are left out.
+        """
+        stage_names = list(self.stage_names)
+        if not self.resume or not self._cast_paths:
+            return stage_names
+        while stage_names and self.journal.is_done(stage_names[0], self._cast_paths):
+            self.logger.info(f'{stage_names[0]} is done for all casts, resuming with the next stage')
+            stage_names.pop(0)
+        return stage_names
+
+
+class _SbeStageFunction:
+    """
+    Picklable callable used as stage function for SBE processing in a process pool.
+    """
+    def __init__(self, paths, overwrite, options):
+        self.paths = paths
+        self.overwrite = overwrite
+        self.options = options
+
+    def __call__(self, file_path):
+        return sbe_process_cast(file_path, paths=self.paths, overwrite=self.overwrite, options=self.options)
+
+
+class _QcStageFunction:
+    """
+    Picklable callable used as stage function for automatic QC of one standard format file.
+    """
+    def __init__(self, paths, overwrite):
+        self.paths = paths
+        self.overwrite = overwrite
+
+    def __call__(self, file_path):
+        working_directory = self.paths.get('working_dir')
+        staging_root = Path(working_directory, qc.STAGING_DIRECTORY_NAME)
+        result = qc.qc_cast(file_path, staging_root, overwrite=True)
+        if not result.ok:
+            raise PipelineError(result.message)
+        qc_directory = self.paths.get('qc_dir') or str(Path(working_directory, result.relative_qc_directory))
+        qc.move_qc_output(result, qc_directory, overwrite=self.overwrite)
+        return result
+
+
+def get_raw_file_paths(directory):
+    return sorted(Path(directory).glob('*.hdr'))
+
+
+def get_summary(results):
+    lines = []
+    for stage_name in ALL_STAGES:
+        stage_results = [res for res in results if res.stage_name == stage_name]
+        if not stage_results:
+            continue
+        nr_ok = len([res for res in stage_results if res.ok])
+        lines.append(f'{stage_name}: {nr_ok} ok, {len(stage_results) - nr_ok} failed')
+        for res in stage_results:
+            if not res.ok:
+                last_line = (res.message.strip().splitlines() or [''])[-1]
+                lines.append(f'    {res.item}: {last_line}')
+    return '\n'.join(lines)
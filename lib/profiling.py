@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+"""
+Instrumentation of the processing steps. Each measurement records wall time, cpu time, peak memory,
+bytes read and written and number of files for one stage, either for a whole step or for a single cast.
+Measurements are appended to a json lines run log in the working directory.
+
+The peak memory (peak_rss) is the peak resident memory of the measuring process over its lifetime, taken
+when the stage ends, not the peak of the stage alone. For casts measured in worker processes it is the peak of
+the worker. It is read from peak_wset (psutil) on Windows and ru_maxrss (resource) elsewhere. psutil is also
+used for io counters, which are left out if it is not installed.
+"""
+import contextlib
+import datetime
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+RUN_LOG_FILE_NAME = 'svea_ctd_run_log.jsonl'
+
+STAGE_SBE_PROCESSING = 'sbe_processing'
+STAGE_METADATA = 'create_metadata_file'
+STAGE_STANDARD_FORMAT = 'create_standard_format'
+STAGE_AUTOMATIC_QC = 'perform_automatic_qc'
+STAGE_VISUAL_QC = 'visual_qc'
+
+
+def get_peak_rss():
+    """
+    Returns the peak resident memory of the current process over its lifetime in bytes or None if not available.
+    """
+    if resource:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Bytes on macOS, kilobytes on Linux
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024
+    if psutil:
+        # resource is not available on Windows, where peak_wset is the peak working set of the process
+        return getattr(psutil.Process().memory_info(), 'peak_wset', None)
+    return None
+
+
+def get_io_counters():
+    """
+    Returns (bytes_read, bytes_written) for the current process or (None, None) if not available.
+    """
+    if not psutil:
+        return None, None
+    try:
+        counters = psutil.Process().io_counters()
+    except (AttributeError, psutil.Error):
+        return None, None
+    return getattr(counters, 'read_chars', counters.read_bytes), getattr(counters, 'write_chars', counters.write_bytes)
+
+
+@contextlib.contextmanager
+def measure(stage, cast=None, **extra):
+    """
+    Measures the block. Yields the record (a dict) so that the block can add e.g. nr_files. The record is
+    complete when the block has finished. ok is set to False if the block raises.
+    """
+    record = dict(stage=stage,
+                  cast=cast,
+                  start=datetime.datetime.now().isoformat(timespec='seconds'),
+                  pid=os.getpid(),
+                  ok=True,
+                  **extra)
+    read_start, write_start = get_io_counters()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield record
+    except BaseException:
+        record['ok'] = False
+        raise
+    finally:
+        record['wall_time'] = round(time.perf_counter() - wall_start, 4)
+        record['cpu_time'] = round(time.process_time() - cpu_start, 4)
+        record['peak_rss'] = get_peak_rss()
+        read_end, write_end = get_io_counters()
+        record['bytes_read'] = read_end - read_start if read_start is not None else None
+        record['bytes_written'] = write_end - write_start if write_start is not None else None
+
+
+class Profiler:
+    """
+    Collects measurement records and appends them to the run log in working_directory.
+    Records measured in worker processes are added with add.
+    """
+    def __init__(self, working_directory=None, run_id=None, logger=None):
+        self.working_directory = working_directory
+        self.run_id = run_id or datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+        self.logger = logger or logging.getLogger(__name__)
+        self.records = []
+        self._lock = threading.Lock()
+
+    @property
+    def log_path(self):
+        if not self.working_directory:
+            return None
+        return Path(self.working_directory, RUN_LOG_FILE_NAME)
+
+    @contextlib.contextmanager
+    def measure(self, stage, cast=None, **extra):
+        record = None
+        try:
+            with measure(stage, cast=cast, **extra) as record:
+                yield record
+        finally:
+            self.add(record)
+
+    def add(self, record):
+        if not record:
+            return
+        record = dict(record, run_id=self.run_id)
+        with self._lock:
+            self.records.append(record)
+            if not self.log_path or not Path(self.working_directory).is_dir():
+                return
+            try:
+                with open(self.log_path, 'a', encoding='utf-8') as fid:
+                    fid.write(json.dumps(record) + '\n')
+            except OSError as e:
+                self.logger.warning(f'Could not write run log: {e}')
+
+    def get_summary(self):
+        return get_summary(self.records)
+
+
+def read_run_log(working_directory, run_id=None):
+    """
+    Returns the records in the run log of working_directory. If run_id is given only records from that run
+    are returned, if run_id is 'last' the records of the latest run.
+    """
+    log_path = Path(working_directory, RUN_LOG_FILE_NAME)
+    if not log_path.exists():
+        return []
+    records = []
+    with open(log_path, encoding='utf-8') as fid:
+        for line in fid:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    if run_id == 'last' and records:
+        run_id = records[-1].get('run_id')
+    if run_id:
+        records = [record for record in records if record.get('run_id') == run_id]
+    return records
+
+
+def _format_bytes(nr_bytes):
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if abs(nr_bytes) < 1024 or unit == 'GB':
+            return f'{nr_bytes:.0f} {unit}' if unit == 'B' else f'{nr_bytes:.1f} {unit}'
+        nr_bytes /= 1024
+
+
+def get_summary(records):
+    """
+    Returns a text summary per stage. Stage level records (cast is None) give the time of the step, cast
+    level records give the number of casts and mean time per cast.
+    """
+    stages = []
+    for record in records:
+        if record['stage'] not in stages:
+            stages.append(record['stage'])
+    lines = []
+    for stage in stages:
+        stage_records = [record for record in records if record['stage'] == stage and record.get('cast') is None]
+        cast_records = [record for record in records if record['stage'] == stage and record.get('cast') is not None]
+        parts = []
+        if stage_records:
+            parts.append(f"{sum(record['wall_time'] for record in stage_records):.1f} s")
+            parts.append(f"cpu {sum(record['cpu_time'] for record in stage_records):.1f} s")
+        if cast_records:
+            mean_time = sum(record['wall_time'] for record in cast_records) / len(cast_records)
+            parts.append(f'{len(cast_records)} kast ({mean_time:.2f} s/kast)')
+        all_records = stage_records + cast_records
+        peak_rss = [record['peak_rss'] for record in all_records if record.get('peak_rss')]
+        if peak_rss:
+            parts.append(f'max minne (process) {_format_bytes(max(peak_rss))}')
+        for key, text in [('bytes_read', 'läst'), ('bytes_written', 'skrivet')]:
+            values = [record[key] for record in cast_records or stage_records if record.get(key) is not None]
+            if values:
+                parts.append(f'{text} {_format_bytes(sum(values))}')
+        # A step measured both as a whole and per cast would otherwise count its files twice
+        nr_files = [record['nr_files'] for record in cast_records or stage_records
+                    if record.get('nr_files') is not None]
+        if nr_files:
+            parts.append(f'{sum(nr_files)} filer')
+        nr_failed = len([record for record in all_records if not record.get('ok', True)])
+        if nr_failed:
+            parts.append(f'{nr_failed} misslyckade')
+        lines.append(f"{stage}: {', '.join(parts)}")
+    return '\n'.join(lines)
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+"""
+Automatic QC per cast in a process pool. Each worker runs SveaController.perform_automatic_qc on a
+staging directory holding one standard format file. The QC:ed file is moved into the QC directory as soon
+as the cast is done.
+"""
+import hashlib
+import importlib.metadata
+import importlib.util
+import json
+import logging
+import os
+import shutil
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from . import batch
+from . import profiling
+from .manifest import FileManifest, get_file_hash
+
+STAGING_DIRECTORY_NAME = '.qc_staging'
+STANDARD_FORMAT_SUFFIX = '.txt'
+QC_MANIFEST_FILE_NAME = '.qc_manifest.json'
+
+# Packages whose version is part of the QC configuration fingerprint
+QC_PACKAGES = ['svea', 'ctd_processing', 'ctdpy', 'profileqc']
+
+# QC settings and parameter mapping files, relative to their package directory, that are part of the QC
+# configuration fingerprint
+QC_CONFIG_FILES = {'profileqc': ['etc/parameter_dependencies.json',
+                                 'etc/qc_routines/qc_decrease.yaml',
+                                 'etc/qc_routines/qc_diff.yaml',
+                                 'etc/qc_routines/qc_increase.yaml',
+                                 'etc/qc_routines/qc_range.yaml',
+                                 'etc/qc_routines/qc_spike.yaml'],
+                   'ctdpy': ['core/etc/mapping_parameter.json',
+                             'core/etc/mapping_unit.json',
+                             'core/etc/readers/ctd_stdfmt.yaml']}
+
+class QcResult:
+
+    def __init__(self, file_path, ok=True, message='', output_paths=None, relative_qc_directory=None,
+                 profile=None):
+        self.file_path = str(file_path)
+        self.ok = ok
+        self.message = message
+        self.output_paths = output_paths or []
+        self.relative_qc_directory = relative_qc_directory
+        self.profile = profile
+
+    def __repr__(self):
+        status = 'ok' if self.ok else 'failed'
+        return f'QcResult({Path(self.file_path).name}: {status})'
+
+
+def get_standard_format_files(directory):
+    return sorted(path for path in Path(directory).glob(f'*{STANDARD_FORMAT_SUFFIX}')
+                  if not path.name.startswith('.'))
+
+
+def get_package_version(name):
+    try:
+        return importlib.metadata.version(name)
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+def get_package_directory(name):
+    """
+    Returns the directory of package name without importing it, or None if it is not installed.
+    """
+    try:
+        spec = importlib.util.find_spec(name)
+    except (ImportError, ValueError):
+        return None
+    if spec is None or not spec.submodule_search_locations:
+        return None
+    return Path(list(spec.submodule_search_locations)[0])
+
+
+def get_config_hash(file_path):
+    """
+    Returns the content hash of file_path or None if it does not exist.
+    """
+    try:
+        return get_file_hash(file_path)
+    except OSError:
+        return None
+
+
+def get_qc_fingerprint(config_paths=None, **settings):
+    """
+    Returns a fingerprint of the QC configuration: the versions of the packages doing the QC, their QC settings
+    and parameter mapping files (QC_CONFIG_FILES), the files in config_paths and any extra settings given as
+    keyword arguments. Casts QC:ed with another fingerprint are stale.
+    """
+    config = dict(settings)
+    config['versions'] = {name: get_package_version(name) for name in QC_PACKAGES}
+    for name, relative_paths in QC_CONFIG_FILES.items():
+        package_directory = get_package_directory(name)
+        config[name] = {path: get_config_hash(Path(package_directory, path)) if package_directory else None
+                        for path in relative_paths}
+    config['config_paths'] = {str(path): get_config_hash(path) for path in config_paths or []}
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+class QcManifest(FileManifest):
+    """
+    Manifest in the QC directory recording the input hash and QC configuration fingerprint for each cast.
+    """
+    def __init__(self, qc_directory):
+        FileManifest.__init__(self, qc_directory, file_name=QC_MANIFEST_FILE_NAME)
+
+    def is_stale(self, file_path, fingerprint):
+        if self.is_changed(file_path):
+            return True
+        entry = self.entries[Path(file_path).name]
+        if entry.get('fingerprint') != fingerprint:
+            return True
+        for path in entry.get('outputs', []):
+            if not Path(self.directory, path).exists():
+                return True
+        return False
+
+    def get_stale_files(self, file_paths, fingerprint):
+        return [path for path in file_paths if self.is_stale(path, fingerprint)]
+
+    def add_result(self, result, fingerprint):
+        self.update([result.file_path],
+                    fingerprint=fingerprint,
+                    outputs=[Path(path).name for path in result.output_paths])
+
+
+def qc_cast(file_path, staging_root, overwrite=False):
+    """
+    Worker function. Runs automatic QC for a single standard format file. The output is left in a
+    staging directory under staging_root. Returns a QcResult with the paths of the output files and
+    the QC directory relative to the staging directory, so the caller can mirror it in the working directory.
+    The measurement of the cast is returned in QcResult.profile.
+    """
+    with profiling.measure(profiling.STAGE_AUTOMATIC_QC, cast=Path(file_path).stem) as record:
+        result = _run_qc(file_path, staging_root, overwrite)
+        record['ok'] = result.ok
+        record['nr_files'] = len(result.output_paths)
+    result.profile = record
+    return result
+
+
+def _run_qc(file_path, staging_root, overwrite):
+    file_path = Path(file_path)
+    staging = Path(staging_root, file_path.stem)
+    try:
+        if staging.exists():
+            shutil.rmtree(staging)
+        standard_directory = Path(staging, 'standard_format_files')
+        os.makedirs(standard_directory)
+        shutil.copy2(file_path, Path(standard_directory, file_path.name))
+
+        controller = batch.create_svea_controller(paths={'working_dir': str(staging),
+                                                         'standard_files_dir': str(standard_directory)},
+                                                  overwrite=overwrite)
+        qc_directory = Path(controller.perform_automatic_qc())
+        try:
+            relative_qc_directory = qc_directory.relative_to(staging)
+        except ValueError:
+            relative_qc_directory = Path(qc_directory.name)
+        output_paths = [str(path) for path in qc_directory.iterdir() if path.is_file()]
+        return QcResult(file_path, output_paths=output_paths, relative_qc_directory=str(relative_qc_directory))
+    except Exception:
+        return QcResult(file_path, ok=False, message=traceback.format_exc())
+
+
+def move_qc_output(result, qc_directory, overwrite=False):
+    """
+    Moves the output of a finished cast into qc_directory. Returns the new paths.
+    Raises FileExistsError if a file exists and overwrite is False.
+    """
+    os.makedirs(qc_directory, exist_ok=True)
+    target_paths = [Path(qc_directory, Path(path).name) for path in result.output_paths]
+    if not overwrite:
+        for target_path in target_paths:
+            if target_path.exists():
+                raise FileExistsError(f'Har inte tillstånd att skriva över fil: {target_path}')
+    new_paths = []
+    for path, target_path in zip(result.output_paths, target_paths):
+        os.replace(path, target_path)
+        new_paths.append(str(target_path))
+    result.output_paths = new_paths
+    return new_paths
+
+
+def run_automatic_qc(file_paths, working_directory, qc_directory=None, overwrite=False, nr_workers=None,
+                     logger=None, progress_callback=None, cancel_event=None, incremental=True, profiler=None,
+                     journal=None, resume=False):
+    """
+    Runs automatic QC for each standard format file in a process pool.
+
+    :param qc_directory: directory for the QC:ed files. If None the directory used by SveaController
+    (relative to the working directory) is used
+    :param incremental: only QC casts whose input or QC configuration has changed since they were last
+    QC:ed into qc_directory
+    :param progress_callback: called with (nr_done, nr_total, result) each time a cast is done
+    :param cancel_event: threading.Event. When set, casts not yet started are skipped
+    :param profiler: profiling.Profiler that the measurement of each cast is added to
+    :param journal: journal.Journal where the state of each cast is recorded. Casts that are running
+                    elsewhere are skipped
+    :param resume: skip casts that are already done according to journal
+    :return: (qc_directory, list of QcResult)
+    """
+    logger = logger or logging.getLogger(__name__)
+    file_paths = [str(path) for path in file_paths]
+    fingerprint = get_qc_fingerprint()
+    manifest = QcManifest(qc_directory) if qc_directory else None
+    if incremental and manifest:
+        nr_files = len(file_paths)
+        file_paths = manifest.get_stale_files(file_paths, fingerprint)
+        logger.info(f'{nr_files - len(file_paths)} of {nr_files} casts are already QC:ed with the same configuration')
+        if not file_paths:
+            return qc_directory, []
+    if journal:
+        journal.add(profiling.STAGE_AUTOMATIC_QC, file_paths)
+        file_paths = [path for path in file_paths
+                      if journal.claim(profiling.STAGE_AUTOMATIC_QC, path, redo=not resume)]
+        if not file_paths:
+            return qc_directory, []
+    nr_workers = min(nr_workers or batch.get_default_nr_workers(), len(file_paths)) or 1
+    staging_root = Path(working_directory, STAGING_DIRECTORY_NAME)
+    if staging_root.exists():
+        shutil.rmtree(staging_root, ignore_errors=True)
+    results = {}
+    logger.info(f'Starting automatic QC of {len(file_paths)} casts using {nr_workers} workers')
+    try:
+        with ProcessPoolExecutor(max_workers=nr_workers) as executor:
+            # The staging directories are new, overwrite permission is checked when moving the output
+            futures = {executor.submit(qc_cast, path, str(staging_root), True): path for path in file_paths}
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                file_path = futures[future]
+                try:
+                    result = future.result()
+                except Exception:
+                    result = QcResult(file_path, ok=False, message=traceback.format_exc())
+                if result.ok:
+                    if qc_directory is None:
+                        qc_directory = str(Path(working_directory, result.relative_qc_directory))
+                    try:
+                        move_qc_output(result, qc_directory, overwrite=overwrite)
+                    except OSError as e:
+                        result.ok = False
+                        result.message = str(e)
+                if result.ok:
+                    if manifest is None:
+                        manifest = QcManifest(qc_directory)
+                    manifest.add_result(result, fingerprint)
+                    logger.info(f'Automatic QC done: {file_path}')
+                else:
+                    logger.error(f'Automatic QC failed: {file_path}\n{result.message}')
+                if profiler:
+                    profiler.add(result.profile)
+                if journal and result.ok:
+                    journal.mark_done(profiling.STAGE_AUTOMATIC_QC, [file_path])
+                elif journal:
+                    journal.mark_failed(profiling.STAGE_AUTOMATIC_QC, [file_path], result.message)
+                results[file_path] = result
+                if progress_callback:
+                    progress_callback(len(results), len(file_paths), result)
+                if cancel_event and cancel_event.is_set():
+                    for fut in futures:
+                        fut.cancel()
+    finally:
+        shutil.rmtree(staging_root, ignore_errors=True)
+        if manifest is not None:
+            manifest.save()
+        if journal:
+            journal.release(profiling.STAGE_AUTOMATIC_QC, [path for path in file_paths if path not in results])
+    return qc_directory, [results[path] for path in file_paths if path in results]
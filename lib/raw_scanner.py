@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+"""
+Scanner for directories with Seabird raw files. Files are grouped per cast (file stem) and only the .hdr
+header is read to get station, time and instrument serial number. Headers are read in a thread pool, which
+pays off on network drives, and the result is cached on the modification time of the directory and files.
+Headers already read into a cast index (lib.cast_index) with the same size and mtime are taken from the index.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from . import cast_index
+from . import cnv
+
+RAW_SUFFIXES = ['.hex', '.hdr', '.xmlcon', '.bl', '.btl']
+HEADER_KEYS = ['station', 'time', 'serial']
+
+
+class RawCast:
+    """
+    The raw files of one cast. files has the lower case suffix as key and the path as value.
+    """
+    def __init__(self, key, files, station=None, time=None, serial=None):
+        self.key = key
+        self.files = files
+        self.station = station
+        self.time = time
+        self.serial = serial
+
+    def __repr__(self):
+        return f'RawCast({self.key}: {", ".join(sorted(self.files))})'
+
+    @property
+    def hdr_path(self):
+        return self.files.get('.hdr')
+
+    @property
+    def missing(self):
+        return [suffix for suffix in RAW_SUFFIXES if suffix not in self.files]
+
+    @property
+    def is_complete(self):
+        return not self.missing
+
+    def get_status(self):
+        if self.is_complete:
+            return ''
+        return 'saknar ' + ', '.join(self.missing)
+
+
+def read_hdr_info(file_path):
+    """
+    Returns station, time and serial number from a .hdr file.
+    """
+    metadata = cnv.parse_header(cnv.read_header(file_path))['metadata']
+    time = next((cast_index.parse_time(metadata[key]) for key in cast_index.SEABIRD_TIME_KEYS
+                 if key in metadata), None)
+    return dict(station=metadata.get('Station'), time=time,
+                serial=cast_index.get_serial_number(file_path, metadata))
+
+
+def get_index_headers(index):
+    """
+    Returns a dict with the raw file path as key and ((size, mtime), header info) as value for the raw casts
+    in the cast index.
+    """
+    headers = {}
+    for _, entry in index.get_casts(cast_index.STAGE_RAW):
+        file_info = entry['files'][cast_index.STAGE_RAW]
+        headers[file_info['path']] = ((file_info['size'], file_info['mtime']),
+                                      {key: entry.get(key) for key in HEADER_KEYS})
+    return headers
+
+
+class RawScanner:
+    """
+    Cached scanner of raw file directories. Thread safe.
+    """
+    def __init__(self, nr_workers=8):
+        self.nr_workers = nr_workers
+        self._directories = {}
+        self._headers = {}
+        self._lock = threading.Lock()
+
+    def _read_headers(self, hdr_files, index=None):
+        """
+        Reads the headers in hdr_files ({path: (size, mtime)}) that are not cached or in index.
+        """
+        index_headers = get_index_headers(index) if index else {}
+        with self._lock:
+            for path, stat in hdr_files.items():
+                if path in index_headers and index_headers[path][0] == stat:
+                    self._headers[path] = index_headers[path]
+            to_read = [path for path, stat in hdr_files.items() if self._headers.get(path, (None,))[0] != stat]
+        if not to_read:
+            return
+
+        def read(path):
+            try:
+                return read_hdr_info(path)
+            except (OSError, ValueError):
+                return {}
+
+        with ThreadPoolExecutor(max_workers=min(self.nr_workers, len(to_read))) as executor:
+            infos = list(executor.map(read, to_read))
+        with self._lock:
+            for path, info in zip(to_read, infos):
+                self._headers[path] = (hdr_files[path], info)
+
+    def scan(self, directory, index=None):
+        """
+        Returns a list of RawCast sorted on key for all casts in directory that have a .hdr file.
+        The directory is only listed again if its mtime has changed.
+
+        :param index: cast_index.CastIndex whose raw entries are used instead of reading the headers
+        """
+        if not directory:
+            return []
+        directory = str(directory)
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return []
+        with self._lock:
+            cached = self._directories.get(directory)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        files = {}
+        hdr_files = {}
+        with os.scandir(directory) as it:
+            for entry in it:
+                suffix = Path(entry.name).suffix.lower()
+                if suffix not in RAW_SUFFIXES or not entry.is_file():
+                    continue
+                path = str(Path(directory, entry.name))
+                files.setdefault(Path(entry.name).stem, {})[suffix] = path
+                if suffix == '.hdr':
+                    stat = entry.stat()
+                    hdr_files[path] = (stat.st_size, stat.st_mtime_ns)
+        self._read_headers(hdr_files, index=index)
+
+        casts = []
+        with self._lock:
+            for key, cast_files in sorted(files.items()):
+                if '.hdr' not in cast_files:
+                    continue
+                info = self._headers[cast_files['.hdr']][1]
+                casts.append(RawCast(key, cast_files, **info))
+            self._directories[directory] = (mtime, casts)
+        return casts
+
+    def invalidate(self, directory=None):
+        with self._lock:
+            if directory is None:
+                self._directories = {}
+            else:
+                self._directories.pop(str(directory), None)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+# Files that are needed by every shard (e.g. the metadata file used together with the cnv files)
+SHARED_SUFFIXES = ['.xlsx']
+
+
+def split_list(items, nr_parts):
+    """
+    Splits items in nr_parts contiguous parts of (almost) equal size. Order is kept.
+    """
+    nr_parts = max(1, min(nr_parts, len(items)))
+    size, rest = divmod(len(items), nr_parts)
+    parts = []
+    start = 0
+    for i in range(nr_parts):
+        end = start + size + (1 if i < rest else 0)
+        parts.append(items[start:end])
+        start = end
+    return parts
+
+
+def read_sequential(file_paths, reader='smhi'):
+    from ctdpy.core import session as ctdpy_session
+    session = ctdpy_session.Session(filepaths=[str(path) for path in file_paths], reader=reader)
+    return session.read()
+
+
+def iter_datasets(file_paths, reader='smhi', batch_size=1, cache_directory=None):
+    """
+    Generator reading files with a ctdpy Session batch_size data files at a time. Yields (session, datasets)
+    for each batch. Files with a suffix in SHARED_SUFFIXES are read in every batch. Only one batch is held
+    in memory at a time, so peak memory is bounded by the largest batch and not by the whole cruise.
+
+    :param cache_directory: working directory holding the cast cache, see read_datasets_cached
+    """
+    from ctdpy.core import session as ctdpy_session
+    file_paths = [str(path) for path in file_paths]
+    shared_paths = [path for path in file_paths if Path(path).suffix in SHARED_SUFFIXES]
+    data_paths = [path for path in file_paths if path not in shared_paths]
+    batch_size = max(1, batch_size)
+    for start in range(0, len(data_paths), batch_size):
+        batch_paths = data_paths[start:start + batch_size] + shared_paths
+        session = ctdpy_session.Session(filepaths=batch_paths, reader=reader)
+        if cache_directory:
+            yield session, read_datasets_cached(session, cache_directory, reader=reader)
+        else:
+            yield session, session.read()
+
+
+def merge_datasets(shard_datasets):
+    """
+    Merges the results from Session.read() of several shards. Session.read() returns a sequence of dicts
+    (one per file type). Dicts at the same position are merged in shard order, so with contiguous shards
+    the key order is the same as for a sequential read. Entries from shared files are identical in all
+    shards and end up once.
+    """
+    merged = None
+    for datasets in shard_datasets:
+        if merged is None:
+            merged = [dict(item) if isinstance(item, dict) else item for item in datasets]
+            continue
+        for i, item in enumerate(datasets):
+            if i >= len(merged):
+                merged.append(item)
+            elif isinstance(item, dict):
+                merged[i].update(item)
+    if merged is None:
+        return []
+    if isinstance(shard_datasets[0], tuple):
+        return tuple(merged)
+    return merged
+
+
+def read_cnv_files(file_paths, nr_workers=1, cache_directory=None):
+    """
+    Reads cnv files with the fast reader in lib.cnv. Returns a dict with file stem as key and CnvFile as value.
+    Use this where only the parameter arrays and header are needed, the ctdpy writers need datasets
+    from read_datasets.
+
+    :param cache_directory: working directory holding the cast cache. Casts are loaded from the
+    cache when valid and added to it otherwise
+    """
+    from . import cnv
+    file_paths = [str(path) for path in file_paths]
+    if cache_directory:
+        from .cast_cache import CastCache
+        return CastCache(cache_directory).load_cnv_files(file_paths, nr_workers=nr_workers)
+    if nr_workers <= 1 or len(file_paths) < 2:
+        cnv_files = [cnv.read_cnv(path) for path in file_paths]
+    else:
+        with ProcessPoolExecutor(max_workers=nr_workers) as executor:
+            cnv_files = list(executor.map(cnv.read_cnv, file_paths, chunksize=4))
+    return {cnv_file.key: cnv_file for cnv_file in cnv_files}
+
+
+def read_datasets_cached(session, cache_directory, reader='smhi', nr_workers=1, logger=None):
+    """
+    Returns the same as session.read(), but the entry of each cnv file is taken from the cast cache in
+    cache_directory when the file is unchanged. Only the files not in the cache are read (with read_datasets)
+    and added to the cache. Datasets with other files (e.g. the metadata file, whose dataset is keyed on sheet
+    name and not on file name) are always read.
+    """
+    from .cast_cache import CastCache
+    logger = logger or logging.getLogger(__name__)
+    cache = CastCache(cache_directory)
+    # Session.readers holds the datasets having files, in the same order as returned by session.read()
+    dataset_paths = {name: [str(path) for path in session.readers[name]['file_names']] for name in session.readers}
+    cacheable = set(name for name, paths in dataset_paths.items()
+                    if all(Path(path).suffix.lower() == '.cnv' for path in paths))
+    entries = {}
+    to_read = []
+    for name, paths in dataset_paths.items():
+        if name not in cacheable:
+            to_read.extend(paths)
+            continue
+        for path in paths:
+            entry = cache.get_dataset_entry(path, reader, name)
+            if entry is None:
+                to_read.append(path)
+            else:
+                entries[(name, Path(path).name)] = entry
+    logger.debug(f'{len(entries)} of {len(entries) + len(to_read)} files loaded from the cast cache')
+
+    read = {}
+    if to_read:
+        to_read = list(dict.fromkeys(to_read))
+        to_read_set = set(to_read)
+        # A session only returns the datasets having files, in the same order as in the full session
+        read_names = [name for name, paths in dataset_paths.items() if to_read_set.intersection(paths)]
+        read = dict(zip(read_names, read_datasets(to_read, reader=reader, nr_workers=nr_workers, logger=logger)))
+        for name in cacheable.intersection(read):
+            for path in dataset_paths[name]:
+                file_name = Path(path).name
+                if path in to_read_set and file_name in read[name]:
+                    cache.put_dataset_entry(path, reader, name, read[name][file_name])
+    cache.save_manifest()
+
+    datasets = []
+    for name, paths in dataset_paths.items():
+        if name not in cacheable:
+            datasets.append(read[name])
+            continue
+        data = read.get(name, {})
+        merged = {}
+        for path in paths:
+            file_name = Path(path).name
+            entry = entries.get((name, file_name), data.get(file_name))
+            if entry is not None:
+                merged[file_name] = entry
+        datasets.append(merged)
+    return datasets
+
+
+def read_datasets(file_paths, reader='smhi', nr_workers=1, logger=None):
+    """
+    Reads files with a ctdpy Session. With nr_workers > 1 the data files are split in contiguous shards
+    that are read in separate processes and merged. Files with a suffix in SHARED_SUFFIXES are
+    read in every shard. The result is the same as for a sequential read.
+    """
+    logger = logger or logging.getLogger(__name__)
+    file_paths = [str(path) for path in file_paths]
+    shared_paths = [path for path in file_paths if Path(path).suffix in SHARED_SUFFIXES]
+    data_paths = [path for path in file_paths if path not in shared_paths]
+
+    start_time = time.time()
+    if nr_workers <= 1 or len(data_paths) < 2:
+        datasets = read_sequential(file_paths, reader=reader)
+        logger.debug(f'{len(file_paths)} files read in {time.time() - start_time:.3f} sec')
+        return datasets
+
+    shards = [part + shared_paths for part in split_list(data_paths, nr_workers)]
+    with ProcessPoolExecutor(max_workers=len(shards)) as executor:
+        shard_datasets = list(executor.map(read_sequential, shards, [reader] * len(shards)))
+    datasets = merge_datasets(shard_datasets)
+    logger.debug(f'{len(file_paths)} files read in {len(shards)} processes in {time.time() - start_time:.3f} sec')
+    return datasets
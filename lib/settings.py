@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+"""
+Debounced writing of user settings. The user settings objects of the main app write their json file on
+each call to set. SettingsWriter collects the values from a burst of saves and, when the gui has been quiet
+for a short while, writes the values that differ from what is stored through the public set method of the
+settings object. Only changed keys are set, so a burst of saves that changes one path gives one write.
+"""
+import logging
+
+
+class SettingsWriter:
+
+    def __init__(self, widget, delay=500, logger=None):
+        """
+        :param widget: tkinter widget used to schedule the write with after
+        :param delay: debounce time in milliseconds
+        """
+        self.widget = widget
+        self.delay = delay
+        self.logger = logger or logging.getLogger(__name__)
+        self._pending = {}
+        self._after_id = None
+
+    @property
+    def has_pending(self):
+        return bool(self._pending)
+
+    def set(self, settings, key, value):
+        """
+        Queues settings.set(key, value). Later values for the same key replace earlier ones.
+        """
+        self._pending.setdefault(id(settings), (settings, {}))[1][key] = value
+        self._schedule()
+
+    def update(self, settings, values):
+        for key, value in values.items():
+            self.set(settings, key, value)
+
+    def _schedule(self):
+        if self._after_id is not None:
+            self.widget.after_cancel(self._after_id)
+        self._after_id = self.widget.after(self.delay, self.flush)
+
+    def flush(self):
+        """
+        Writes all pending values now. Returns the number of values that were changed.
+        """
+        if self._after_id is not None:
+            self.widget.after_cancel(self._after_id)
+            self._after_id = None
+        pending = self._pending
+        self._pending = {}
+        nr_changed = 0
+        for settings, values in pending.values():
+            for key, value in values.items():
+                if settings.get(key) == value:
+                    continue
+                settings.set(key, value)
+                nr_changed += 1
+        if nr_changed:
+            self.logger.debug(f'{nr_changed} user settings saved')
+        return nr_changed
+
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+import contextlib
+import time
+
+
+class Timer:
+    """
+    Collects named time measurements, e.g. for the different parts of the plugin startup.
+    """
+    def __init__(self, name=''):
+        self.name = name
+        self.start_time = time.perf_counter()
+        self.measurements = []
+
+    @contextlib.contextmanager
+    def measure(self, label):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.measurements.append((label, time.perf_counter() - start_time))
+
+    @property
+    def total(self):
+        return time.perf_counter() - self.start_time
+
+    def get_report(self):
+        lines = [f'{self.name}: {self.total:.3f} s']
+        for label, seconds in self.measurements:
+            lines.append(f'    {label}: {seconds:.3f} s')
+        return '\n'.join(lines)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+"""
+Concurrent, verified copying of files, e.g. cnv files from a network share into the working directory.
+Files are copied in a bounded thread pool (copying is io bound). Each file is written to a temporary name,
+verified against the hash computed while reading the source and renamed in place, so the source is only
+read once and a failed copy never leaves a partial file.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from .manifest import get_file_hash
+
+DEFAULT_NR_WORKERS = 8
+CHUNK_SIZE = 1024 * 1024
+# File systems like FAT and some SMB shares store mtime with two seconds resolution
+MTIME_TOLERANCE = 2.0
+
+STATUS_COPIED = 'copied'
+STATUS_SKIPPED = 'skipped'
+STATUS_FAILED = 'failed'
+
+
+class CopyResult:
+
+    def __init__(self, source_path, target_path, status, nr_bytes=0, message=''):
+        self.source_path = str(source_path)
+        self.target_path = str(target_path)
+        self.status = status
+        self.nr_bytes = nr_bytes
+        self.message = message
+
+    def __repr__(self):
+        return f'CopyResult({Path(self.source_path).name}: {self.status})'
+
+    @property
+    def ok(self):
+        return self.status != STATUS_FAILED
+
+
+def is_identical(source_path, target_path, compare_hash=False):
+    """
+    Returns True if target_path exists and has the same size and mtime as source_path.
+    With compare_hash the content hashes are compared instead of mtime.
+    """
+    try:
+        source_stat = os.stat(source_path)
+        target_stat = os.stat(target_path)
+    except OSError:
+        return False
+    if source_stat.st_size != target_stat.st_size:
+        return False
+    if compare_hash:
+        return get_file_hash(source_path) == get_file_hash(target_path)
+    return abs(source_stat.st_mtime - target_stat.st_mtime) <= MTIME_TOLERANCE
+
+
+def copy_file(source_path, target_directory, compare_hash=False):
+    """
+    Copies source_path to target_directory unless an identical file is already there. The copy is verified
+    (size and sha256) before it replaces any existing file. Returns a CopyResult.
+    """
+    source_path = Path(source_path)
+    target_path = Path(target_directory, source_path.name)
+    if is_identical(source_path, target_path, compare_hash=compare_hash):
+        return CopyResult(source_path, target_path, STATUS_SKIPPED)
+    tmp_path = Path(target_directory, f'.{source_path.name}.{threading.get_ident()}.tmp')
+    try:
+        sha = hashlib.sha256()
+        nr_bytes = 0
+        with open(source_path, 'rb') as source, open(tmp_path, 'wb') as target:
+            for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                sha.update(chunk)
+                target.write(chunk)
+                nr_bytes += len(chunk)
+        shutil.copystat(source_path, tmp_path)
+        if os.path.getsize(tmp_path) != nr_bytes or get_file_hash(tmp_path) != sha.hexdigest():
+            raise OSError(f'Verification of copy failed: {target_path}')
+        os.replace(tmp_path, target_path)
+    except OSError as e:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return CopyResult(source_path, target_path, STATUS_FAILED, message=str(e))
+    return CopyResult(source_path, target_path, STATUS_COPIED, nr_bytes=nr_bytes)
+
+
+def copy_files(file_paths, target_directory, nr_workers=DEFAULT_NR_WORKERS, compare_hash=False, logger=None,
+               progress_callback=None):
+    """
+    Copies file_paths to target_directory concurrently.
+
+    :param compare_hash: compare content hash instead of size and mtime to find files that need no copy
+    :param progress_callback: called with (nr_done, nr_total, result) each time a file is done
+    :return: (list of CopyResult in the same order as file_paths, elapsed seconds)
+    """
+    logger = logger or logging.getLogger(__name__)
+    file_paths = [str(path) for path in file_paths]
+    os.makedirs(target_directory, exist_ok=True)
+    start_time = time.perf_counter()
+    results = {}
+    nr_workers = max(1, min(nr_workers, len(file_paths)))
+    with ThreadPoolExecutor(max_workers=nr_workers) as executor:
+        futures = {executor.submit(copy_file, path, target_directory, compare_hash): path for path in file_paths}
+        for future in as_completed(futures):
+            result = future.result()
+            results[futures[future]] = result
+            if not result.ok:
+                logger.error(f'Could not copy {result.source_path}: {result.message}')
+            if progress_callback:
+                progress_callback(len(results), len(file_paths), result)
+    seconds = time.perf_counter() - start_time
+    results = [results[path] for path in file_paths]
+    logger.info(get_summary(results, seconds))
+    return results, seconds
+
+
+def get_summary(results, seconds):
+    copied = [res for res in results if res.status == STATUS_COPIED]
+    nr_skipped = len([res for res in results if res.status == STATUS_SKIPPED])
+    nr_failed = len([res for res in results if res.status == STATUS_FAILED])
+    nr_bytes = sum(res.nr_bytes for res in copied)
+    throughput = nr_bytes / 1e6 / seconds if seconds else 0
+    return (f'{len(copied)} files copied ({nr_bytes / 1e6:.1f} MB, {throughput:.1f} MB/s), '
+            f'{nr_skipped} already up to date, {nr_failed} failed')
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+"""
+Long lived visual QC server. The bokeh server started by SveaController.open_visual_qc is kept running
+across clicks and is only restarted when the directory it serves or its settings change. The server reads
+the QC directory directly, so QC flags saved in the viewer end up in the QC files and a new browser session
+always loads the current data.
+
+For large cruises the server can be fed a decimated level of detail (see lib.decimate) instead of the full
+resolution files. Flags set on a decimated level can not be written back to the QC files, so the decimated
+files are read only and QC flags can only be saved at full resolution.
+"""
+import logging
+import threading
+from pathlib import Path
+
+from . import decimate
+from . import qc
+
+LOD_DIRECTORY_NAME = '.lod'
+
+
+class VisualQcServer:
+
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.controller = None
+        self.settings = None
+
+    @property
+    def is_running(self):
+        return self.controller is not None
+
+    def get_directory(self, qc_directory, level=None):
+        """
+        Returns the directory to serve for the given level of detail. The decimated files are kept in a hidden
+        directory in the QC directory and only recreated for new or changed casts.
+        """
+        if not level:
+            return Path(qc_directory)
+        lod_directory = Path(qc_directory, LOD_DIRECTORY_NAME, level)
+        decimate.create_level(qc.get_standard_format_files(qc_directory), lod_directory, decimate.LEVELS[level],
+                              read_only=True)
+        self.logger.debug(f'Visual QC data decimated to level {level}: {lod_directory}')
+        return lod_directory
+
+    def open(self, controller_factory, directory, server_file_directory, venv_path, shark_package_root,
+             visualize_setting):
+        """
+        Starts the server on directory if it is not running or if the directory or server settings have changed.
+
+        :param controller_factory: callable returning a new SveaController. The server gets its own controller
+        so that the paths of the gui controller are not changed
+        :param directory: the directory to serve, from get_directory. Creating a decimated level reads and
+        writes every file, so get_directory is called in the background by the gui
+        :return: True if a new server was started, False if the running server was reused
+        """
+        settings = (str(directory), str(server_file_directory), str(venv_path), str(shark_package_root),
+                    visualize_setting)
+        if self.is_running and settings == self.settings:
+            return False
+        self.close()
+        controller = controller_factory()
+        controller.set_path_standard_format_files_qc(str(directory))
+        controller.bokeh_visualize_setting = visualize_setting
+        controller.open_visual_qc(server_file_directory=server_file_directory,
+                                  venv_path=venv_path,
+                                  shark_package_root=shark_package_root)
+        self.controller = controller
+        self.settings = settings
+        self.logger.info(f'Visual QC server started on {directory}')
+        return True
+
+    def close(self):
+        if not self.controller:
+            return
+        try:
+            self.controller.close_visual_qc()
+        finally:
+            self.controller = None
+            self.settings = None
+            self.logger.info('Visual QC server closed')
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def get_server(logger=None):
+    """
+    Returns the visual QC server shared by all pages.
+    """
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = VisualQcServer(logger=logger)
+        return _server
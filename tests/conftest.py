@@ -0,0 +1,41 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# The plugin is loaded as a package by the main app. The modules in lib only use relative imports within lib,
+# so lib can be imported on its own from the repository root.
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+CNV_HEADER = """* Sea-Bird SBE 9 Data File:
+* FileName = C:\\ctd\\SBE09_1387_20200207_0801_77SE_00_0120.hex
+* System UTC = Feb 07 2020 08:01:00
+* NMEA Latitude = 58 15.02 N
+* NMEA Longitude = 011 26.50 E
+** Station: BY5
+# nquan = 3
+# nvalues = {nr_scans}
+# name 0 = prDM: Pressure, Digiquartz [db]
+# name 1 = t090C: Temperature [ITS-90, deg C]
+# name 2 = sal00: Salinity, Practical [PSU]
+# bad_flag = -9.990e-29
+*END*
+"""
+
+
+def write_cnv(file_path, rows):
+    lines = [''.join(f'{value:11.4f}' if value != -9.990e-29 else f'{value:11.3e}' for value in row)
+             for row in rows]
+    content = CNV_HEADER.format(nr_scans=len(rows)) + ''.join(f'{line}\n' for line in lines)
+    Path(file_path).write_bytes(content.replace('\n', '\r\n').encode('cp1252'))
+    return Path(file_path)
+
+
+@pytest.fixture
+def cnv_rows():
+    return [[float(i), 10.0 - i / 10, 7.0 + i / 100] for i in range(25)]
+
+
+@pytest.fixture
+def cnv_path(tmp_path, cnv_rows):
+    return write_cnv(tmp_path / 'SBE09_1387_20200207_0801_77SE_00_0120.cnv', cnv_rows)
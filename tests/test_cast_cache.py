@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from lib import cast_cache
+
+
+def test_fast_reader_entry_is_loaded_from_cache(tmp_path, cnv_path):
+    cache = cast_cache.CastCache(tmp_path / 'work')
+    first = cache.load(cnv_path)
+    assert cache.get(cnv_path) is not None
+    second = cast_cache.CastCache(tmp_path / 'work').load(cnv_path)
+    assert second.names == first.names
+    np.testing.assert_array_equal(second.data, first.data)
+
+
+def test_prune_removes_entries_of_removed_files(tmp_path, cnv_path):
+    cache = cast_cache.CastCache(tmp_path / 'work')
+    cache.load(cnv_path)
+    assert len(list(cache.directory.glob('*.npy'))) == 1
+    cnv_path.unlink()
+    cast_cache.CastCache(tmp_path / 'work').save_manifest()
+    assert list(cache.directory.glob('*.npy')) == []
+
+
+def test_dataset_entry_round_trip(tmp_path, cnv_path):
+    pd = pytest.importorskip('pandas')
+    entry = {'data': pd.DataFrame({'PRES_CTD': ['1.0', '2.0'], 'TEMP_CTD': ['5.1', '5.0']}),
+             'lores_data': None,
+             'metadata': {'STATN': 'BY5', 'LATIT': 58.25},
+             'raw_format': pd.Series(['* System UTC = Feb 07 2020 08:01:00', '*END*'])}
+    cache = cast_cache.CastCache(tmp_path / 'work')
+    assert cache.put_dataset_entry(cnv_path, 'smhi', 'cnv', entry)
+    loaded = cast_cache.CastCache(tmp_path / 'work').get_dataset_entry(cnv_path, 'smhi', 'cnv')
+    assert loaded['data'].equals(entry['data'])
+    assert loaded['raw_format'].equals(entry['raw_format'])
+    assert loaded['metadata'] == entry['metadata']
+    assert loaded['lores_data'] is None
+    assert cache.get_dataset_entry(cnv_path, 'smhi', 'xlsx') is None
+
+
+def test_dataset_entry_that_can_not_be_stored_exactly_is_not_cached(tmp_path, cnv_path):
+    pd = pytest.importorskip('pandas')
+    entry = {'data': pd.DataFrame({'PRES_CTD': ['1.0', None]}, dtype=object)}
+    cache = cast_cache.CastCache(tmp_path / 'work')
+    assert not cache.put_dataset_entry(cnv_path, 'smhi', 'cnv', entry)
+    assert cache.get_dataset_entry(cnv_path, 'smhi', 'cnv') is None
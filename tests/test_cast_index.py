@@ -0,0 +1,29 @@
+import pytest
+
+from lib import cast_index
+
+
+@pytest.mark.parametrize('file_name', ['SBE09_1387_20200207_0801_77SE_00_0120.hdr',
+                                       'SBE09_1387_20200207_0801_77SE_00_0120.cnv',
+                                       'ctd_profile_20200207_77SE_0120.txt'])
+def test_get_cast_id_is_the_same_in_all_stages(file_name):
+    assert cast_index.get_cast_id(file_name) == '20200207_77SE_0120'
+
+
+def test_get_cast_id_falls_back_to_stem():
+    assert cast_index.get_cast_id('/data/some_other_file.cnv') == 'some_other_file'
+
+
+def test_index_reads_cnv_and_removes_missing_files(tmp_path, cnv_path):
+    index = cast_index.CastIndex(tmp_path)
+    assert index.update({cast_index.STAGE_CNV: tmp_path}) == 1
+    entry = index.entries['20200207_77SE_0120']
+    assert entry['station'] == 'BY5'
+    assert entry['time'] == '2020-02-07T08:01:00'
+    assert (entry['depth_min'], entry['depth_max']) == (0.0, 24.0)
+    assert cast_index.CastIndex(tmp_path).entries == index.entries
+
+    assert index.update({cast_index.STAGE_CNV: tmp_path}) == 0
+    cnv_path.unlink()
+    assert index.update({cast_index.STAGE_CNV: tmp_path}) == 1
+    assert index.entries == {}
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from lib import cnv
+
+
+def test_parse_data_block_whitespace_separated():
+    data = cnv.parse_data_block(b'  1.0  2.0  3.0\r\n  4.0  5.0  6.0\r\n', 3)
+    np.testing.assert_array_equal(data, [[1, 2, 3], [4, 5, 6]])
+
+
+def test_parse_data_block_fixed_width_without_space():
+    # Large negative numbers fill the whole column width
+    line = f'{1.5:11.4f}{-12345678.5:11.1f}{-123456.125:11.3f}'.encode()
+    assert b'-12345678.5-123456.125' in line
+    data = cnv.parse_data_block(line + b'\r\n', 3)
+    np.testing.assert_array_equal(data, [[1.5, -12345678.5, -123456.125]])
+
+
+def test_parse_data_block_empty():
+    assert cnv.parse_data_block(b'\r\n', 3).shape == (0, 3)
+
+
+def test_read_cnv(cnv_path, cnv_rows):
+    cnv_file = cnv.read_cnv(cnv_path)
+    assert cnv_file.names == ['prDM', 't090C', 'sal00']
+    assert cnv_file.metadata['Station'] == 'BY5'
+    assert cnv_file.get_column_index('depSM', 'prDM') == 0
+    np.testing.assert_allclose(cnv_file.data, cnv_rows)
+
+
+def test_iter_blocks_matches_read_cnv(cnv_path):
+    blocks = list(cnv.iter_blocks(cnv_path, block_size=10))
+    assert [block.nr_scans for block in blocks] == [10, 10, 5]
+    assert [block.first_scan for block in blocks] == [0, 10, 20]
+    np.testing.assert_array_equal(np.vstack([block.data for block in blocks]), cnv.read_cnv(cnv_path).data)
+
+
+def test_bad_flag_is_nan(tmp_path, cnv_rows):
+    from conftest import write_cnv
+    cnv_rows[3][1] = -9.990e-29
+    file_path = write_cnv(tmp_path / 'bad_flag.cnv', cnv_rows)
+    assert np.isnan(cnv.read_cnv(file_path).data[3, 1])
+    blocks = list(cnv.iter_blocks(file_path, block_size=2))
+    assert np.isnan(blocks[1].data[1, 1])
+
+
+
+def test_header_copy_has_full_header_and_edge_rows(tmp_path, cnv_path):
+    target_directory = tmp_path / 'headers'
+    target_directory.mkdir()
+    copy_path = list(cnv.iter_header_copies([cnv_path], target_directory))[0]
+    original = cnv.read_cnv(cnv_path)
+    copy = cnv.read_cnv(copy_path)
+    assert copy.metadata == original.metadata
+    assert copy.names == original.names
+    assert copy.descriptions == original.descriptions
+    assert '# nvalues = 2' in copy.header_lines
+    np.testing.assert_array_equal(copy.data, original.data[[0, -1]])
+
+
+def test_header_copy_gives_same_ctdpy_metadata(tmp_path, cnv_path):
+    pytest.importorskip('ctdpy')
+    from ctdpy.core import session as ctdpy_session
+    target_directory = tmp_path / 'headers'
+    target_directory.mkdir()
+    copy_path = list(cnv.iter_header_copies([cnv_path], target_directory))[0]
+    original = ctdpy_session.Session(filepaths=[str(cnv_path)], reader='smhi').read()[0]
+    copy = ctdpy_session.Session(filepaths=[str(copy_path)], reader='smhi').read()[0]
+    assert copy[copy_path.name]['metadata'] == original[cnv_path.name]['metadata']
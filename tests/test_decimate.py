@@ -0,0 +1,58 @@
+import os
+import stat
+
+import numpy as np
+
+from lib import decimate
+
+
+def write_standard_format(file_path, depths, values):
+    lines = ['//METADATA;DELIMITERS;\\t', 'STATN\tDEPH\tTEMP_CTD\tQ_TEMP_CTD']
+    lines.extend(f'BY5\t{depth}\t{value}\t0' for depth, value in zip(depths, values))
+    file_path.write_text('\n'.join(lines) + '\n', encoding='cp1252')
+    return file_path
+
+
+def test_minmax_indices_keeps_extremes_per_bin():
+    depth = np.array([0.1, 0.2, 0.3, 1.1, 1.2, 1.3])
+    values = np.array([5.0, 9.0, 1.0, 4.0, 4.5, 4.2])
+    indices = decimate.minmax_indices(depth, [values], bin_size=1.0)
+    np.testing.assert_array_equal(indices, [0, 1, 2, 3, 4])
+
+
+def test_minmax_indices_ignores_nan():
+    depth = np.array([0.1, 0.2, 0.3])
+    values = np.array([np.nan, 2.0, 3.0])
+    np.testing.assert_array_equal(decimate.minmax_indices(depth, [values], bin_size=1.0), [0, 1, 2])
+
+
+def test_minmax_indices_empty():
+    assert decimate.minmax_indices(np.array([]), [], bin_size=1.0).size == 0
+
+
+def test_decimate_file_keeps_lines_unchanged(tmp_path):
+    depths = np.arange(0, 10, 0.1).round(1)
+    values = np.sin(depths)
+    source_path = write_standard_format(tmp_path / 'cast.txt', depths, values)
+    target_path = tmp_path / 'decimated.txt'
+    nr_in, nr_out = decimate.decimate_file(source_path, target_path, bin_size=2.0)
+    assert nr_in == 100
+    assert nr_out < nr_in
+    source = decimate.read_standard_format(source_path)
+    target = decimate.read_standard_format(target_path)
+    assert target.metadata_lines == source.metadata_lines
+    assert target.columns == source.columns
+    assert set(target.lines) <= set(source.lines)
+
+
+def test_create_level_is_read_only_and_removes_old_files(tmp_path):
+    source_directory = tmp_path / 'qc'
+    source_directory.mkdir()
+    first = write_standard_format(source_directory / 'first.txt', [0.5, 1.5], [1.0, 2.0])
+    second = write_standard_format(source_directory / 'second.txt', [0.5, 1.5], [1.0, 2.0])
+    lod_directory = tmp_path / 'lod'
+    decimate.create_level([first, second], lod_directory, bin_size=1.0, read_only=True)
+    assert not os.stat(lod_directory / 'first.txt').st_mode & stat.S_IWRITE
+
+    decimate.create_level([first], lod_directory, bin_size=1.0, read_only=True)
+    assert sorted(path.name for path in lod_directory.iterdir() if not path.name.startswith('.')) == ['first.txt']
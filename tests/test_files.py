@@ -0,0 +1,63 @@
+import os
+import subprocess
+import sys
+import stat
+
+from lib import files
+
+
+def create_tree(directory):
+    for sub_directory in ['a', 'a/b', 'c']:
+        os.makedirs(directory / sub_directory, exist_ok=True)
+        (directory / sub_directory / 'file.txt').write_text('data')
+    (directory / 'root.txt').write_text('data')
+
+
+def test_delete_tree(tmp_path):
+    directory = tmp_path / 'tree'
+    create_tree(directory)
+    assert files.delete_tree(directory, nr_workers=2) == []
+    assert not directory.exists()
+
+
+def test_delete_tree_keep_root(tmp_path):
+    directory = tmp_path / 'tree'
+    create_tree(directory)
+    assert files.delete_tree(directory, keep_root=True) == []
+    assert directory.exists()
+    assert list(directory.iterdir()) == []
+
+
+def test_delete_tree_removes_read_only_files(tmp_path):
+    directory = tmp_path / 'tree'
+    create_tree(directory)
+    os.chmod(directory / 'root.txt', stat.S_IREAD)
+    assert files.delete_tree(directory) == []
+    assert not directory.exists()
+
+
+def test_delete_tree_missing_directory(tmp_path):
+    assert files.delete_tree(tmp_path / 'missing') == []
+
+
+def test_move_contents_aside_keeps_given_names(tmp_path):
+    directory = tmp_path / 'working'
+    create_tree(directory)
+    (directory / 'journal.sqlite').write_text('journal')
+    trash_directory, not_moved = files.move_contents_aside(directory, keep=['journal.sqlite'])
+    assert not_moved == []
+    assert [path.name for path in directory.iterdir()] == ['journal.sqlite']
+    assert trash_directory in files.get_stale_trash_directories(tmp_path)
+    assert files.delete_tree(trash_directory) == []
+
+
+def test_remove_stale_staging_directories_keeps_running_owners(tmp_path):
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    stale = tmp_path / f'{files.STAGING_PREFIX}{process.pid}_20200207080100000000'
+    own = files.get_staging_directory(tmp_path)
+    for directory in [stale, own]:
+        os.makedirs(directory)
+    files.remove_stale_staging_directories(tmp_path)
+    assert not stale.exists()
+    assert own.exists()
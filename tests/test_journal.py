@@ -0,0 +1,66 @@
+import pytest
+
+from lib import journal
+
+STAGE = 'sbe_processing'
+FILE_PATHS = ['SBE09_1387_20200207_0801_77SE_00_0120.hex', 'SBE09_1387_20200207_0901_77SE_00_0121.hex']
+
+
+@pytest.fixture
+def cast_journal(tmp_path):
+    with journal.Journal(tmp_path, heartbeat_interval=3600) as cast_journal:
+        yield cast_journal
+
+
+def test_claim_only_once(tmp_path, cast_journal):
+    cast_journal.add(STAGE, FILE_PATHS)
+    assert cast_journal.claim(STAGE, FILE_PATHS[0])
+    assert not cast_journal.claim(STAGE, FILE_PATHS[0])
+    with journal.Journal(tmp_path, heartbeat_interval=3600) as other:
+        assert not other.claim(STAGE, FILE_PATHS[0])
+        assert other.claim_next(STAGE) == FILE_PATHS[1]
+        assert other.claim_next(STAGE) is None
+
+
+def test_done_casts_are_only_claimed_with_redo(cast_journal):
+    cast_journal.claim(STAGE, FILE_PATHS[0])
+    cast_journal.mark_done(STAGE, FILE_PATHS[:1])
+    assert not cast_journal.claim(STAGE, FILE_PATHS[0])
+    assert cast_journal.claim(STAGE, FILE_PATHS[0], redo=True)
+
+
+def test_unfinished_work(cast_journal):
+    cast_journal.add(STAGE, FILE_PATHS)
+    assert not cast_journal.has_unfinished_work(STAGE, FILE_PATHS)
+    cast_journal.claim(STAGE, FILE_PATHS[0])
+    cast_journal.mark_done(STAGE, FILE_PATHS[:1])
+    cast_journal.claim(STAGE, FILE_PATHS[1])
+    cast_journal.mark_failed(STAGE, FILE_PATHS[1:], 'error')
+    assert cast_journal.has_unfinished_work(STAGE, FILE_PATHS)
+    assert cast_journal.get_unfinished(STAGE) == FILE_PATHS[1:]
+    assert not cast_journal.is_done(STAGE, FILE_PATHS)
+
+
+def test_running_casts_are_pending_after_close(tmp_path):
+    with journal.Journal(tmp_path, heartbeat_interval=3600) as cast_journal:
+        cast_journal.claim(STAGE, FILE_PATHS[0])
+    with journal.Journal(tmp_path, heartbeat_interval=3600) as cast_journal:
+        assert set(cast_journal.get_states(STAGE).values()) == {journal.STATE_PENDING}
+
+
+def test_casts_of_alive_owner_are_not_reset(tmp_path, cast_journal):
+    cast_journal.claim(STAGE, FILE_PATHS[0])
+    with journal.Journal(tmp_path, heartbeat_interval=3600) as other:
+        assert other.reset_stale() == 0
+
+
+def test_casts_with_old_heartbeat_are_reset(tmp_path, cast_journal):
+    cast_journal.claim(STAGE, FILE_PATHS[0])
+    with journal.Journal(tmp_path, heartbeat_interval=3600, stale_timeout=-1) as other:
+        assert other.get_states(STAGE) == {'20200207_77SE_0120': journal.STATE_PENDING}
+
+
+def test_clear(cast_journal):
+    cast_journal.add(STAGE, FILE_PATHS)
+    cast_journal.clear()
+    assert cast_journal.get_states(STAGE) == {}
@@ -0,0 +1,66 @@
+import json
+import os
+
+from lib import manifest
+
+
+def test_write_json_atomic_leaves_no_tmp_file(tmp_path):
+    file_path = tmp_path / 'data.json'
+    manifest.write_json_atomic(file_path, {'a': 1})
+    manifest.write_json_atomic(file_path, {'a': 2})
+    assert json.loads(file_path.read_text(encoding='utf-8')) == {'a': 2}
+    assert [path.name for path in tmp_path.iterdir()] == ['data.json']
+
+
+def test_new_file_is_changed(tmp_path):
+    file_path = tmp_path / 'cast.cnv'
+    file_path.write_text('data')
+    assert manifest.FileManifest(tmp_path / 'out').is_changed(file_path)
+
+
+def test_saved_manifest_is_loaded(tmp_path):
+    file_path = tmp_path / 'cast.cnv'
+    file_path.write_text('data')
+    file_manifest = manifest.FileManifest(tmp_path / 'out')
+    file_manifest.update([file_path], extra='value')
+    file_manifest.save()
+
+    loaded = manifest.FileManifest(tmp_path / 'out')
+    assert 'cast.cnv' in loaded
+    assert loaded.entries['cast.cnv']['extra'] == 'value'
+    assert not loaded.is_changed(file_path)
+
+
+def test_touched_file_is_not_changed(tmp_path):
+    file_path = tmp_path / 'cast.cnv'
+    file_path.write_text('data')
+    file_manifest = manifest.FileManifest(tmp_path)
+    file_manifest.update([file_path])
+    stat = file_path.stat()
+    os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert not file_manifest.is_changed(file_path)
+
+
+def test_modified_file_is_changed(tmp_path):
+    file_path = tmp_path / 'cast.cnv'
+    file_path.write_text('data')
+    file_manifest = manifest.FileManifest(tmp_path)
+    file_manifest.update([file_path])
+    stat = file_path.stat()
+    file_path.write_text('date')
+    os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert file_manifest.is_changed(file_path)
+    assert file_manifest.get_changed_files([file_path]) == [file_path]
+
+
+def test_broken_manifest_is_empty(tmp_path):
+    (tmp_path / manifest.MANIFEST_FILE_NAME).write_text('{broken')
+    assert manifest.FileManifest(tmp_path).entries == {}
+
+
+def test_clear_removes_file(tmp_path):
+    file_manifest = manifest.FileManifest(tmp_path)
+    file_manifest.save()
+    file_manifest.clear()
+    assert not file_manifest.file_path.exists()
+    assert file_manifest.entries == {}
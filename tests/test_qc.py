@@ -0,0 +1,22 @@
+from lib import qc
+
+
+def test_fingerprint_changes_with_config_file(tmp_path):
+    config_path = tmp_path / 'qc_range.yaml'
+    config_path.write_text('range: 1')
+    fingerprint = qc.get_qc_fingerprint(config_paths=[config_path])
+    assert qc.get_qc_fingerprint(config_paths=[config_path]) == fingerprint
+    config_path.write_text('range: 2')
+    assert qc.get_qc_fingerprint(config_paths=[config_path]) != fingerprint
+
+
+def test_fingerprint_ignores_other_files_in_package_directory(tmp_path, monkeypatch):
+    package_directory = tmp_path / 'profileqc'
+    (package_directory / 'etc').mkdir(parents=True)
+    (package_directory / 'etc' / 'parameter_dependencies.json').write_text('{}')
+    monkeypatch.setattr(qc, 'get_package_directory', lambda name: package_directory)
+    fingerprint = qc.get_qc_fingerprint()
+    (package_directory / 'etc' / 'export.txt').write_text('written by the package')
+    assert qc.get_qc_fingerprint() == fingerprint
+    (package_directory / 'etc' / 'parameter_dependencies.json').write_text('{"TEMP": []}')
+    assert qc.get_qc_fingerprint() != fingerprint
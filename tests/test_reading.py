@@ -0,0 +1,60 @@
+import pytest
+
+from lib import reading
+
+
+def test_split_list_keeps_order():
+    assert reading.split_list(list(range(5)), 2) == [[0, 1, 2], [3, 4]]
+    assert reading.split_list([1], 4) == [[1]]
+
+
+def test_merge_datasets_keeps_shard_order():
+    shards = [[{'a.cnv': 1, 'b.cnv': 2}, {'meta.xlsx': 'm'}],
+              [{'c.cnv': 3}, {'meta.xlsx': 'm'}]]
+    merged = reading.merge_datasets(shards)
+    assert list(merged[0]) == ['a.cnv', 'b.cnv', 'c.cnv']
+    assert merged[1] == {'meta.xlsx': 'm'}
+
+
+def test_merge_datasets_does_not_change_first_shard():
+    first = [{'a.cnv': 1}]
+    reading.merge_datasets([first, [{'b.cnv': 2}]])
+    assert first == [{'a.cnv': 1}]
+
+
+def test_merge_datasets_keeps_tuple_and_extra_items():
+    merged = reading.merge_datasets([({'a.cnv': 1},), ({'b.cnv': 2}, {'meta.xlsx': 'm'})])
+    assert merged == ({'a.cnv': 1, 'b.cnv': 2}, {'meta.xlsx': 'm'})
+
+
+def test_merge_datasets_empty():
+    assert reading.merge_datasets([]) == []
+
+
+def assert_datasets_equal(datasets, expected):
+    assert len(datasets) == len(expected)
+    for data, expected_data in zip(datasets, expected):
+        assert list(data) == list(expected_data)
+        for file_name, entry in data.items():
+            expected_entry = expected_data[file_name]
+            assert list(entry) == list(expected_entry)
+            for key, value in entry.items():
+                if hasattr(value, 'equals'):
+                    assert value.equals(expected_entry[key])
+                else:
+                    assert value == expected_entry[key]
+
+
+def test_read_datasets_cached_equals_session_read(tmp_path, cnv_rows):
+    pytest.importorskip('ctdpy')
+    from ctdpy.core import session as ctdpy_session
+    from conftest import write_cnv
+    # One file in the old and one in the new SMHI file name format, read by two different readers
+    file_paths = [str(write_cnv(tmp_path / 'SBE09_1387_20200207_0801_77_10_0120.cnv', cnv_rows)),
+                  str(write_cnv(tmp_path / 'SBE09_1387_20200207_0901_77SE_00_0121.cnv', cnv_rows))]
+    expected = ctdpy_session.Session(filepaths=file_paths, reader='smhi').read()
+    assert len(expected) == 2
+    # Cold and warm cache
+    for _ in range(2):
+        session = ctdpy_session.Session(filepaths=file_paths, reader='smhi')
+        assert_datasets_equal(reading.read_datasets_cached(session, tmp_path / 'work'), expected)
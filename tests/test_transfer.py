@@ -0,0 +1,57 @@
+import os
+
+from lib import transfer
+
+
+def test_copy_file(tmp_path):
+    source_path = tmp_path / 'cast.cnv'
+    source_path.write_bytes(b'data' * 1000)
+    target_directory = tmp_path / 'target'
+    target_directory.mkdir()
+    result = transfer.copy_file(source_path, target_directory)
+    assert result.status == transfer.STATUS_COPIED
+    assert result.nr_bytes == 4000
+    assert (target_directory / 'cast.cnv').read_bytes() == source_path.read_bytes()
+    assert [path.name for path in target_directory.iterdir()] == ['cast.cnv']
+
+
+def test_identical_file_is_skipped(tmp_path):
+    source_path = tmp_path / 'cast.cnv'
+    source_path.write_bytes(b'data')
+    target_directory = tmp_path / 'target'
+    target_directory.mkdir()
+    transfer.copy_file(source_path, target_directory)
+    assert transfer.copy_file(source_path, target_directory).status == transfer.STATUS_SKIPPED
+    assert transfer.copy_file(source_path, target_directory, compare_hash=True).status == transfer.STATUS_SKIPPED
+
+
+def test_changed_file_is_copied_again(tmp_path):
+    source_path = tmp_path / 'cast.cnv'
+    source_path.write_bytes(b'data')
+    target_directory = tmp_path / 'target'
+    target_directory.mkdir()
+    transfer.copy_file(source_path, target_directory)
+    source_path.write_bytes(b'date')
+    stat = source_path.stat()
+    os.utime(source_path, (stat.st_atime, stat.st_mtime + 60))
+    assert transfer.copy_file(source_path, target_directory).status == transfer.STATUS_COPIED
+    assert (target_directory / 'cast.cnv').read_bytes() == b'date'
+
+
+def test_missing_source_fails(tmp_path):
+    result = transfer.copy_file(tmp_path / 'missing.cnv', tmp_path)
+    assert not result.ok
+    assert result.message
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_copy_files_reports_progress(tmp_path):
+    file_paths = []
+    for i in range(3):
+        file_paths.append(tmp_path / f'cast_{i}.cnv')
+        file_paths[-1].write_bytes(b'data')
+    progress = []
+    results, _ = transfer.copy_files(file_paths, tmp_path / 'target', nr_workers=2,
+                                     progress_callback=lambda nr_done, nr_total, result: progress.append(nr_done))
+    assert [result.source_path for result in results] == [str(path) for path in file_paths]
+    assert sorted(progress) == [1, 2, 3]